@@ -13,6 +13,13 @@ function widget:GetInfo() return {
 --
 local logfile
 local gameOver = false
+-- Summary only mode: stop once postprocess.py has everything it needs from us, rather than at GameOver
+local summaryOnly = false
+local summaryDone = false
+local summaryFactories = 5
+local summaryFrames = 0
+-- teamID => set of factory names finished, for the teams of players listed at startup
+local teamFactories = {}
 
 --
 -- Constants
@@ -43,6 +50,23 @@ local hiddenStats = {
 	damage_dealt = true,
 	unit_value_killed = true,
 }
+-- The factories postprocess.py builds factory progressions from. See: facplop in postprocess.py
+local factoryNames = {
+	["Cloakbot Factory"] = true,
+	["Shieldbot Factory"] = true,
+	["Rover Assembly"] = true,
+	["Hovercraft Platform"] = true,
+	["Gunship Plant"] = true,
+	["Airplane Plant"] = true,
+	["Spider Factory"] = true,
+	["Jumpbot Factory"] = true,
+	["Tank Foundry"] = true,
+	["Amphbot Factory"] = true,
+	["Shipyard"] = true,
+	["Strider Hub"] = true,
+}
+-- Marks the end of a summary only run, for postprocess.py, bin/run-simulation.sh and simulate.py
+local SUMMARY_COMPLETE = "Summary events complete"
 
 --
 -- Constant function cache
@@ -115,6 +139,9 @@ local function GetPlayerInfo (teamID)
 	local clanLong  = customKeys.clanfull or ""
 	local elo       = customKeys.elo      or "0"
 	line = name .. ", team: " .. teamID .. ", elo:" .. elo
+	if not isAI and name ~= "?" then
+		teamFactories[teamID] = {}
+	end
 	if customKeys.lobbyid then
 		line = line .. ', userid: ' .. customKeys.lobbyid
 	end
@@ -273,6 +300,35 @@ end
 
 local done_startup = false
 
+--
+-- Summary only mode. Once every player has finished summaryFactories distinct factories, or summaryFrames have passed,
+-- the rest of the game can't change the summary: postprocess.py takes the winner and duration from the battle's
+-- metadata instead. Mark the log, and quit rather than simulating on to GameOver.
+--
+
+local function summaryComplete()
+	if next(teamFactories) == nil then
+		return false
+	end
+	for _, factories in pairs(teamFactories) do
+		local count = 0
+		for _ in pairs(factories) do
+			count = count + 1
+		end
+		if count < summaryFactories then
+			return false
+		end
+	end
+	return true
+end
+
+local function finishSummary()
+	summaryDone = true
+	log(SUMMARY_COMPLETE)
+	logfile:flush()
+	Spring.SendCommands("quitforce")
+end
+
 function widget:GameFrame(f)
 	-- spring v104.0.1-1239/Zero-K v1.7.5.1 doesn't call widget:GameFrame on frame 0
 	if (not done_startup and f >= 0) then
@@ -282,6 +338,8 @@ function widget:GameFrame(f)
 	if gameOver then
 		printStats()
 		widgetHandler:RemoveCallIn("GameFrame")
+	elseif summaryOnly and not summaryDone and (summaryComplete() or (summaryFrames > 0 and f >= summaryFrames)) then
+		finishSummary()
 	end
 end
 
@@ -298,6 +356,12 @@ function widget:Initialize()
 	end
 	Spring.Echo("<Replay Stats> We appear to be in a replay/spectator. Writing stats to file.")
 	local num = Spring.GetConfigInt("ZKHeadlessReplay") or 'unknown'
+	summaryOnly = (Spring.GetConfigInt("ZKHeadlessReplaySummaryOnly", 0) or 0) ~= 0
+	summaryFactories = Spring.GetConfigInt("ZKHeadlessReplaySummaryFactories", summaryFactories) or summaryFactories
+	summaryFrames = Spring.GetConfigInt("ZKHeadlessReplaySummaryFrames", summaryFrames) or summaryFrames
+	if summaryOnly then
+		Spring.Echo("<Replay Stats> Summary only: stopping after " .. summaryFactories .. " factories per player, or frame " .. summaryFrames)
+	end
 	local filename = STATS_FOLDER ..  num .. '/events.log'
 	Spring.Echo("<Replay Stats> Attempting to open " .. filename)
 	local err
@@ -359,6 +423,9 @@ function widget:UnitFinished(unitID, unitDefID, unitTeam)
 
 	local humanName = Spring.Utilities.GetHumanName(ud)
 	AddEvent(unitTeam .. ' finished unit ' .. humanName, unitDefID, nil, "structureComplete", pos)
+	if teamFactories[unitTeam] and factoryNames[humanName] then
+		teamFactories[unitTeam][humanName] = true
+	end
 end
 
 function widget:UnitIdle(unitID, unitDefID, unitTeam)
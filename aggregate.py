@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+'''
+Incrementally combine per-battle summaries into the published dataset.
+
+Inputs:
+    shards/<shard>/summaries/shard.json.frags (stamp, touched when a shard has been processed)
+    shards/<shard>/summaries/<id>/summary.json
+    demos/exclude.txt
+    public/data/config.json, public/data/map-types.json (see enrich.py)
+    demos/fullwhr.json, demos/fullwhr-skipped.json, demos/fullwhr-missing.json (with --whr; see whrjoin.py)
+    summaries/summaries.db (with --db, instead of the shards; see summarydb.py)
+
+Outputs:
+    summaries/all.json
+    summaries/all.index.json
+
+The index records, for every battle seen, which shard it lives in, the
+mtime of its summary, and where its record lives in all.json. Only shards
+whose stamp changed are rescanned, only summaries whose mtime changed are
+reread, and everything else is copied straight out of the previous
+all.json by offset.
+
+Records are enriched with the fields the dashboard would otherwise derive
+on every page load. If the enrichment inputs change, everything is
+rebuilt.
+
+With --whr, getwhr.py's ratings are joined onto the records too. The index
+keeps a key of each battle's WHR inputs, so when getwhr.py's outputs
+change, only the battles whose ratings changed are rejoined, from their
+records in the previous all.json.
+
+With --db, summaries come from the summary database instead. all.json is
+then written in one scan of the database in gameid order, whenever the
+database's generation, the exclusions, or the enrichment inputs change.
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+import json
+import logging
+import mmap
+import os
+
+from enrich import Enricher
+import exclusions
+from summarydb import SummaryStore
+import whrjoin
+
+INDEX_VERSION = 2
+
+
+@dataclass(slots=True)
+class IndexEntry:
+    gameid: int
+    shard: str
+    mtime: int
+    skip: bool
+    # Location of this battle's record in all.json. offset is -1 if it isn't published.
+    offset: int = -1
+    length: int = 0
+    # Key of the WHR inputs joined onto its record, or None if WHR isn't joined. See: whrjoin.WHRData.key
+    whr: str | None = None
+
+    def to_json(self) -> list:
+        return [self.gameid, self.shard, self.mtime, int(self.skip), self.offset, self.length, self.whr]
+
+    @staticmethod
+    def from_json(row: list) -> IndexEntry:
+        gameid, shard, mtime, skip, offset, length, whr = row
+        return IndexEntry(gameid, shard, mtime, bool(skip), offset, length, whr)
+
+
+def stamp(path: str) -> list[int] | None:
+    '''
+    A cheap change detector for a file: its mtime and size, or None if it doesn't exist.
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def whr_stamp(whr: str | None) -> list[list[int] | None] | None:
+    return [stamp(path) for path in whrjoin.input_paths(whr)] if whr else None
+
+
+def write_atomically(path: str, data: str) -> None:
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Aggregator:
+    def __init__(self, root: str, output: str, index: str, exclude: str, enricher: Enricher, whr: str | None = None) -> None:
+        self._root = root
+        self._enricher = enricher
+        self._whr_path = whr
+        # Only loaded once a record needs joining
+        self._whr: whrjoin.WHRData | None = None
+        self._whr_stamp: list[list[int] | None] | None = None
+        self._output = output
+        self._index_path = index
+        self._exclude_path = exclude
+        self._entries: dict[int, IndexEntry] = {}
+        self._shard_stamps: dict[str, list[int] | None] = {}
+        self._exclude_stamp: list[int] | None = None
+        self._output_stamp: list[int] | None = None
+        # Records which must be written from freshly read text rather than copied from the old output
+        self._fresh: dict[int, str] = {}
+
+    def load_index(self) -> bool:
+        '''
+        Load the previous index. Returns False if there is no usable index, and everything must be rebuilt.
+        '''
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return False
+        if index.get('version') != INDEX_VERSION:
+            logging.info(f"Index version {index.get('version')} != {INDEX_VERSION}, rebuilding")
+            return False
+        if 'battles' not in index:
+            logging.info("Index was written by an export from the summary database, rebuilding")
+            return False
+        if index.get('output') != stamp(self._output):
+            logging.info(f"{self._output} does not match the index, rebuilding")
+            return False
+        if index.get('enrich') != self._enricher.digest:
+            logging.info("Enrichment inputs changed, rebuilding")
+            return False
+        self._entries = {row[0]: IndexEntry.from_json(row) for row in index['battles']}
+        self._shard_stamps = index['shards']
+        self._exclude_stamp = index['exclude']
+        self._output_stamp = index['output']
+        self._whr_stamp = index['whr']
+        return True
+
+    def shards(self) -> list[str]:
+        shards_dir = os.path.join(self._root, 'shards')
+        with os.scandir(shards_dir) as it:
+            return sorted(entry.name for entry in it if entry.is_dir())
+
+    def rescan_shard(self, shard: str) -> int:
+        '''
+        Pick up new, changed, and removed summaries in a shard. Returns the number of battles which changed.
+        '''
+        summaries_dir = os.path.join(self._root, 'shards', shard, 'summaries')
+        seen = set()
+        changed = 0
+        try:
+            it = os.scandir(summaries_dir)
+        except FileNotFoundError:
+            it = None
+        if it is not None:
+            with it:
+                for battle_dir in it:
+                    if not battle_dir.name.isdigit():
+                        continue
+                    gameid = int(battle_dir.name)
+                    summary_path = os.path.join(battle_dir.path, 'summary.json')
+                    summary_stamp = stamp(summary_path)
+                    if summary_stamp is None:
+                        continue
+                    seen.add(gameid)
+                    entry = self._entries.get(gameid)
+                    if entry is not None and entry.shard == shard and entry.mtime == summary_stamp[0]:
+                        continue
+                    summary = self.read_summary(summary_path)
+                    if summary is None:
+                        continue
+                    skip = summary.get('skip', False)
+                    self._entries[gameid] = IndexEntry(gameid, shard, summary_stamp[0], skip)
+                    if not skip:
+                        self._fresh[gameid] = self.render(self._entries[gameid], summary)
+                    changed += 1
+        for gameid in [gameid for gameid, entry in self._entries.items() if entry.shard == shard and gameid not in seen]:
+            del self._entries[gameid]
+            changed += 1
+        return changed
+
+    @staticmethod
+    def read_summary(path: str) -> dict | None:
+        with open(path, 'r') as f:
+            text = f.read().strip()
+        if not text:
+            # Shouldn't happen as summaries are written atomically, but don't poison all.json if it does
+            logging.warning(f"Empty summary at {path}, ignoring")
+            return None
+        return json.loads(text)
+
+    def whr_key(self, gameid: int) -> str | None:
+        if not self._whr_path:
+            return None
+        if self._whr is None:
+            self._whr = whrjoin.WHRData.load(self._whr_path)
+        return self._whr.key(gameid)
+
+    def join(self, entry: IndexEntry, record: dict) -> str:
+        '''
+        Join WHR ratings onto an enriched record, noting what was joined in its index entry.
+        '''
+        entry.whr = self.whr_key(entry.gameid)
+        return json.dumps(self._whr.join(record) if entry.whr is not None else whrjoin.strip(record))
+
+    def render(self, entry: IndexEntry, summary: dict) -> str:
+        return self.join(entry, self._enricher(summary))
+
+    def run(self, full: bool = False) -> None:
+        if full or not self.load_index():
+            self._entries = {}
+            self._shard_stamps = {}
+            self._exclude_stamp = None
+            self._output_stamp = None
+            self._whr_stamp = None
+
+        changed = 0
+        shards = self.shards()
+        for shard in shards:
+            shard_stamp = stamp(os.path.join(self._root, 'shards', shard, 'summaries', 'shard.json.frags'))
+            if shard in self._shard_stamps and self._shard_stamps[shard] == shard_stamp:
+                continue
+            shard_changed = self.rescan_shard(shard)
+            logging.info(f"Shard {shard}: {shard_changed} battles changed")
+            changed += shard_changed
+            self._shard_stamps[shard] = shard_stamp
+        for shard in set(self._shard_stamps) - set(shards):
+            # Shard directory went away entirely
+            for gameid in [gameid for gameid, entry in self._entries.items() if entry.shard == shard]:
+                del self._entries[gameid]
+                changed += 1
+            del self._shard_stamps[shard]
+
+        exclude_stamp = stamp(self._exclude_path)
+        excluded = exclusions.load(self._exclude_path)
+        published_before = {gameid for gameid, entry in self._entries.items() if entry.offset >= 0}
+        published = {gameid for gameid, entry in self._entries.items() if not entry.skip and gameid not in excluded}
+        unpublished = published_before - published
+        if exclude_stamp != self._exclude_stamp:
+            logging.info(f"Exclusions changed, {len(unpublished)} battles no longer published")
+        changed += len(unpublished)
+        # Battles which were previously excluded and are now allowed have no record in the old output to copy
+        for gameid in published - published_before - self._fresh.keys():
+            entry = self._entries[gameid]
+            summary = self.read_summary(os.path.join(self._root, 'shards', entry.shard, 'summaries', str(gameid), 'summary.json'))
+            if summary is None:
+                published.discard(gameid)
+                continue
+            self._fresh[gameid] = self.render(entry, summary)
+            changed += 1
+
+        # Everything else keeps its record, unless its WHR inputs changed
+        rejoin = set()
+        current_whr_stamp = whr_stamp(self._whr_path)
+        if current_whr_stamp != self._whr_stamp:
+            rejoin = {gameid for gameid in published - self._fresh.keys() if self._entries[gameid].whr != self.whr_key(gameid)}
+            logging.info(f"WHR ratings changed, {len(rejoin)} battles to rejoin")
+            changed += len(rejoin)
+
+        self._exclude_stamp = exclude_stamp
+        self._whr_stamp = current_whr_stamp
+        if not changed and self._output_stamp is not None:
+            logging.info("Nothing changed")
+            self.write_index()
+            return
+
+        self.write_output(published, rejoin)
+        self.write_index()
+        logging.info(f"Wrote {len(published)} battles to {self._output} ({changed} changed)")
+
+    def write_output(self, published: set[int], rejoin: set[int]) -> None:
+        '''
+        Write all.json, splicing freshly read records in between records copied from the previous output.
+        Records in rejoin are copied with their WHR fields joined afresh.
+        '''
+        old = None
+        old_file = None
+        if self._output_stamp is not None and self._output_stamp[1] > 0:
+            old_file = open(self._output, 'rb')
+            old = mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+        tmp = self._output + '.tmp'
+        try:
+            with open(tmp, 'wb') as out:
+                out.write(b'[')
+                pos = 1
+                first = True
+                for gameid in sorted(self._entries):
+                    entry = self._entries[gameid]
+                    if gameid not in published:
+                        entry.offset, entry.length = -1, 0
+                        continue
+                    if gameid in self._fresh:
+                        record = self._fresh[gameid].encode()
+                    elif gameid in rejoin:
+                        record = self.join(entry, json.loads(old[entry.offset:entry.offset + entry.length])).encode()
+                    else:
+                        record = old[entry.offset:entry.offset + entry.length]
+                    if not first:
+                        out.write(b',')
+                        pos += 1
+                    first = False
+                    out.write(record)
+                    entry.offset, entry.length = pos, len(record)
+                    pos += len(record)
+                out.write(b']')
+        finally:
+            if old is not None:
+                old.close()
+                old_file.close()
+        os.replace(tmp, self._output)
+        self._output_stamp = stamp(self._output)
+        self._fresh = {}
+
+    def write_index(self) -> None:
+        write_atomically(self._index_path, json.dumps({
+            'version': INDEX_VERSION,
+            'output': self._output_stamp,
+            'enrich': self._enricher.digest,
+            'exclude': self._exclude_stamp,
+            'whr': self._whr_stamp,
+            'shards': self._shard_stamps,
+            'battles': [self._entries[gameid].to_json() for gameid in sorted(self._entries)],
+        }))
+
+
+def export_store(db: str, output: str, index: str, exclude: str, enricher: Enricher, whr: str | None = None, full: bool = False) -> None:
+    '''
+    Write all.json from the summary database, unless nothing it depends on changed since the last export.
+    '''
+    with SummaryStore(db) as store:
+        state = {
+            'version': INDEX_VERSION,
+            'db': store.generation,
+            'enrich': enricher.digest,
+            'exclude': stamp(exclude),
+            'whr': whr_stamp(whr),
+        }
+        if not full:
+            try:
+                with open(index, 'r') as f:
+                    previous = json.load(f)
+                if previous == {**state, 'output': stamp(output)}:
+                    logging.info("Nothing changed")
+                    return
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        excluded = exclusions.load(exclude)
+        whr_data = whrjoin.WHRData.load(whr) if whr else None
+        written = 0
+        tmp = output + '.tmp'
+        with open(tmp, 'w') as out:
+            out.write('[')
+            for gameid, body in store.published():
+                if gameid in excluded:
+                    continue
+                if written:
+                    out.write(',')
+                record = enricher(json.loads(body))
+                out.write(json.dumps(whr_data.join(record) if whr_data else record))
+                written += 1
+            out.write(']')
+        os.replace(tmp, output)
+    write_atomically(index, json.dumps({**state, 'output': stamp(output)}))
+    logging.info(f"Wrote {written} battles to {output} from {db}")
+
+
+def main():
+    parser = ArgumentParser(description="Incrementally combine per-battle summaries into all.json")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--root', '-r', default='.', help='Base directory containing shards/ (default: .)')
+    parser.add_argument('--output', '-o', default='summaries/all.json', help='Output JSON file (default: summaries/all.json)')
+    parser.add_argument('--index', '-x', default='summaries/all.index.json', help='Index of battles in the output (default: summaries/all.index.json)')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    parser.add_argument('--config', '-c', default='public/data/config.json', help='Dashboard configuration (default: public/data/config.json)')
+    parser.add_argument('--map-types', '-t', default='public/data/map-types.json', help='Map name to map type mapping (default: public/data/map-types.json)')
+    parser.add_argument('--whr', '-w', default=None, help='Join WHR ratings from this getwhr.py output, and its -skipped and -missing siblings, eg: demos/fullwhr.json')
+    parser.add_argument('--db', '-d', default=None, help='Read summaries from this summary database instead of the shards, eg: summaries/summaries.db')
+    parser.add_argument('--full', action='store_true', help='Ignore the existing index and rebuild from scratch')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    enricher = Enricher.load(args.config, args.map_types)
+    if args.db:
+        export_store(args.db, args.output, args.index, args.exclude, enricher, whr=args.whr, full=args.full)
+        return
+    Aggregator(args.root, args.output, args.index, args.exclude, enricher, whr=args.whr).run(full=args.full)
+
+if __name__ == '__main__':
+    main()
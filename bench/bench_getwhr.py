@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark getwhr.py against a local mock ZKI API.
+
+Inputs:
+    getwhr.py
+    bench/mock_zki.py
+
+Outputs:
+    A table of requests made, wall time, retries and peak memory per run, on stdout
+    Optionally the same as JSON, with --json
+
+For each size, a fresh mock server is started and getwhr.py is run once, from
+an empty cache, over that many battle IDs, in a scratch directory. Server side
+counts come from the mock's /stats; retries are the attempts getwhr.py logged
+after a 429 or timeout; peak memory is getwhr.py's maximum resident set size.
+
+Example, with a fifth of a percent of IDs poisoned and ZKI's rate limit:
+    bench/bench_getwhr.py --sizes 10000 100000 --mock='--poison-rate 0.002 --max-rate 5'
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GETWHR = os.path.join(HERE, '..', 'getwhr.py')
+MOCK_ZKI = os.path.join(HERE, 'mock_zki.py')
+
+
+@dataclass(slots=True)
+class Run:
+    battles: int
+    returncode: int
+    wall_seconds: float
+    peak_rss_mib: float
+    requests: int
+    retries: int
+    throttled: int
+    poisoned: int
+    hung: int
+    rated: int
+    skipped: int
+    missing: int
+
+
+def start_mock(python: str, mock_args: list[str]) -> tuple[subprocess.Popen, str]:
+    proc = subprocess.Popen(
+        [python, MOCK_ZKI, '--port', '0', *mock_args],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    # The first line out is the URL it's serving on
+    url = proc.stdout.readline().strip()
+    if not url:
+        proc.kill()
+        raise RuntimeError("Mock ZKI server exited before it started serving")
+    return proc, url
+
+
+def mock_stats(url: str) -> dict[str, int]:
+    stats_url = url.split('/api/')[0] + '/stats'
+    with urllib.request.urlopen(stats_url) as response:
+        return json.load(response)
+
+
+def run_getwhr(python: str, workdir: str, url: str, getwhr_args: list[str]) -> tuple[int, float, float, int]:
+    '''
+    Run getwhr.py once. Returns its exit code, wall time, peak RSS in MiB, and how many retries it logged.
+    '''
+    log = os.path.join(workdir, 'getwhr.log')
+    cmd = [
+        python, GETWHR,
+        '--input', 'live.json',
+        '--output', 'fullwhr.json',
+        '--skipped-output', 'fullwhr-skipped.json',
+        '--missing-output', 'fullwhr-missing.json',
+        '--cache', 'cache.json',
+        '--api-url', url,
+        *getwhr_args,
+    ]
+    with open(log, 'w') as f:
+        started = time.monotonic()
+        proc = subprocess.Popen(cmd, cwd=workdir, stdout=f, stderr=subprocess.STDOUT)
+        # wait4 rather than wait, for the resource usage of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    with open(log) as f:
+        lines = f.readlines()
+    # RateLimitTransport logs each failed attempt as "... attempt N/M"; the first of each is the request itself
+    retries = sum(1 for line in lines if ' attempt ' in line)
+    if proc.returncode != 0:
+        logging.error(f"getwhr.py exited with {proc.returncode}, last output:\n{''.join(lines[-20:])}")
+    # ru_maxrss is in KiB on Linux
+    return proc.returncode, wall, rusage.ru_maxrss / 1024, retries
+
+
+def count_json(path: str) -> int:
+    try:
+        with open(path) as f:
+            return len(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return 0
+
+
+def bench(python: str, size: int, mock_args: list[str], getwhr_args: list[str]) -> Run:
+    with tempfile.TemporaryDirectory(prefix='bench-getwhr-') as workdir:
+        with open(os.path.join(workdir, 'live.json'), 'w') as f:
+            # Realistic IDs: six digit, ascending, with some gaps from battles that weren't 1v1s
+            json.dump([{'gameid': 700000 + i + i // 7} for i in range(size)], f)
+        mock, url = start_mock(python, mock_args)
+        try:
+            returncode, wall, rss, retries = run_getwhr(python, workdir, url, getwhr_args)
+            stats = mock_stats(url)
+        finally:
+            mock.terminate()
+            mock.wait()
+        return Run(
+            battles=size,
+            returncode=returncode,
+            wall_seconds=round(wall, 2),
+            peak_rss_mib=round(rss, 1),
+            requests=stats.get('requests', 0),
+            retries=retries,
+            throttled=stats.get('throttled', 0),
+            poisoned=stats.get('poisoned', 0),
+            hung=stats.get('hung', 0),
+            rated=count_json(os.path.join(workdir, 'fullwhr.json')),
+            skipped=count_json(os.path.join(workdir, 'fullwhr-skipped.json')),
+            missing=count_json(os.path.join(workdir, 'fullwhr-missing.json')),
+        )
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark getwhr.py against a local mock ZKI API")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='Numbers of battle IDs to run with (default: 10000 100000 1000000)')
+    parser.add_argument('--mock', default='', help='Extra arguments for mock_zki.py, as one string')
+    parser.add_argument('--getwhr', default='', help='Extra arguments for getwhr.py, as one string')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to run both with (default: this one)')
+    parser.add_argument('--json', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    runs = []
+    for size in args.sizes:
+        logging.info(f"Running getwhr.py over {size} battles")
+        runs.append(bench(args.python, size, shlex.split(args.mock), shlex.split(args.getwhr)))
+
+    fields = list(asdict(runs[0]))
+    widths = [max(len(name), *(len(str(getattr(run, name))) for run in runs)) for name in fields]
+    print('  '.join(name.rjust(width) for name, width in zip(fields, widths)))
+    for run in runs:
+        print('  '.join(str(getattr(run, name)).rjust(width) for name, width in zip(fields, widths)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'mock': args.mock, 'getwhr': args.getwhr, 'runs': [asdict(run) for run in runs]}, f, indent=2)
+    if any(run.returncode != 0 for run in runs):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for the ZKI WHR battles API, for exercising getwhr.py offline.
+
+Inputs:
+    POST /api/whr/battles, as described in getwhr.py
+
+Outputs:
+    Responses in the same shape as ZKI's, with faults injected as configured
+    GET /stats: JSON counters of what was served, for bench_getwhr.py
+
+Faults are decided per battle ID from a seeded hash, so a poisoned, omitted
+or null ID behaves the same way on every request, as it does on ZKI:
+    poisoned: Any request containing it fails with ZKI's KeyNotFoundException 500
+    omitted:  Silently left out of the response
+    null:     Returned with null ratings
+
+Throttling and timeouts are per request:
+    Requests beyond --max-rate per second get a 429, with a Retry-After of
+    whole seconds or an HTTP date, alternating if --retry-after both
+    A --timeout-rate fraction of requests hang for --hang seconds before
+    answering, long enough for getwhr.py's read timeout to fire
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from collections import Counter, deque
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import random
+import threading
+import time
+
+API_PATH = '/api/whr/battles'
+
+KEY_NOT_FOUND = {
+    'Message': 'An error has occurred.',
+    'ExceptionMessage': 'The given key was not present in the dictionary.',
+    'ExceptionType': 'System.Collections.Generic.KeyNotFoundException',
+}
+
+
+class Faults:
+    '''
+    Which battle IDs misbehave, and how. Stable for a given seed.
+    '''
+    def __init__(self, seed: int, poison_rate: float, omit_rate: float, null_rate: float, poisoned: set[int]) -> None:
+        self.seed = seed.to_bytes(8, 'little')
+        self.poison_rate = poison_rate
+        self.omit_rate = omit_rate
+        self.null_rate = null_rate
+        self.poisoned = poisoned
+
+    def _roll(self, battle_id: int, salt: bytes) -> float:
+        digest = blake2b(battle_id.to_bytes(8, 'little', signed=True) + salt, key=self.seed, digest_size=8).digest()
+        return int.from_bytes(digest, 'little') / 2 ** 64
+
+    def is_poisoned(self, battle_id: int) -> bool:
+        return battle_id in self.poisoned or self._roll(battle_id, b'poison') < self.poison_rate
+
+    def is_omitted(self, battle_id: int) -> bool:
+        return self._roll(battle_id, b'omit') < self.omit_rate
+
+    def is_null(self, battle_id: int) -> bool:
+        return self._roll(battle_id, b'null') < self.null_rate
+
+    def players(self, battle_id: int) -> list[dict]:
+        if self.is_null(battle_id):
+            return [{'rating': None, 'stdev': None, 'accountId': 2 * battle_id + i} for i in range(2)]
+        rng = random.Random(battle_id)
+        return [{'rating': rng.uniform(800, 2500), 'stdev': rng.uniform(50, 300), 'accountId': 2 * battle_id + i} for i in range(2)]
+
+
+class Throttle:
+    '''
+    Sliding window request limit, as ZKI's DosProtect applies.
+    '''
+    def __init__(self, max_rate: float) -> None:
+        self.max_rate = max_rate
+        self._times: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def admit(self) -> bool:
+        if not self.max_rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self._times and now - self._times[0] >= 1:
+                self._times.popleft()
+            if len(self._times) >= self.max_rate:
+                return False
+            self._times.append(now)
+            return True
+
+
+class MockZKI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], args) -> None:
+        super().__init__(address, Handler)
+        self.args = args
+        self.faults = Faults(args.seed, args.poison_rate, args.omit_rate, args.null_rate, set(args.poison))
+        self.throttle = Throttle(args.max_rate)
+        self.rng = random.Random(args.seed)
+        self.stats: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, **counts: int) -> None:
+        with self.lock:
+            self.stats.update(counts)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: MockZKI
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(format % args)
+
+    def _send_json(self, status: int, body, headers: dict[str, str] | None = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path != '/stats':
+            self._send_json(404, {'Message': 'Not found'})
+            return
+        with self.server.lock:
+            self._send_json(200, dict(self.server.stats))
+
+    def do_POST(self) -> None:
+        server, args = self.server, self.server.args
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != API_PATH:
+            self._send_json(404, {'Message': 'Not found'})
+            return
+        battle_ids: list[int] = json.loads(body)['battleids']
+        server.count(requests=1, requested_ids=len(battle_ids))
+
+        if not server.throttle.admit():
+            server.count(throttled=1)
+            use_date = args.retry_after == 'date' or (args.retry_after == 'both' and server.stats['throttled'] % 2 == 0)
+            if use_date:
+                # HTTP dates only have whole second resolution, so round up
+                retry_after = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=2), usegmt=True)
+            else:
+                retry_after = '1'
+            self._send_json(429, {'Message': 'Too many requests'}, {'Retry-After': retry_after})
+            return
+        with server.lock:
+            hang = server.rng.random() < args.timeout_rate
+        if hang:
+            server.count(hung=1)
+            time.sleep(args.hang)
+        else:
+            time.sleep(args.latency + args.latency_per_id * len(battle_ids))
+
+        if any(server.faults.is_poisoned(battle_id) for battle_id in battle_ids):
+            server.count(poisoned=1)
+            self._send_json(500, KEY_NOT_FOUND)
+            return
+        battles = []
+        for battle_id in battle_ids:
+            if server.faults.is_omitted(battle_id):
+                server.count(omitted_ids=1)
+                continue
+            if server.faults.is_null(battle_id):
+                server.count(null_ids=1)
+            battles.append({'players': server.faults.players(battle_id), 'id': battle_id})
+        server.count(ok=1, served_ids=len(battles))
+        try:
+            self._send_json(200, battles)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on a hung request
+            server.count(abandoned=1)
+
+
+def make_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Local stand-in for the ZKI WHR battles API")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', '-p', type=int, default=8765, help='Port to listen on, 0 for any free port (default: 8765)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for which IDs misbehave and for timeouts (default: 0)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response (default: 0.05)')
+    parser.add_argument('--latency-per-id', type=float, default=0.0002, help='Seconds added to a response per battle ID requested (default: 0.0002)')
+    parser.add_argument('--poison-rate', type=float, default=0.0, help='Fraction of battle IDs which fail requests with KeyNotFoundException (default: 0)')
+    parser.add_argument('--poison', type=int, nargs='*', default=[], help='Specific battle IDs which fail requests with KeyNotFoundException')
+    parser.add_argument('--omit-rate', type=float, default=0.0, help='Fraction of battle IDs silently left out of responses (default: 0)')
+    parser.add_argument('--null-rate', type=float, default=0.0, help='Fraction of battle IDs returned with null ratings (default: 0)')
+    parser.add_argument('--max-rate', type=float, default=0, help='Requests per second before responding 429, 0 for no limit (default: 0)')
+    parser.add_argument('--retry-after', choices=['seconds', 'date', 'both'], default='both', help='Retry-After format on 429s (default: both, alternating)')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='Fraction of requests which hang (default: 0)')
+    parser.add_argument('--hang', type=float, default=20, help='Seconds a hanging request hangs for (default: 20, past getwhr.py\'s read timeout)')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    server = MockZKI((args.host, args.port), args)
+    host, port = server.server_address[:2]
+    # bench_getwhr.py reads the URL from this line to find a port chosen with --port 0
+    print(f"http://{host}:{port}{API_PATH}", flush=True)
+    logging.info(f"Serving mock WHR API on http://{host}:{port}{API_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
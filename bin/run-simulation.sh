@@ -2,6 +2,11 @@
 
 set -euo pipefail
 
+# Several simulations may fail at once, so append under a lock. See: exclusions.py
+exclude() {
+    python3 ../../exclusions.py --exclude ../../demos/exclude.txt add "$1" "$2"
+}
+
 early_exit_watcher() {
     local id="$1"
     local sim_pgid="$2"
@@ -9,12 +14,23 @@ early_exit_watcher() {
     local seen_replay_stats_lua=""
     # Watch for conditions which the replay analysis widget cannot
     while read -r line; do
+        # In summary only mode, has the widget recorded everything postprocess.py needs?
+        # It quits by itself; only make sure the simulation doesn't outstay that.
+        # Example line:
+        # [t=00:03:12.501234][f=0021004] <Replay Stats> [21004] Summary events complete
+        if [[ "$line" =~ \<Replay\ Stats\>\ \[[0-9]+\]\ Summary\ events\ complete$ ]]; then
+            echo "Watchdog: Summary events complete."
+            sleep 15
+            echo "Watchdog: 15 seconds past summary completion without exit. Killing simulation." >&2
+            kill -- -"$sim_pgid" 2>/dev/null ||:
+            break
+        fi
         # Have we reached the end of the replay, without reaching a normal exit?
         if [[ "$line" =~ End\ of\ demo\ reached$ ]]; then
             echo "Watchdog: Replay EOF detected."
             sleep 15
             echo "Watchdog: 15 seconds past end of replay without normal exit. Killing simulation." >&2
-            printf "%d (Automatic) Non-terminating replay detected. Added %s\n" "$id" "$(date --iso-8601)" >> ../../demos/exclude.txt
+            exclude "$id" "Non-terminating replay detected"
             kill -- -"$sim_pgid" 2>/dev/null ||:
             break
         fi
@@ -30,7 +46,7 @@ early_exit_watcher() {
         # [t=00:00:37.065796][f=0000000] Playback continued
         if [[ -z "$seen_replay_stats_lua" ]] && [[ "$line" =~ ^\[t=[0-9:\.]+\]\[f=[^-] ]]; then
             echo "Watchdog: Replay simulation started without loading replay_stats.lua. Killing simulation." >&2
-            printf "%d (Automatic) Could not load replay_stats.lua. Added %s\n" "$id" "$(date --iso-8601)" >> ../../demos/exclude.txt
+            exclude "$id" "Could not load replay_stats.lua"
             kill -- -"$sim_pgid" 2>/dev/null ||:
             break
         fi
@@ -59,6 +75,15 @@ main() {
     local replay="$2"
     local zkdir="$3"
     local timeout="$4"
+    # Optional: stop once the widget has the summary's events, or at this frame if sooner (0 for no limit),
+    # rather than simulating on to the end. Winner and duration then come from the battle's metadata.
+    local summary_frames="${5:-}"
+
+    # Don't spend hours simulating replays whose header says they'll be skipped anyway. See: sdfz.py
+    if ! python3 ../../sdfz.py --exclude ../../demos/exclude.txt triage --replay "$replay" "$id"; then
+        echo "Replay $id excluded by triage, not simulating." >&2
+        exit 1
+    fi
 
     mkdir -p "../../stats/$((id / 10000))/$id/"
     mkdir -p "$zkdir/LuaUI/Logs/replay_stats/$id/"
@@ -66,6 +91,9 @@ main() {
     trap "rm -rf '${work_dir}'" EXIT
 
     cat "$zkdir/springsettings.cfg" <(echo ZKHeadlessReplay=$id) > "${work_dir}/springsettings.$id.cfg"
+    if [[ -n "$summary_frames" ]]; then
+        printf 'ZKHeadlessReplaySummaryOnly=1\nZKHeadlessReplaySummaryFrames=%d\n' "$summary_frames" >> "${work_dir}/springsettings.$id.cfg"
+    fi
 
     # Clear any previous output, so the early exit watcher doesn't trigger a false positive
     rm -f "stats/$id/spring.log"
@@ -83,9 +111,14 @@ main() {
     wait "$sim_pgid"; local sim_retcode=$?
     set -e
 
+    # However a summary only run ended, once the widget had everything, it was a success
+    if [[ -n "$summary_frames" ]] && grep -qE '<Replay Stats> \[[0-9]+\] Summary events complete$' "stats/$id/spring.log"; then
+        sim_retcode=0
+    fi
+
     # If the replay timed out, skip it
     if [[ "$sim_retcode" -eq 124 ]]; then
-        printf "%d (Automatic) Timeout reached, replay skipped. Added %s\n" "$id" "$(date --iso-8601)" >> ../../demos/exclude.txt
+        exclude "$id" "Timeout reached, replay skipped"
     fi
 
     kill "$watcher_pid" 2>/dev/null ||:
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+'''
+Precompute a dense matchup count cube for the factory vs factory views.
+
+Inputs:
+    summaries/all.json (enriched, see enrich.py)
+    public/data/config.json
+
+Outputs:
+    summaries/matchups.cube.json
+    summaries/matchups.cube.bin.gz
+
+The cube counts matches along these axes, in this order:
+    winner_fac: Winner's first factory
+    loser_fac:  Loser's first factory
+    map_type:   From map-types.json
+    elo_lead:   Winner's elo lead, bucketed and clamped at both ends
+    month:      Month the match started in, YYYY-MM
+
+cube[w, l, ...] is the number of times w beat l, so the losses for that
+cell are cube[l, w, ...]. Mirror matches are the w == l diagonal, so they
+don't need an axis of their own.
+
+The header (.json) describes the axes; the body (.bin.gz) is the gzipped
+C-ordered little-endian count array. public/js/util/cube.js loads and slices
+it in a browser, but isn't loaded by the dashboard, whose charts all filter
+one crossfilter of the matches.
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import gzip
+import json
+import logging
+import os
+
+import numpy as np
+
+CUBE_VERSION = 1
+
+
+def axis_labels(values: np.ndarray, preferred: list[str]) -> list[str]:
+    '''
+    Labels for a categorical axis: the preferred order first, then anything else seen, sorted.
+    '''
+    seen = set(values.tolist())
+    return [v for v in preferred if v in seen] + sorted(seen - set(preferred))
+
+
+def build(records: list[dict], config: dict, elo_bucket: int, elo_max: int) -> tuple[list[dict], np.ndarray]:
+    facorder = [f for f in config['orders']['facorder'] if f != 'Any']
+    map_type_order = list(config['colors']['map-type'])
+
+    winner_fac = np.array([r['winner_fac'] for r in records])
+    loser_fac = np.array([r['loser_fac'] for r in records])
+    map_type = np.array([r.get('map_type', 'Unknown') for r in records])
+    elo_lead = np.array([r['winner_elo_lead'] for r in records], dtype=np.int64)
+    month = np.array([(r['started'] or '0000-00')[:7] for r in records])
+
+    fac_labels = axis_labels(np.concatenate([winner_fac, loser_fac]), facorder)
+    map_type_labels = axis_labels(map_type, map_type_order)
+    month_labels = sorted(set(month.tolist()))
+    buckets = elo_max // elo_bucket
+    # Bucket i covers [i * elo_bucket, (i + 1) * elo_bucket), with the outermost buckets open ended
+    elo_labels = list(range(-buckets * elo_bucket, (buckets + 1) * elo_bucket, elo_bucket))
+
+    dims = [
+        {'name': 'winner_fac', 'labels': fac_labels},
+        {'name': 'loser_fac', 'labels': fac_labels},
+        {'name': 'map_type', 'labels': map_type_labels},
+        {'name': 'elo_lead', 'labels': elo_labels, 'bucket': elo_bucket},
+        {'name': 'month', 'labels': month_labels},
+    ]
+
+    def codes(values: np.ndarray, labels: list[str]) -> np.ndarray:
+        # labels are unique, so searchsorted on the sorted labels maps each value to its label's position
+        order = np.argsort(labels)
+        return order[np.searchsorted(np.array(labels)[order], values)]
+
+    indices = (
+        codes(winner_fac, fac_labels),
+        codes(loser_fac, fac_labels),
+        codes(map_type, map_type_labels),
+        np.clip(np.floor_divide(elo_lead, elo_bucket), -buckets, buckets) + buckets,
+        codes(month, month_labels),
+    )
+    shape = tuple(len(dim['labels']) for dim in dims)
+    flat = np.ravel_multi_index(indices, shape)
+    counts = np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape)
+    return dims, counts
+
+
+def main():
+    parser = ArgumentParser(description="Precompute a dense matchup count cube")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--input', '-i', default='summaries/all.json', help='Input JSON file with enriched battle summaries (default: summaries/all.json)')
+    parser.add_argument('--config', '-c', default='public/data/config.json', help='Dashboard configuration, for axis orders (default: public/data/config.json)')
+    parser.add_argument('--output', '-o', default='summaries/matchups.cube', help='Output prefix; writes PREFIX.json and PREFIX.bin.gz (default: summaries/matchups.cube)')
+    parser.add_argument('--elo-bucket', type=int, default=100, help='Width of elo lead buckets (default: 100)')
+    parser.add_argument('--elo-max', type=int, default=1000, help='Elo leads beyond this are clamped into the outermost bucket (default: 1000)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    with open(args.input, 'r') as f:
+        records = [record for record in json.load(f) if not record.get('skip', False)]
+
+    dims, counts = build(records, config, args.elo_bucket, args.elo_max)
+    dtype = np.dtype('<u2') if counts.max(initial=0) < 2 ** 16 else np.dtype('<u4')
+
+    body = args.output + '.bin.gz'
+    with open(body + '.tmp', 'wb') as f:
+        f.write(gzip.compress(counts.astype(dtype).tobytes(order='C')))
+    header = {
+        'version': CUBE_VERSION,
+        'dims': dims,
+        'shape': list(counts.shape),
+        'dtype': dtype.name,
+        'total': int(counts.sum()),
+        'body': os.path.basename(body),
+    }
+    with open(args.output + '.json.tmp', 'w') as f:
+        json.dump(header, f)
+    # Body first, so the header never describes a body that isn't there yet
+    os.replace(body + '.tmp', body)
+    os.replace(args.output + '.json.tmp', args.output + '.json')
+    logging.info(f"Wrote {header['total']} battles into a {'x'.join(map(str, counts.shape))} {dtype.name} cube ({os.path.getsize(body)} bytes compressed)")
+
+if __name__ == '__main__':
+    main()
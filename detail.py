@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+'''
+Extract what we need from a battle's detail.html once, into a compact record.
+
+Inputs, relative to a shard directory:
+    demos/<id>/detail.html
+
+Outputs, relative to a shard directory:
+    demos/<id>/detail.json
+    demos/<id>/events.log.deps
+
+detail.json holds the map name and ID, start time, engine and game versions,
+replay file name, player name to userid mapping and winner, so nothing
+downstream needs to scrape the HTML again:
+    {"version": 2, "gameid": 1606223, "map": "Fairyland 1.31", "map_id": 7514,
+     "started": "2023-01-02 03:04:05", "engine": "105.1.1-1485-g78f9a2c",
+     "game": "Zero-K v1.11.4.0", "replay": "20230102_030405_Fairyland 1.31_105.1.1-1485-g78f9a2c.sdfz",
+     "players": {"Alice": "12345", "Bob": "67890"}, "winner": "Alice"}
+
+Records carry the version of the parser that wrote them. load() parses the
+HTML in memory instead of using a record that is older than its
+detail.html, or from another version, so readers never need write access to
+demos/. After changing the parser, bump DETAIL_VERSION and rebuild every
+record with the rebuild command.
+
+fetch.py writes the record and events.log.deps as soon as it has the page.
+Otherwise Makefile.shard builds them with the record command.
+
+Usage:
+    detail.py record SHARD_DIR ID...          Write detail.json and events.log.deps for battles
+    detail.py deps SHARD_DIR ID               Print events.log.deps for a battle
+    detail.py rebuild [--force] SHARD_DIR...  Rewrite outdated detail.json and events.log.deps
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import re
+import sys
+
+# Bump when parse() changes what it extracts, then run: detail.py rebuild shards/*
+DETAIL_VERSION = 2
+ZKDIR = '/var/lib/zkreplay/Zero-K'
+
+MAP_LINK = re.compile(r'<a href="/Maps/Detail/(?P<id>[0-9]+)"')
+MAP_NAME = re.compile(r'Map: (?P<name>[^<]+)')
+# From 105.1.1-2314-g9e0bf7d, a new way of recording the timestamp in the replay filename was used.
+# Before: YYYYMMDD_HHMMSS_
+# After: YYYY-mm-dd_HH-MM-SS-mmm_
+TIMESTAMP = re.compile(r"a href='/replays/(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})_(?P<hours>[0-9]{2})-(?P<minutes>[0-9]{2})-(?P<seconds>[0-9]{2})-[0-9]{3}_")
+TIMESTAMP_PRE_2314 = re.compile(r"a href='/replays/(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})_(?P<hours>[0-9]{2})(?P<minutes>[0-9]{2})(?P<seconds>[0-9]{2})_")
+REPLAY_LINK = re.compile(r"<a href='/replays/(?P<name>.*\.sdfz)'>Manual download</a>")
+USERID = re.compile(r"href='/Users/Detail/(?P<userid>[0-9]+)'[^>]+>(?P<username>[^<]+)</a>")
+# The version itself is on the third line after its label. See: getspringversion and getzkversion in Makefile.shard
+ENGINE_VERSION = re.compile(r' *([-a-zA-Z0-9_.]+)')
+GAME_VERSION = re.compile(r' *([-a-zA-Z0-9_. ]+)')
+# ZKI gives each team's box a battle_winner or battle_loser class. The first player listed in the winning box is the winner.
+WINNER_MARK = re.compile(r'''class=["'][^"']*\bbattle_winner\b''')
+LOSER_MARK = re.compile(r'''class=["'][^"']*\bbattle_loser\b''')
+
+
+@dataclass(slots=True)
+class BattleDetail:
+    gameid: int
+    map: str | None = None
+    map_id: int | None = None
+    started: str | None = None
+    engine: str | None = None
+    game: str | None = None
+    replay: str | None = None
+    players: dict[str, str] = field(default_factory=dict)
+    winner: str | None = None
+    version: int = DETAIL_VERSION
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), separators=(',', ':')) + '\n'
+
+    @classmethod
+    def from_json(cls, text: str) -> BattleDetail:
+        return cls(**json.loads(text))
+
+    def deps(self, zkdir: str = ZKDIR) -> str:
+        '''
+        The makefile fragment ordering this battle's replay after the map, engine and game it needs.
+        '''
+        replay = f'demos/{self.gameid}/replay.sdfz'
+        map_id = '' if self.map_id is None else self.map_id
+        game = (self.game or '').replace(' ', '\\ ')
+        return (
+            f'{replay}: | maps/{map_id}.html\n'
+            f'{replay}: | {zkdir}/engine/linux64/{self.engine or ""}/spring-headless\n'
+            f'{replay}: | games/{game}\n'
+        )
+
+
+def parse(gameid: int, html: str) -> BattleDetail:
+    '''
+    Everything we use from a battle's detail page.
+    '''
+    detail = BattleDetail(gameid)
+    lines = html.splitlines()
+    winner_next = False
+    for i, line in enumerate(lines):
+        if m := MAP_LINK.search(line):
+            if detail.map_id is None:
+                detail.map_id = int(m.group('id'))
+            # The name follows the link on the next line
+            if i + 1 < len(lines) and (name := MAP_NAME.search(lines[i + 1])):
+                detail.map = name.group('name')
+        elif 'Engine version:' in line and detail.engine is None and i + 3 < len(lines):
+            if m := ENGINE_VERSION.fullmatch(lines[i + 3].replace('\r', '')):
+                detail.engine = m.group(1)
+        elif 'Game version:' in line and detail.game is None and i + 3 < len(lines):
+            if m := GAME_VERSION.fullmatch(lines[i + 3].replace('\r', '')):
+                detail.game = m.group(1)
+        if m := TIMESTAMP.search(line) or TIMESTAMP_PRE_2314.search(line):
+            detail.started = '%s-%s-%s %s:%s:%s' % (m.group('year'), m.group('month'), m.group('day'), m.group('hours'), m.group('minutes'), m.group('seconds'))
+        if detail.replay is None and (m := REPLAY_LINK.search(line)):
+            detail.replay = m.group('name')
+        if WINNER_MARK.search(line):
+            winner_next = True
+        elif LOSER_MARK.search(line):
+            winner_next = False
+        if m := USERID.search(line):
+            detail.players[m.group('username')] = m.group('userid')
+            if winner_next and detail.winner is None:
+                detail.winner = m.group('username')
+                winner_next = False
+    return detail
+
+
+def detail_paths(shard_dir: str, gameid: int) -> tuple[str, str]:
+    demo_dir = os.path.join(shard_dir, 'demos', str(gameid))
+    return os.path.join(demo_dir, 'detail.html'), os.path.join(demo_dir, 'detail.json')
+
+
+def read_html(html_path: str) -> str:
+    with open(html_path, 'r', errors='replace') as f:
+        return f.read()
+
+
+def load(shard_dir: str, gameid: int) -> BattleDetail:
+    '''
+    A battle's detail record, parsing detail.html in memory if the record is missing, outdated or from another version.
+    '''
+    html_path, json_path = detail_paths(shard_dir, gameid)
+    try:
+        if os.stat(json_path).st_mtime_ns >= os.stat(html_path).st_mtime_ns:
+            with open(json_path, 'r') as f:
+                detail = BattleDetail.from_json(f.read())
+            if detail.version == DETAIL_VERSION:
+                return detail
+    except (FileNotFoundError, TypeError, ValueError):
+        pass
+    return parse(gameid, read_html(html_path))
+
+
+def write_atomic(path: str, text: str) -> None:
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def record(shard_dir: str, gameid: int, zkdir: str = ZKDIR) -> BattleDetail:
+    '''
+    Parse detail.html, and write detail.json and events.log.deps.
+    '''
+    html_path, json_path = detail_paths(shard_dir, gameid)
+    detail = parse(gameid, read_html(html_path))
+    write_atomic(json_path, detail.to_json())
+    write_atomic(os.path.join(os.path.dirname(json_path), 'events.log.deps'), detail.deps(zkdir))
+    return detail
+
+
+def rebuild(shard_dir: str, zkdir: str, force: bool = False) -> tuple[int, int]:
+    '''
+    Rewrite every detail.json in a shard that is missing, outdated or from another version. Returns (rebuilt, failed).
+    '''
+    rebuilt = failed = 0
+    with os.scandir(os.path.join(shard_dir, 'demos')) as it:
+        gameids = sorted(int(entry.name) for entry in it if entry.name.isdigit())
+    for gameid in gameids:
+        html_path, json_path = detail_paths(shard_dir, gameid)
+        if not os.path.exists(html_path):
+            continue
+        if not force:
+            try:
+                if os.stat(json_path).st_mtime_ns >= os.stat(html_path).st_mtime_ns:
+                    with open(json_path, 'r') as f:
+                        if json.load(f).get('version') == DETAIL_VERSION:
+                            continue
+            except (FileNotFoundError, ValueError):
+                pass
+        try:
+            record(shard_dir, gameid, zkdir)
+            rebuilt += 1
+        except OSError as e:
+            logging.warning(f"Failed to rebuild detail record for battle {gameid}: {e}")
+            failed += 1
+    return rebuilt, failed
+
+
+def main():
+    parser = ArgumentParser(description="Extract battle metadata from detail.html into detail.json")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--zkdir', default=ZKDIR, help=f'Zero-K installation, as referred to by events.log.deps (default: {ZKDIR})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='Write detail.json and events.log.deps for battles')
+    record_parser.add_argument('shard', help='Shard directory, eg: shards/160')
+    record_parser.add_argument('ids', type=int, nargs='+', help='Battle IDs')
+    deps_parser = subparsers.add_parser('deps', help="Print a battle's events.log.deps")
+    deps_parser.add_argument('shard', help='Shard directory, eg: shards/160')
+    deps_parser.add_argument('id', type=int, help='Battle ID')
+    rebuild_parser = subparsers.add_parser('rebuild', help='Rewrite outdated detail.json and events.log.deps')
+    rebuild_parser.add_argument('shards', nargs='+', help='Shard directories, eg: shards/160')
+    rebuild_parser.add_argument('--force', '-f', action='store_true', help='Rewrite every record, even those up to date')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    match args.command:
+        case 'record':
+            for gameid in args.ids:
+                record(args.shard, gameid, args.zkdir)
+        case 'deps':
+            sys.stdout.write(load(args.shard, args.id).deps(args.zkdir))
+        case 'rebuild':
+            failed = 0
+            for shard_dir in args.shards:
+                rebuilt, shard_failed = rebuild(shard_dir, args.zkdir, args.force)
+                failed += shard_failed
+                logging.info(f"Shard {shard_dir}: rebuilt {rebuilt} detail records, {shard_failed} failed")
+            sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+'''
+Precompute the fields the dashboard derives from each summary.
+
+Inputs:
+    public/data/config.json
+    public/data/map-types.json
+    summaries (via aggregate.py, or a JSON file given on the command line)
+
+Outputs:
+    The same summaries, with these fields added:
+        winner_fac_prog, loser_fac_prog: Deduplicated, terminated with "Never", and truncated to fac_progression_max
+        winner_fac1..N, loser_fac1..N: Each step of the above, or "Never"
+        mirror_match: Whether both players' first factory was the same
+        map_type: From map-types.json, or "Unknown"
+
+These used to be computed by dataCoerce in public/js/dvis.js on every
+page load. dvis.js skips any record which already has them.
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import hashlib
+import json
+import logging
+import os
+
+# Bump when the derived fields change, so aggregate.py knows to recompute them for every battle
+ENRICH_VERSION = 1
+
+DEFAULT_FAC_PROGRESSION_MAX = 5
+
+
+class Enricher:
+    def __init__(self, config: dict, map_types: dict[str, str]) -> None:
+        self.fac_progression_max: int = config.get('fac_progression_max', DEFAULT_FAC_PROGRESSION_MAX)
+        self.map_types = map_types
+        # Only hash what affects the output, so eg changing a chart colour doesn't recompute everything
+        self.digest = hashlib.sha256(json.dumps(
+            [ENRICH_VERSION, self.fac_progression_max, map_types], sort_keys=True
+        ).encode()).hexdigest()
+
+    @staticmethod
+    def load(config_path: str, map_types_path: str) -> Enricher:
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        with open(map_types_path, 'r') as f:
+            map_types = json.load(f)
+        return Enricher(config, map_types)
+
+    def fac_progression(self, prog: list[str]) -> list[str]:
+        # Strip duplicates
+        ret = list(dict.fromkeys(prog))
+        # Add terminal node if one is not already present
+        if not ret or ret[-1] != 'Never':
+            ret.append('Never')
+        return ret[:self.fac_progression_max]
+
+    def __call__(self, summary: dict) -> dict:
+        # Which postprocess.py extractors built the summary is of no use to the dashboard
+        summary.pop('extractors', None)
+        # Track mirror match states for use as its own dimension.
+        summary['mirror_match'] = summary['winner_fac'] == summary['loser_fac']
+        summary['map_type'] = self.map_types.get(summary['map'], 'Unknown')
+        # Coerce the data in our hierarchical progressions
+        for player in ('winner', 'loser'):
+            prog = summary[player + '_fac_prog'] = self.fac_progression(summary[player + '_fac_prog'])
+            for depth in range(self.fac_progression_max):
+                summary[player + '_fac' + str(depth + 1)] = prog[depth] if depth < len(prog) else 'Never'
+        return summary
+
+
+def main():
+    parser = ArgumentParser(description="Precompute dashboard fields for a JSON file of summaries")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--config', '-c', default='public/data/config.json', help='Dashboard configuration (default: public/data/config.json)')
+    parser.add_argument('--map-types', '-t', default='public/data/map-types.json', help='Map name to map type mapping (default: public/data/map-types.json)')
+    parser.add_argument('input', help='Input JSON file with battle summaries')
+    parser.add_argument('output', help='Output JSON file')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    enricher = Enricher.load(args.config, args.map_types)
+    with open(args.input, 'r') as f:
+        summaries = [enricher(summary) for summary in json.load(f) if not summary.get('skip', False)]
+    tmp = args.output + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(summaries, f)
+    os.replace(tmp, args.output)
+    logging.info(f"Enriched {len(summaries)} battles")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+'''
+Read and append to the list of battles which shouldn't be processed.
+
+Inputs:
+    demos/exclude.txt
+
+Outputs:
+    demos/exclude.txt (add)
+    stdout (battles, stats)
+
+exclude.txt stays the source of truth, and stays hand editable. Each line
+is a battle ID, then a free form comment. Lines added by the pipeline look
+like:
+    1606223 (Automatic) Timeout reached, replay skipped. Added 2023-01-02
+
+Every stage reads it through load(), which parses it once into a bitset
+keyed by battle ID, for constant time membership tests, alongside a sorted
+array of IDs and a parallel array of reason codes (see: Reason).
+
+Every stage appends to it through add(), which takes an exclusive flock on
+the file, skips battles already listed, and writes the whole line with one
+write() to a file opened for appending. Many simulations failing at once
+therefore can't interleave their lines or list a battle twice. Shell
+recipes use the add command rather than printf >>.
+
+Usage:
+    exclusions.py add ID REASON       Exclude a battle, unless it already is
+    exclusions.py battles SHARD_DIR   Print a shard's battles which aren't excluded
+    exclusions.py stats               Count excluded battles by reason
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from datetime import date
+from enum import IntEnum
+import fcntl
+import logging
+import os
+
+DEFAULT_PATH = 'demos/exclude.txt'
+
+
+class Reason(IntEnum):
+    # Anything a person wrote by hand
+    MANUAL = 0
+    NO_REPLAY_LINK = 1
+    NON_TERMINATING = 2
+    NO_WIDGET = 3
+    TIMEOUT = 4
+    # Any other reason the pipeline gave
+    AUTOMATIC = 5
+    # Found certain to be skipped from its replay's header, without simulating it. See: sdfz.py
+    TRIAGED = 6
+
+
+AUTOMATIC_PREFIX = '(Automatic) '
+# The messages the pipeline writes, and the reason they're recorded as
+REASON_MESSAGES = {
+    'Could not find demofile link, replay skipped': Reason.NO_REPLAY_LINK,
+    'Non-terminating replay detected': Reason.NON_TERMINATING,
+    'Could not load replay_stats.lua': Reason.NO_WIDGET,
+    'Timeout reached, replay skipped': Reason.TIMEOUT,
+    'Unreadable replay, replay skipped': Reason.TRIAGED,
+    'Replay of an unfinished game, replay skipped': Reason.TRIAGED,
+    'No winner in replay, replay skipped': Reason.TRIAGED,
+    'AI in replay, replay skipped': Reason.TRIAGED,
+    'Replay is not a 1v1, replay skipped': Reason.TRIAGED,
+}
+
+
+def classify(comment: str) -> Reason:
+    if not comment.startswith(AUTOMATIC_PREFIX):
+        return Reason.MANUAL
+    message = comment[len(AUTOMATIC_PREFIX):].split('. Added ', 1)[0].rstrip('.')
+    return REASON_MESSAGES.get(message, Reason.AUTOMATIC)
+
+
+class Exclusions:
+    '''
+    Excluded battle IDs, with a reason code each. Membership is a bit test.
+    '''
+    __slots__ = ('_ids', '_reasons', '_bits')
+
+    def __init__(self, entries: Iterable[tuple[int, Reason]] = ()) -> None:
+        # The first reason given for a battle is the one that counts
+        first: dict[int, Reason] = {}
+        for battle_id, reason in entries:
+            first.setdefault(battle_id, reason)
+        ids = sorted(first)
+        self._ids = array('I', ids)
+        self._reasons = bytes(first[battle_id] for battle_id in ids)
+        self._bits = bytearray((ids[-1] >> 3) + 1 if ids else 0)
+        for battle_id in ids:
+            self._bits[battle_id >> 3] |= 1 << (battle_id & 7)
+
+    def __contains__(self, battle_id: object) -> bool:
+        if not isinstance(battle_id, int) or battle_id < 0:
+            return False
+        byte = battle_id >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (battle_id & 7)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def reason(self, battle_id: int) -> Reason | None:
+        if battle_id not in self:
+            return None
+        return Reason(self._reasons[bisect_left(self._ids, battle_id)])
+
+    def without(self, battle_ids: Iterable[int]) -> list[int]:
+        '''
+        The given battle IDs which aren't excluded, in their original order.
+        '''
+        return [battle_id for battle_id in battle_ids if battle_id not in self]
+
+
+def parse(lines: Iterable[str]) -> Iterator[tuple[int, Reason]]:
+    for line in lines:
+        field, _, comment = line.strip().partition(' ')
+        if field.isdigit():
+            yield int(field), classify(comment)
+
+
+def load(path: str = DEFAULT_PATH) -> Exclusions:
+    '''
+    Every battle listed in exclude.txt. Only the first part of each line is an ID. A missing file excludes nothing.
+    '''
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return Exclusions(parse(f))
+    except FileNotFoundError:
+        return Exclusions()
+
+
+def add(path: str, battle_id: int, reason: str) -> bool:
+    '''
+    Exclude a battle, unless it already is. Returns whether it was added.
+    reason is a sentence without a full stop, eg "Timeout reached, replay skipped".
+    '''
+    line = '%d %s%s. Added %s\n' % (battle_id, AUTOMATIC_PREFIX, reason, date.today().isoformat())
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with open(fd, 'r', errors='replace', closefd=False) as f:
+            f.seek(0)
+            text = f.read()
+        if any(listed == battle_id for listed, _ in parse(text.splitlines())):
+            return False
+        # Hand edits don't always end in a newline
+        if text and not text.endswith('\n'):
+            line = '\n' + line
+        os.write(fd, line.encode())
+        return True
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+
+
+def shard_battle_ids(shard_dir: str) -> set[int]:
+    '''
+    Battle IDs in a shard's index.mk, plus those that already have a demos directory.
+    '''
+    ids = set()
+    try:
+        with open(os.path.join(shard_dir, 'demos', 'index.mk'), 'r') as f:
+            for line in f:
+                if line.startswith('BATTLEIDS:='):
+                    ids.update(int(field) for field in line[len('BATTLEIDS:='):].split())
+    except FileNotFoundError:
+        pass
+    with os.scandir(os.path.join(shard_dir, 'demos')) as it:
+        ids.update(int(entry.name) for entry in it if entry.name.isdigit() and entry.is_dir())
+    return ids
+
+
+def main():
+    parser = ArgumentParser(description="Read and append to the list of battles which shouldn't be processed")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--exclude', '-e', default=DEFAULT_PATH, help=f'Exclusion list (default: {DEFAULT_PATH})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Exclude a battle, unless it already is')
+    add_parser.add_argument('id', type=int, help='Battle ID')
+    add_parser.add_argument('reason', help='Why, as a sentence without a full stop, eg: "Timeout reached, replay skipped"')
+    battles_parser = subparsers.add_parser('battles', help="Print a shard's battles which aren't excluded")
+    battles_parser.add_argument('shard', help='Shard directory, eg: shards/160')
+    subparsers.add_parser('stats', help='Count excluded battles by reason')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    match args.command:
+        case 'add':
+            if add(args.exclude, args.id, args.reason):
+                logging.info(f"Excluded battle {args.id}: {args.reason}")
+            else:
+                logging.info(f"Battle {args.id} was already excluded")
+        case 'battles':
+            excluded = load(args.exclude)
+            print(' '.join(map(str, sorted(excluded.without(shard_battle_ids(args.shard))))))
+        case 'stats':
+            excluded = load(args.exclude)
+            counts = Counter(excluded.reason(battle_id) for battle_id in excluded)
+            for reason in Reason:
+                print(f'{reason.name.lower()}\t{counts[reason]}')
+            print(f'total\t{len(excluded)}')
+
+if __name__ == '__main__':
+    main()
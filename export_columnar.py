@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+'''
+Export the summaries in a compact, dictionary encoded columnar format for the dashboard.
+
+Inputs:
+    summaries/all.json
+
+Outputs:
+    summaries/all.columnar.json
+
+Format:
+{
+    "format": "zkstats-columnar",
+    "version": 1,
+    "length": <number of records>,
+    "tables": { "fac": ["Cloakbot Factory", ...], "map": [...], "version": [...] },
+    "columns": [
+        { "name": "gameid", "type": "delta", "data": [730190, 5, 6, ...] },
+        { "name": "map", "type": "str", "table": "map", "data": [0, 1, 0, ...] },
+        { "name": "winner_fac_prog", "type": "strlist", "table": "fac", "data": [[0], [0, 3], ...] },
+        { "name": "started", "type": "datetime", "data": [1559788481, ...] },
+        ...
+    ],
+    "derived": ["winner_elo_lead", ...]
+}
+
+Column types:
+    int:      Integers, or null.
+    delta:    Integers, each stored as the difference from the previous one.
+    str:      Indices into the named string table, or null.
+    strlist:  Lists of indices into the named string table.
+    datetime: "YYYY-MM-DD HH:MM:SS" timestamps as seconds since the epoch, or null.
+    raw:      Anything else, stored as is.
+
+Fields listed in "derived" are omitted, and recomputed by the loader.
+See: public/js/util/columnar.js
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import re
+
+FORMAT = 'zkstats-columnar'
+FORMAT_VERSION = 1
+
+# Which string table each string column is encoded against.
+# Columns sharing a table share their vocabulary, eg factories appear in both first factory and progression columns.
+STRING_TABLES = {
+    'winner_fac': 'fac',
+    'loser_fac': 'fac',
+    'winner_fac_prog': 'fac',
+    'loser_fac_prog': 'fac',
+    **{player + '_fac' + str(depth): 'fac' for player in ('winner', 'loser') for depth in range(1, 10)},
+    'map': 'map',
+    'zk_version': 'version',
+    'spring_version': 'version',
+}
+
+DATETIME_COLUMNS = {'started'}
+DELTA_COLUMNS = {'gameid'}
+
+STARTED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fields the loader can recompute from other columns. These are only dropped if every record agrees.
+DERIVED = {
+    'winner_elo_lead': lambda r: r['winner_elo'] - r['loser_elo'],
+    'winner_fac': lambda r: r['winner_fac_prog'][0] if r['winner_fac_prog'] else 'Never',
+    'loser_fac': lambda r: r['loser_fac_prog'][0] if r['loser_fac_prog'] else 'Never',
+    'mirror_match': lambda r: r['winner_fac'] == r['loser_fac'],
+}
+# Per step factory progression fields added by enrich.py, eg winner_fac3
+FAC_STEP = re.compile(r'^(?P<player>winner|loser)_fac(?P<depth>[1-9][0-9]*)$')
+
+
+def deriver(name: str):
+    if name in DERIVED:
+        return DERIVED[name]
+    m = FAC_STEP.match(name)
+    if m:
+        prog, depth = m.group('player') + '_fac_prog', int(m.group('depth')) - 1
+        return lambda r: r[prog][depth] if depth < len(r[prog]) else 'Never'
+    return None
+
+
+class StringTable:
+    def __init__(self) -> None:
+        self.values: list[str] = []
+        self._index: dict[str, int] = {}
+
+    def __call__(self, value: str | None) -> int | None:
+        if value is None:
+            return None
+        i = self._index.get(value)
+        if i is None:
+            i = self._index[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def to_epoch(value: str | None) -> int | None:
+    # Timestamps carry no timezone. Store them as if UTC, and have the loader format them back the same way.
+    if value is None:
+        return None
+    return int(datetime.strptime(value, STARTED_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+
+def is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def encode(records: list[dict]) -> dict:
+    names: list[str] = []
+    for record in records:
+        for name in record:
+            if name not in names:
+                names.append(name)
+
+    derived = []
+    for name in names:
+        derive = deriver(name)
+        try:
+            if derive is not None and all(name in r and r[name] == derive(r) for r in records):
+                derived.append(name)
+        except KeyError:
+            # Something the derivation depends on isn't present everywhere
+            pass
+
+    tables: dict[str, StringTable] = {}
+    columns = []
+    for name in names:
+        if name in derived:
+            continue
+        values = [record.get(name) for record in records]
+        present = [v for v in values if v is not None]
+        if name in DATETIME_COLUMNS and all(isinstance(v, str) for v in present):
+            try:
+                columns.append({'name': name, 'type': 'datetime', 'data': [to_epoch(v) for v in values]})
+                continue
+            except ValueError:
+                pass
+        if all(is_int(v) for v in present):
+            if name in DELTA_COLUMNS and len(present) == len(values):
+                deltas = [b - a for a, b in zip([0] + values, values)]
+                columns.append({'name': name, 'type': 'delta', 'data': deltas})
+            else:
+                columns.append({'name': name, 'type': 'int', 'data': values})
+            continue
+        if all(isinstance(v, str) for v in present):
+            table = tables.setdefault(STRING_TABLES.get(name, name), StringTable())
+            columns.append({'name': name, 'type': 'str', 'table': STRING_TABLES.get(name, name), 'data': [table(v) for v in values]})
+            continue
+        if len(present) == len(values) and all(isinstance(v, list) and all(isinstance(s, str) for s in v) for v in values):
+            table = tables.setdefault(STRING_TABLES.get(name, name), StringTable())
+            columns.append({'name': name, 'type': 'strlist', 'table': STRING_TABLES.get(name, name), 'data': [[table(s) for s in v] for v in values]})
+            continue
+        columns.append({'name': name, 'type': 'raw', 'data': values})
+
+    return {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'length': len(records),
+        'tables': {name: table.values for name, table in tables.items()},
+        'columns': columns,
+        'derived': derived,
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Export summaries in a compact columnar format for the dashboard")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--input', '-i', default='summaries/all.json', help='Input JSON file with battle summaries (default: summaries/all.json)')
+    parser.add_argument('--output', '-o', default='summaries/all.columnar.json', help='Output columnar JSON file (default: summaries/all.columnar.json)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    with open(args.input, 'r') as f:
+        records = [record for record in json.load(f) if not record.get('skip', False)]
+
+    encoded = encode(records)
+
+    tmp = args.output + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(encoded, f, separators=(',', ':'))
+    os.replace(tmp, args.output)
+    logging.info(f"Exported {len(records)} battles in {len(encoded['columns'])} columns to {args.output} ({os.path.getsize(args.input)} -> {os.path.getsize(args.output)} bytes)")
+
+if __name__ == '__main__':
+    main()
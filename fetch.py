@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+'''
+Fetch battle details, replays, maps, engines and games for shards, concurrently
+within one global rate budget.
+
+Inputs, relative to a shard directory:
+    demos/index.mk
+    ../../demos/exclude.txt
+    https://zero-k.info/Battles/Detail/<id>
+    https://zero-k.info/replays/<replay>.sdfz
+    https://zero-k.info/Maps/Detail/<mapid>, and the map file it links to
+    https://zero-k.info/engine/linux64/<version>.zip
+    pr-downloader --download-game <version>
+
+Outputs, relative to a shard directory:
+    demos/<id>/detail.html
+    demos/<id>/detail.json and events.log.deps (see: detail.py)
+    demos/<id>/<replay>.sdfz, and demos/<id>/replay.sdfz linking to it
+    maps/<mapid>.html, or maps/FAILED.<mapid>.html
+    games/<version>, linking to $ZKDIR/packages/<hash>.sdp
+    $ZKDIR/maps/<map file>
+    $ZKDIR/engine/linux64/<version>/
+    fetch-stamp, if anything was fetched
+    ../../demos/exclude.txt (battles without a replay link)
+
+The in-process equivalent of the shard makefile's fetch target. Rather than
+a curl and a sleep per file, every request goes through one HTTP/2 client,
+whose connections are kept alive, and whose RateLimitTransport (see:
+getwhr.py) holds all of them to --rate requests a second between them, so
+up to --jobs battles are in flight at once. Each map, engine and game is
+only fetched once, however many battles in the run need it.
+
+Large files are downloaded to a .part file beside their destination, and
+only renamed into place once complete. If a run is interrupted, the next
+one resumes the .part file with a Range request. Engines are unpacked
+beside their destination directory and renamed into place.
+
+Anything that fails here is left for the shard makefile, which the top
+level Makefile still runs afterwards, to retry.
+
+Usage:
+    fetch.py [--jobs N] [--rate N] SHARD_DIR... [--ids ID...]
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+from collections.abc import Awaitable, Callable
+from contextlib import suppress
+from email.utils import parsedate_to_datetime
+import gzip
+import httpx
+import logging
+import os
+import re
+import shutil
+import sys
+from urllib.parse import quote
+import zipfile
+
+import detail
+import exclusions
+from getwhr import MaxRetryError, RateLimitTransport
+
+BASE_URL = 'https://zero-k.info'
+ZKDIR = '/var/lib/zkreplay/Zero-K'
+# Workaround for 104.0.1-1477-g8ecf38a's pr-downloader failing to --download-game. See: Makefile.shard
+PR_DOWNLOADER = f'{ZKDIR}/engine/linux64/104.0.1-1435-g79d77ca/pr-downloader'
+
+CHUNK_SIZE = 1 << 16
+
+# Prefer a zero-k.info download link, then the first of the manual downloads. See: Makefile.shard
+MAP_LINK = re.compile(r"<a href='(https://zero-k\.info/content/maps/[^']+\.sd[7z])'")
+MANUAL_MAP_LINK = re.compile(r"<a href='([^']+)'")
+ENGINE_EXECUTABLES = ('spring', 'spring-headless', 'spring-dedicated')
+
+
+def pending_battles(shard_dir: str, excluded: exclusions.Exclusions) -> list[int]:
+    '''
+    Battles in a shard that are missing either their detail.html or their replay.
+    '''
+    pending = []
+    for battle_id in sorted(excluded.without(exclusions.shard_battle_ids(shard_dir))):
+        demo_dir = os.path.join(shard_dir, 'demos', str(battle_id))
+        if not os.path.lexists(os.path.join(demo_dir, 'replay.sdfz')) or not os.path.exists(os.path.join(demo_dir, 'detail.html')):
+            pending.append(battle_id)
+    return pending
+
+
+def map_url(html: str) -> str | None:
+    '''
+    Where to download a map from, given its ZKI map detail page.
+    '''
+    if m := MAP_LINK.search(html):
+        return m.group(1)
+    lines = html.splitlines()
+    for i, line in enumerate(lines):
+        if 'Manual downloads:' in line and i + 1 < len(lines):
+            if m := MANUAL_MAP_LINK.search(lines[i + 1].replace('\r', '')):
+                return m.group(1)
+    return None
+
+
+def quote_basename(url: str) -> str:
+    '''
+    ZKI's links aren't always valid URLs. Encode only the final component, as curl won't tidy it up for us.
+    '''
+    directory, _, name = url.rpartition('/')
+    return f'{directory}/{quote(name, safe="")}'
+
+
+def write_atomic(path: str, content: bytes) -> None:
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def symlink_atomic(target: str, path: str) -> None:
+    with suppress(FileNotFoundError):
+        os.unlink(path + '.tmp')
+    os.symlink(target, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class Fetcher:
+    '''
+    Fetches battles through a shared client, and each map, engine and game they depend on at most once.
+    '''
+    def __init__(self, client: httpx.AsyncClient, root: str, zkdir: str, exclude: str, pr_downloader: str) -> None:
+        self._client = client
+        self._root = root
+        self._zkdir = zkdir
+        self._exclude = exclude
+        self._pr_downloader = pr_downloader
+        # (kind, name) -> the one task fetching it, so every battle needing it awaits the same download
+        self._once: dict[tuple[str, str], asyncio.Task] = {}
+        # pr-downloader keeps its own state in ZKDIR, so only one may run at a time
+        self._pr_downloader_lock = asyncio.Lock()
+        self.fetched = 0
+        self.failed = 0
+        self.excluded = 0
+        self.downloaded_bytes = 0
+        self.resumed = 0
+
+    def once(self, kind: str, name: str, fetch: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        key = (kind, name)
+        if key not in self._once:
+            self._once[key] = asyncio.ensure_future(fetch())
+        return self._once[key]
+
+    async def get(self, url: str) -> bytes:
+        response = await self._client.get(url)
+        response.raise_for_status()
+        self.downloaded_bytes += len(response.content)
+        return response.content
+
+    async def download(self, url: str, path: str) -> None:
+        '''
+        Download url to path by way of path.part, resuming it if a previous attempt was interrupted.
+        The modification time is taken from Last-Modified, as with curl -R.
+        '''
+        part = path + '.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        async with self._client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 416:
+                # The partial file doesn't fit whatever is there now. Start again.
+                os.unlink(part)
+                return await self.download(url, path)
+            response.raise_for_status()
+            resumed = response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f'bytes {offset}-')
+            if offset and resumed:
+                self.resumed += 1
+                logging.debug(f"Resuming {url} from {offset} bytes")
+            with open(part, 'ab' if resumed else 'wb') as f:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    f.write(chunk)
+                    self.downloaded_bytes += len(chunk)
+            last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            try:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(part, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+        os.replace(part, path)
+
+    async def fetch_map(self, map_id: str) -> None:
+        maps_dir = os.path.join(self._root, 'maps')
+        html_path = os.path.join(maps_dir, f'{map_id}.html')
+        if os.path.exists(html_path):
+            return
+        os.makedirs(maps_dir, exist_ok=True)
+        logging.info(f"Fetching map {map_id}")
+        html = await self.get(f'{BASE_URL}/Maps/Detail/{map_id}')
+        try:
+            url = map_url(html.decode(errors='replace'))
+            if url is None:
+                raise ValueError(f"No download link found for map {map_id}")
+            logging.debug(f"Using scraped URL: {url}")
+            # Saved under the name as scraped, not as encoded
+            path = os.path.join(self._zkdir, 'maps', os.path.basename(url))
+            if not os.path.exists(path):
+                await self.download(quote_basename(url), path)
+        except Exception:
+            logging.warning(f"FAILED getting map ID {map_id}")
+            write_atomic(os.path.join(maps_dir, f'FAILED.{map_id}.html'), html)
+            raise
+        # The detail page going in last marks the map as present
+        write_atomic(html_path, html)
+
+    async def fetch_engine(self, version: str) -> None:
+        engines_dir = os.path.join(self._zkdir, 'engine', 'linux64')
+        engine_dir = os.path.join(engines_dir, version)
+        if os.access(os.path.join(engine_dir, 'spring-headless'), os.X_OK):
+            return
+        logging.info(f"Fetching spring engine version {version}")
+        archive = os.path.join(engines_dir, f'.{version}.zip')
+        await self.download(f'{BASE_URL}/engine/linux64/{version}.zip', archive)
+        staging = os.path.join(engines_dir, f'.{version}.tmp')
+        await asyncio.to_thread(self._unpack_engine, archive, staging)
+        # A directory left by an interrupted unzip can't be renamed over
+        if os.path.isdir(engine_dir):
+            shutil.rmtree(engine_dir)
+        os.replace(staging, engine_dir)
+        os.unlink(archive)
+
+    @staticmethod
+    def _unpack_engine(archive: str, staging: str) -> None:
+        shutil.rmtree(staging, ignore_errors=True)
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                path = z.extract(info, staging)
+                # Keep the archive's permissions as unzip would, but never world writable
+                mode = (info.external_attr >> 16) & 0o777
+                if not info.is_dir() and mode:
+                    os.chmod(path, mode & ~0o002 | 0o440)
+        for name in ENGINE_EXECUTABLES:
+            path = os.path.join(staging, name)
+            if os.path.exists(path):
+                os.chmod(path, os.stat(path).st_mode | 0o110)
+
+    async def run_pr_downloader(self, *args: str) -> None:
+        async with self._pr_downloader_lock:
+            process = await asyncio.create_subprocess_exec(self._pr_downloader, *args, '--filesystem-writepath', self._zkdir)
+            if await process.wait():
+                raise RuntimeError(f"pr-downloader {' '.join(args)} exited with {process.returncode}")
+
+    async def fetch_versions(self) -> None:
+        if not os.path.exists(os.path.join(self._zkdir, 'rapid', 'repos.springrts.com', 'zk', 'versions.gz')):
+            await self.run_pr_downloader()
+
+    async def fetch_game(self, version: str) -> None:
+        games_dir = os.path.join(self._root, 'games')
+        link = os.path.join(games_dir, version)
+        if os.path.exists(link):
+            return
+        await self.once('versions', '', self.fetch_versions)
+        with gzip.open(os.path.join(self._zkdir, 'rapid', 'repos.springrts.com', 'zk', 'versions.gz'), 'rt') as f:
+            hashes = [line.split(',')[1] for line in f if version in line and line.startswith('zk:git:')]
+        if not hashes:
+            raise ValueError(f"{version} is not in the rapid index")
+        logging.info(f"Downloading {version} hash {hashes[0]}")
+        await self.run_pr_downloader('--download-game', version)
+        package = os.path.abspath(os.path.join(self._zkdir, 'packages', f'{hashes[0]}.sdp'))
+        if not os.path.exists(package):
+            raise FileNotFoundError(package)
+        os.makedirs(games_dir, exist_ok=True)
+        symlink_atomic(package, link)
+
+    async def fetch_battle(self, shard_dir: str, battle_id: int) -> bool:
+        '''
+        Fetch a battle's detail.html, everything its replay depends on, and then its replay.
+        Returns whether anything was fetched.
+        '''
+        demo_dir = os.path.join(shard_dir, 'demos', str(battle_id))
+        detail_path = os.path.join(demo_dir, 'detail.html')
+        fetched = False
+        if not os.path.exists(detail_path) or not os.path.getsize(detail_path):
+            os.makedirs(demo_dir, exist_ok=True)
+            write_atomic(detail_path, await self.get(f'{BASE_URL}/Battles/Detail/{battle_id}'))
+            fetched = True
+        # Parse the page once, for everything downstream
+        record = detail.record(shard_dir, battle_id, self._zkdir) if fetched else detail.load(shard_dir, battle_id)
+        replay_path = os.path.join(demo_dir, 'replay.sdfz')
+        if os.path.lexists(replay_path):
+            return fetched
+
+        if record.replay is None:
+            logging.warning(f"Could not find demofile link in {detail_path}, assuming no link. Skipping!")
+            exclusions.add(self._exclude, battle_id, 'Could not find demofile link, replay skipped')
+            self.excluded += 1
+            return fetched
+
+        # As in the shard makefile, the replay is only fetched once everything it depends on is present
+        dependencies = []
+        if (map_id := record.map_id) is not None:
+            dependencies.append(self.once('map', str(map_id), lambda: self.fetch_map(str(map_id))))
+        if engine := record.engine:
+            dependencies.append(self.once('engine', engine, lambda: self.fetch_engine(engine)))
+        if game := record.game:
+            dependencies.append(self.once('game', game, lambda: self.fetch_game(game)))
+        await asyncio.gather(*dependencies)
+
+        # Saved under its encoded name, as curl -O would
+        name = quote(record.replay, safe='')
+        await self.download(f'{BASE_URL}/replays/{name}', os.path.join(demo_dir, name))
+        symlink_atomic(name, replay_path)
+        return True
+
+    async def run(self, work: list[tuple[str, int]], jobs: int) -> None:
+        queue: asyncio.Queue[tuple[str, int]] = asyncio.Queue()
+        for item in work:
+            queue.put_nowait(item)
+        stamped = set()
+
+        async def worker() -> None:
+            while not queue.empty():
+                shard_dir, battle_id = queue.get_nowait()
+                try:
+                    fetched = await self.fetch_battle(shard_dir, battle_id)
+                except (httpx.HTTPError, MaxRetryError, OSError, RuntimeError, ValueError, zipfile.BadZipFile) as e:
+                    logging.warning(f"Failed to fetch battle {battle_id}: {type(e).__name__}: {e}")
+                    self.failed += 1
+                    continue
+                if fetched:
+                    self.fetched += 1
+                    # Tell the top level Makefile that there's something new to process
+                    if shard_dir not in stamped:
+                        stamped.add(shard_dir)
+                        with open(os.path.join(shard_dir, 'fetch-stamp'), 'a'):
+                            os.utime(os.path.join(shard_dir, 'fetch-stamp'))
+
+        await asyncio.gather(*(worker() for _ in range(jobs)))
+
+
+async def amain() -> int:
+    global BASE_URL
+    parser = ArgumentParser(description="Fetch battle details, replays, maps, engines and games for shards within one rate budget")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('shards', nargs='+', help='Shard directories to fetch, eg: shards/160')
+    parser.add_argument('--ids', type=int, nargs='+', default=None, help='Only fetch these battle IDs (default: all pending)')
+    parser.add_argument('--jobs', '-j', type=int, default=16, help='Most battles to fetch at once (default: 16)')
+    parser.add_argument('--rate', type=float, default=5, help='Most requests per second, across all battles (default: 5)')
+    parser.add_argument('--zkdir', default=ZKDIR, help=f'Zero-K installation (default: {ZKDIR})')
+    parser.add_argument('--pr-downloader', default=PR_DOWNLOADER, help=f'pr-downloader to fetch games with (default: {PR_DOWNLOADER})')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    parser.add_argument('--base-url', default=BASE_URL, help=f'Where to fetch from, eg a local mock (default: {BASE_URL})')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    # Quieten httpx's per-request logging unless asked for
+    logging.getLogger('httpx').setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    BASE_URL = args.base_url.rstrip('/')
+
+    excluded = exclusions.load(args.exclude)
+    work = []
+    for shard_dir in args.shards:
+        if args.ids:
+            work.extend((shard_dir, i) for i in args.ids if i // 10000 == int(os.path.basename(os.path.normpath(shard_dir))) and i not in excluded)
+        else:
+            work.extend((shard_dir, i) for i in pending_battles(shard_dir, excluded))
+    if not work:
+        logging.info("Nothing to fetch")
+        return 0
+    logging.info(f"Fetching {len(work)} battles, {args.jobs} at once, at up to {args.rate:g} requests/s")
+
+    # Every shard shares the parent's maps and games. See: bin/scrape.sh
+    root = os.path.normpath(os.path.join(args.shards[0], '..', '..'))
+    # httpx ignores the client's http2 and limits once it's given a transport, so they're set on the pool itself
+    pool = httpx.AsyncHTTPTransport(http2=True, limits=httpx.Limits(max_connections=args.jobs, max_keepalive_connections=args.jobs), retries=0)
+    # Downloads can be large, so only the wait for the first byte is bounded tightly
+    async with httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=httpx.Timeout(10, read=60, pool=60),
+        transport=RateLimitTransport(max_calls=max(1, round(args.rate)), period=max(1, round(args.rate)) / args.rate, retries=4, transport=pool),
+    ) as client:
+        fetcher = Fetcher(client, root, args.zkdir, args.exclude, args.pr_downloader)
+        await fetcher.run(work, args.jobs)
+    logging.info(f"Fetched {fetcher.fetched} battles ({fetcher.downloaded_bytes / 2**20:.1f}MiB, {fetcher.resumed} downloads resumed), {fetcher.excluded} excluded, {fetcher.failed} failed")
+    return 1 if fetcher.failed else 0
+
+
+def main():
+    sys.exit(asyncio.run(amain()))
+
+if __name__ == '__main__':
+    main()
@@ -5,32 +5,45 @@ Get up to date WHR values for all processed matches.
 
 Inputs:
     public/data/live.json
+    demos/whr/cache.json
     API calls to https://zero-k.info/api/whr/battles
 
 Outputs:
     demos/fullwhr.json
     demos/fullwhr-skipped.json
     demos/fullwhr-missing.json
+    demos/whr/cache.json
+    <metrics>/zkreplay_whr.prom and .json, with --metrics (see: metrics.py)
+
+Only battles not yet in the cache, plus a limited slice of stale cache
+entries, are requested on each run. Everything else is served from the
+cache.
 '''
 
 from __future__ import annotations
 
 from argparse import ArgumentParser
 import asyncio
+from bisect import bisect_left, insort
 from collections import deque
 from contextlib import suppress
+from contextvars import ContextVar
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from email.utils import parsedate_to_datetime
-from functools import singledispatchmethod
+from functools import singledispatchmethod, wraps
 from itertools import batched, count
 import json
 import httpx
 import logging
+import os
+import sys
 from pydantic import BaseModel, Field, ConfigDict
-from time import monotonic
+from time import monotonic, time
 from typing import cast, overload
 
+from metrics import COUNTS, SECONDS, Metrics
+
 '''
 API:
 
@@ -94,6 +107,14 @@ class RateLimiter:
         self._timestamps: deque[float] = deque()
         self._lock = asyncio.Lock()
 
+    def set_rate(self, rate: float) -> None:
+        """
+        Change the allowed rate, in calls per second. Takes effect from the next acquire.
+        """
+        # Keep whole numbers of calls in the window, stretching the window for fractional or sub-1 rates
+        self._max_calls = max(1, int(rate))
+        self._period = self._max_calls / rate
+
     async def acquire(self) -> None:
         while True:
             async with self._lock:
@@ -107,6 +128,119 @@ class RateLimiter:
             await asyncio.sleep(sleep_for)
 
 
+class ConcurrencyLimiter:
+    """
+    Semaphore whose limit can be changed while in use.
+    Lowering the limit doesn't interrupt anything in flight, it just stops new entries until enough have left.
+    """
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def set_limit(self, limit: int) -> None:
+        async with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    async def __aenter__(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+
+    async def __aexit__(self, *_) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+@dataclass(slots=True, frozen=True)
+class Backoff:
+    at: datetime
+    reason: str
+    rate: float
+    concurrency: int
+    batch_size: int
+
+
+class AdaptiveController:
+    """
+    Additive-increase/multiplicative-decrease control of request rate, in-flight concurrency, and batch size.
+
+    Every response that comes back promptly nudges all three up a little. Slow responses shrink the batch size,
+    since large batches are what make ZKI slow to respond. Timeouts and 429s cut all three, at most once per
+    cooldown, so a burst of failures from one congestion event only backs off once.
+    """
+    def __init__(
+        self,
+        *,
+        rate: float = 5,
+        max_rate: float = 8,
+        min_rate: float = 0.5,
+        concurrency: int = 5,
+        max_concurrency: int = 20,
+        batch_size: int = 250,
+        max_batch_size: int = 500,
+        min_batch_size: int = 10,
+        latency_target: float = 5,
+        decrease: float = 0.5,
+        cooldown: float = 2,
+    ) -> None:
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limiter = RateLimiter(1, 1)
+        self.limiter.set_rate(rate)
+        self.in_flight = ConcurrencyLimiter(concurrency)
+        self.backoffs: list[Backoff] = []
+        self._last_backoff = float('-inf')
+        # Fractional concurrency, so additive increases can accumulate across responses
+        self._concurrency = float(concurrency)
+
+    async def _apply(self) -> None:
+        self.limiter.set_rate(self.rate)
+        await self.in_flight.set_limit(self.concurrency)
+
+    async def on_success(self, latency: float, batch_size: int | None = None) -> None:
+        if latency > self.latency_target:
+            # The server is struggling with requests of this size. Don't push the rate, and ask for less per request.
+            if batch_size is not None and batch_size >= self.batch_size:
+                self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.75))
+            return
+        # Additive increase, spread across a full window's worth of responses
+        self.rate = min(self.max_rate, self.rate + 1 / max(self.rate, 1))
+        self._concurrency = min(self.max_concurrency, self._concurrency + 1 / max(self._concurrency, 1))
+        self.concurrency = int(self._concurrency)
+        if batch_size is not None and batch_size >= self.batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 10)
+        await self._apply()
+
+    async def on_failure(self, reason: str, retry_after: float | None = None) -> None:
+        now = monotonic()
+        if now - self._last_backoff < self.cooldown:
+            return
+        self._last_backoff = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        if retry_after:
+            # Spread what we would have sent over the period we were asked to wait
+            self.rate = max(self.min_rate, min(self.rate, 1 / retry_after))
+        self._concurrency = max(1.0, self._concurrency * self.decrease)
+        self.concurrency = int(self._concurrency)
+        self.batch_size = max(self.min_batch_size, int(self.batch_size * self.decrease))
+        backoff = Backoff(datetime.now(), reason, self.rate, self.concurrency, self.batch_size)
+        self.backoffs.append(backoff)
+        logging.warning(f"Backing off after {reason}: rate={self.rate:.2f}/s concurrency={self.concurrency} batch_size={self.batch_size}")
+        await self._apply()
+
+
 class MaxRetryError(Exception):
     pass
 
@@ -119,33 +253,68 @@ class RateLimitTransport(httpx.AsyncBaseTransport):
     def __init__(
         self,
         *,
-        max_calls: int,
-        period: float,
+        max_calls: int = 5,
+        period: float = 1,
         retries: int = 0,
         transport: httpx.AsyncBaseTransport | None = None,
+        controller: AdaptiveController | None = None,
+        metrics: Metrics | None = None,
     ) -> None:
         # Disable internal retrying, we must be aware of the rate we're actually sending requests
         self._transport = transport or httpx.AsyncHTTPTransport(retries=0)
-        self._limiter = RateLimiter(max_calls, period)
+        # If adaptive, the controller owns the limiter, and adjusts it as responses come back
+        self._controller = controller
+        self._limiter = controller.limiter if controller else RateLimiter(max_calls, period)
         self._retries = retries
+        self._metrics = metrics
 
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self._controller is None:
+            return await self._handle_async_request(request)
+        async with self._controller.in_flight:
+            return await self._handle_async_request(request)
+
+    async def _handle_async_request(self, request: httpx.Request) -> httpx.Response:
         backoff_base = 0.5
+        batch_size = request.extensions.get('batch_size')
+        if self._metrics:
+            if batch_size is not None:
+                self._metrics.observe('request_battles', batch_size)
+            self._metrics.observe('split_depth', request.extensions.get('split_depth', 0))
         for attempt in count(1):
+            if self._metrics and attempt > 1:
+                self._metrics.inc('retries_total')
+            waited = monotonic()
             await self._limiter.acquire()
             delay = 0
             try:
+                started = monotonic()
+                if self._metrics:
+                    self._metrics.observe('rate_limit_wait_seconds', started - waited)
                 response = await self._transport.handle_async_request(request)
+                if self._metrics:
+                    self._metrics.observe('request_duration_seconds', monotonic() - started)
+                    self._metrics.inc('requests_total', outcome=str(response.status_code))
                 match response.status_code:
                     case 429:
                         if 'Retry-After' in response.headers:
                             delay = self._parse_retry_after(response, raise_=True)
                         logging.info(f'HTTP Request: {request.url} "429 Too Many Requests" attempt {attempt}/{self._retries}')
+                        if self._controller:
+                            await self._controller.on_failure('429 Too Many Requests', self._delay_seconds(delay) if delay else None)
                     case _:
+                        if self._controller:
+                            await self._controller.on_success(monotonic() - started, batch_size)
                         return response
             except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.PoolTimeout) as e:
                 logging.info(f"{type(e).__name__} {request.url} attempt {attempt}/{self._retries}")
+                if self._metrics:
+                    self._metrics.inc('requests_total', outcome=type(e).__name__)
+                if self._controller:
+                    await self._controller.on_failure(type(e).__name__)
             if attempt >= self._retries:
+                if self._metrics:
+                    self._metrics.inc('gave_up_total')
                 raise MaxRetryError(f"Maximum retry attempts reached for {request.url}")
             if not delay:
                 delay = timedelta(seconds=backoff_base * (2 ** (attempt - 1)))
@@ -172,13 +341,19 @@ class RateLimitTransport(httpx.AsyncBaseTransport):
             until: When the next request should be delayed until.
                    Can be an absolute datetime or a timedelta relative to now.
         """
-        delay = (until - datetime.now()).total_seconds()
+        delay = (until - datetime.now(until.tzinfo)).total_seconds()
         await asyncio.sleep(delay)
 
     @_sleep_register
     async def _(self, delay: timedelta) -> None:
         await asyncio.sleep(delay.total_seconds())
 
+    @staticmethod
+    def _delay_seconds(delay: datetime | timedelta) -> float:
+        if isinstance(delay, timedelta):
+            return delay.total_seconds()
+        return (delay - datetime.now(delay.tzinfo)).total_seconds()
+
     @staticmethod
     def _parse_retry_after(
         response: httpx.Response, raise_: bool = False
@@ -216,6 +391,24 @@ class RateLimitTransport(httpx.AsyncBaseTransport):
         await self._transport.aclose()
 
 MAX_BATCH_SIZE = 250
+# Suspect battle IDs are requested in batches this small, so a bad one costs little to isolate
+PROBE_BATCH_SIZE = 8
+
+# How many times the batch being requested has been split off from the one it came from, for metrics
+split_depth: ContextVar[int] = ContextVar('split_depth', default=0)
+
+def splits(f):
+    '''
+    Requests made from within f, and anything it gathers, are one split deeper.
+    '''
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        token = split_depth.set(split_depth.get() + 1)
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            split_depth.reset(token)
+    return wrapper
 
 @dataclass(slots=True, frozen=True)
 class WHRAggregateResult:
@@ -237,9 +430,56 @@ class WHRAggregateResult:
     def empty() -> WHRAggregateResult:
         return WHRAggregateResult([], [], [])
 
-async def get_latest_ratings(battle_ids: list[int], client: httpx.AsyncClient, max_batch_size: int = MAX_BATCH_SIZE) -> WHRAggregateResult:
+class Quarantine:
+    """
+    Battle IDs known to poison requests, and the IDs near them, which are suspect.
+
+    Battles ZKI fails to look up tend to come in runs of nearby IDs, so a known bad ID
+    is evidence against its neighbours too.
+    """
+    def __init__(self, known_bad: set[int], radius: int = 2) -> None:
+        self.radius = radius
+        self._bad = sorted(known_bad)
+        self.poisoned_requests = 0
+
+    def __contains__(self, battle_id: int) -> bool:
+        i = bisect_left(self._bad, battle_id)
+        return i < len(self._bad) and self._bad[i] == battle_id
+
+    def add(self, battle_id: int) -> None:
+        if battle_id not in self:
+            insort(self._bad, battle_id)
+
+    def is_suspect(self, battle_id: int) -> bool:
+        i = bisect_left(self._bad, battle_id - self.radius)
+        return i < len(self._bad) and self._bad[i] <= battle_id + self.radius
+
+    def partition(self, battle_ids: list[int]) -> tuple[list[int], list[int], list[int]]:
+        """
+        Split into known bad, suspect, and clean IDs.
+        """
+        bad, suspect, clean = [], [], []
+        for battle_id in battle_ids:
+            if battle_id in self:
+                bad.append(battle_id)
+            elif self.is_suspect(battle_id):
+                suspect.append(battle_id)
+            else:
+                clean.append(battle_id)
+        return bad, suspect, clean
+
+
+async def get_latest_ratings(
+    battle_ids: list[int],
+    client: httpx.AsyncClient,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    controller: AdaptiveController | None = None,
+    quarantine: Quarantine | None = None,
+) -> WHRAggregateResult:
     '''
     Request WHR values for the given list of player IDs.
+    If a controller is given, batches are sized by it, up to max_batch_size.
+    If a quarantine is given, it is consulted and updated when isolating battle IDs that make ZKI fail.
 
     Returns:
         - A mapping of player ID to WHR value
@@ -248,24 +488,39 @@ async def get_latest_ratings(battle_ids: list[int], client: httpx.AsyncClient, m
     '''
     if len(battle_ids) == 0:
         return WHRAggregateResult.empty()
+    if controller is not None and len(battle_ids) > min(max_batch_size, controller.batch_size):
+        return await get_adaptive_batches(battle_ids, client, max_batch_size, controller, quarantine)
     if len(battle_ids) > max_batch_size:
         # Ensure we don't make extremely large requests which time out
         batch_data = await asyncio.gather(*[
-            get_latest_ratings(list(batch), client)
+            get_latest_ratings(list(batch), client, controller=controller, quarantine=quarantine)
             for batch in batched(battle_ids, max_batch_size)
         ])
         return sum(batch_data, WHRAggregateResult.empty())
 
-    request_body = WHRBattlesRequest(battleids=battle_ids)
     try:
-        response = await client.post(
-            API_URL,
-            headers={"Content-Type": "application/json"},
-            json=request_body.model_dump(by_alias=True)
-        )
+        result = await request_batch(battle_ids, client)
     except MaxRetryError:
         logging.warning(f"Retries exceeded during HTTP request for battle IDs: {len(battle_ids)=}")
-        return await split_request(battle_ids, client)
+        return await split_request(battle_ids, client, controller, quarantine)
+    if result is None:
+        return await isolate_poisoned(battle_ids, client, controller, quarantine or Quarantine(set()))
+    return result
+
+async def request_batch(battle_ids: list[int], client: httpx.AsyncClient) -> WHRAggregateResult | None:
+    '''
+    Make a single request for the given battle IDs.
+
+    Returns None if the batch was poisoned: ZKI failed on some battle ID in it.
+    '''
+    request_body = WHRBattlesRequest(battleids=battle_ids)
+    response = await client.post(
+        API_URL,
+        headers={"Content-Type": "application/json"},
+        json=request_body.model_dump(by_alias=True),
+        # Lets the transport tell the controller how large the request was that it timed
+        extensions={'batch_size': len(battle_ids), 'split_depth': split_depth.get()},
+    )
     try:
         response.raise_for_status()
     except httpx.HTTPStatusError as e:
@@ -273,8 +528,7 @@ async def get_latest_ratings(battle_ids: list[int], client: httpx.AsyncClient, m
 
         # ZKI will sometimes not process all replays. When we request data from a match without date, ZKI
         # will attempt to look it up in its dictionary, fail, and return a 500 error with the stack trace.
-        # If it looks like this is what happened, try to binary search to find any bad battle IDs.
-        # Performs O(n log n) requests if every single Battle ID is bad.
+        # If it looks like this is what happened, the caller isolates the bad battle IDs. See isolate_poisoned.
 
         # It won't tell us which battle ID failed, but it'll somewhat consistently return the C# KeyNotFound error.
         # If it doesn't look like this situation, just forward the error.
@@ -284,13 +538,7 @@ async def get_latest_ratings(battle_ids: list[int], client: httpx.AsyncClient, m
             raise
         if error_json.get("ExceptionType") != "System.Collections.Generic.KeyNotFoundException":
             raise
-
-        # Looks like this was the situation.
-        # If we're down to a single failing ID, identify this as the problem and skip it.
-        if len(battle_ids) == 1:
-            return WHRAggregateResult([], battle_ids, [])
-        # Otherwise, split the request in half and try again.
-        return await split_request(battle_ids, client)
+        return None
 
     battles_data = response.json()
     # Track battles missing from the response: Battles which we asked for, but the server silently did not include
@@ -302,19 +550,225 @@ async def get_latest_ratings(battle_ids: list[int], client: httpx.AsyncClient, m
         missing = list(missing_ids)
     return WHRAggregateResult(battles, [], missing)
 
-async def split_request(battle_ids: list[int], client: httpx.AsyncClient) -> WHRAggregateResult:
+@splits
+async def isolate_poisoned(
+    battle_ids: list[int],
+    client: httpx.AsyncClient,
+    controller: AdaptiveController | None,
+    quarantine: Quarantine,
+) -> WHRAggregateResult:
+    '''
+    Recover the WHR values from a batch known to contain at least one battle ID which makes ZKI fail.
+
+    First, anything the quarantine knows or suspects is pulled out: known bad IDs are skipped, suspects
+    go in their own small probe batches, and the remainder is retried whole. Bad IDs found elsewhere in
+    this run make their neighbours suspect here too.
+
+    Otherwise, binary splitting: only the left half is sent. If it comes back clean, the right half must
+    hold the bad ID, so it is split without ever being sent whole. Isolating one bad ID among n costs
+    about log2(n) requests, rather than the 2 log2(n) of requesting both halves at every level, and each
+    good ID is only sent whole about once more.
+    '''
+    quarantine.poisoned_requests += 1
+    if len(battle_ids) == 1:
+        # Down to a single failing ID, identify this as the problem and skip it.
+        quarantine.add(battle_ids[0])
+        return WHRAggregateResult([], battle_ids, [])
+
+    bad, suspect, clean = quarantine.partition(battle_ids)
+    if bad or (suspect and clean):
+        logging.debug(f"Quarantining {len(bad)} bad and {len(suspect)} suspect IDs from a poisoned batch of {len(battle_ids)}")
+        results = await asyncio.gather(
+            get_latest_ratings(clean, client, len(clean), controller, quarantine),
+            get_latest_ratings(suspect, client, PROBE_BATCH_SIZE, controller, quarantine),
+        )
+        return sum(results, WHRAggregateResult([], bad, []))
+
+    mid = len(battle_ids) // 2
+    left_ids, right_ids = battle_ids[:mid], battle_ids[mid:]
+    try:
+        left = await request_batch(left_ids, client)
+    except MaxRetryError:
+        logging.warning(f"Retries exceeded during HTTP request for battle IDs: {len(left_ids)=}")
+        # The split may have found the bad ID in the left half itself, so nothing is known of the right
+        left, right = await asyncio.gather(
+            split_request(left_ids, client, controller, quarantine),
+            get_latest_ratings(right_ids, client, len(right_ids), controller, quarantine),
+        )
+        return left + right
+    if left is not None:
+        # The left half came back clean, so the bad ID must be in the right
+        return left + await isolate_poisoned(right_ids, client, controller, quarantine)
+    # Both halves could hold bad IDs, but only the left is known to
+    left, right = await asyncio.gather(
+        isolate_poisoned(left_ids, client, controller, quarantine),
+        get_latest_ratings(right_ids, client, len(right_ids), controller, quarantine),
+    )
+    return left + right
+
+async def get_adaptive_batches(
+    battle_ids: list[int],
+    client: httpx.AsyncClient,
+    max_batch_size: int,
+    controller: AdaptiveController,
+    quarantine: Quarantine | None = None,
+) -> WHRAggregateResult:
+    '''
+    Request WHR values in batches carved off as we go, so that each batch is sized by what the
+    controller has learned from the responses so far, rather than fixed up front.
+    '''
+    pending = deque(battle_ids)
+    results: list[WHRAggregateResult] = []
+
+    async def worker() -> None:
+        while pending:
+            size = min(max_batch_size, controller.batch_size, len(pending))
+            batch = [pending.popleft() for _ in range(size)]
+            results.append(await get_latest_ratings(batch, client, size, controller, quarantine))
+
+    # How many of these are actually in flight at once is up to the controller, in the transport
+    await asyncio.gather(*[worker() for _ in range(controller.max_concurrency)])
+    return sum(results, WHRAggregateResult.empty())
+
+@splits
+async def split_request(
+    battle_ids: list[int],
+    client: httpx.AsyncClient,
+    controller: AdaptiveController | None = None,
+    quarantine: Quarantine | None = None,
+) -> WHRAggregateResult:
     mid = len(battle_ids) // 2
     left_ids = battle_ids[:mid]
     right_ids = battle_ids[mid:]
     left, right = await asyncio.gather(
-        get_latest_ratings(left_ids, client),
-        get_latest_ratings(right_ids, client)
+        get_latest_ratings(left_ids, client, controller=controller, quarantine=quarantine),
+        get_latest_ratings(right_ids, client, controller=controller, quarantine=quarantine)
     )
     if len(left) + len(right) != len(battle_ids):
         logging.warning(f"Mismatch in split request results length, {len(left.ratings)=} + {len(right.ratings)=} + {len(left.skipped)=} + {len(right.skipped)=} + {len(left.missing)=} + {len(right.missing)=} != {len(battle_ids)=}")
     return left + right
 
+class WHRCache:
+    """
+    Persistent record of the WHR data we have for each battle, and when we fetched it.
+
+    Each entry has a status:
+        ok:      We have ratings for this battle
+        skipped: Requesting this battle caused server errors
+        missing: The server silently omitted this battle from its response
+    """
+    VERSION = 1
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._entries: dict[int, dict] = {}
+
+    @staticmethod
+    def load(path: str) -> WHRCache:
+        cache = WHRCache(path)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cache
+        except json.JSONDecodeError:
+            logging.warning(f"WHR cache at {path} is corrupt, starting from scratch")
+            return cache
+        if data.get('version') != WHRCache.VERSION:
+            logging.warning(f"WHR cache at {path} has version {data.get('version')}, expected {WHRCache.VERSION}, starting from scratch")
+            return cache
+        cache._entries = {int(battle_id): entry for battle_id, entry in data['battles'].items()}
+        return cache
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': WHRCache.VERSION, 'battles': self._entries}, f)
+        os.replace(tmp, self._path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def ids_with_status(self, status: str) -> set[int]:
+        return {battle_id for battle_id, entry in self._entries.items() if entry['status'] == status}
+
+    def select(self, battle_ids: list[int], refresh_after: timedelta, refresh_recent: int, refresh_oldest: int) -> tuple[list[int], list[int]]:
+        """
+        Choose which battles to request this run.
+
+        Returns (new, stale):
+            new:   Battles we have never fetched
+            stale: Battles fetched longer than refresh_after ago, prioritised as follows:
+                   - Anything that isn't ok, since it may have been fixed server side
+                   - Up to refresh_recent of the most recent battles, whose ratings are still moving the most
+                   - Up to refresh_oldest of the least recently fetched battles, so everything is revisited eventually
+        """
+        cutoff = time() - refresh_after.total_seconds()
+        new = []
+        stale_not_ok = []
+        stale_ok = []
+        for battle_id in battle_ids:
+            entry = self._entries.get(battle_id)
+            if entry is None:
+                new.append(battle_id)
+            elif entry['fetched'] < cutoff:
+                (stale_ok if entry['status'] == 'ok' else stale_not_ok).append(battle_id)
+        # Battle IDs increase over time, so the highest IDs are the most recent battles
+        stale_ok.sort(reverse=True)
+        recent = stale_ok[:refresh_recent]
+        oldest = sorted(stale_ok[refresh_recent:], key=lambda battle_id: self._entries[battle_id]['fetched'])[:refresh_oldest]
+        return new, stale_not_ok + recent + oldest
+
+    def update(self, result: WHRAggregateResult) -> None:
+        now = time()
+        for battle in result.ratings:
+            self._entries[battle.id] = {'fetched': now, 'status': 'ok', 'players': [player.model_dump(by_alias=True) for player in battle.players]}
+        for battle_id in result.skipped:
+            self._entries[battle_id] = {'fetched': now, 'status': 'skipped'}
+        for battle_id in result.missing:
+            self._entries[battle_id] = {'fetched': now, 'status': 'missing'}
+
+    def result_for(self, battle_ids: list[int]) -> WHRAggregateResult:
+        """
+        Everything the cache knows about the given battles, in the same form as a fresh fetch.
+        """
+        ratings, skipped, missing = [], [], []
+        for battle_id in battle_ids:
+            entry = self._entries.get(battle_id)
+            if entry is None:
+                continue
+            match entry['status']:
+                case 'ok':
+                    ratings.append(WHRBattle(id=battle_id, players=[WHRPlayerRatings.model_validate(player) for player in entry['players']]))
+                case 'skipped':
+                    skipped.append(battle_id)
+                case 'missing':
+                    missing.append(battle_id)
+        return WHRAggregateResult(ratings, skipped, missing)
+
+def whr_metrics() -> Metrics:
+    '''
+    What a run records, as RateLimitTransport and amain fill it in.
+    '''
+    m = Metrics('whr')
+    m.histogram('request_duration_seconds', 'Time from sending a request to its response headers', SECONDS)
+    m.histogram('request_battles', 'Battle IDs per request', COUNTS)
+    m.histogram('rate_limit_wait_seconds', 'Time each attempt waited in RateLimiter.acquire', SECONDS)
+    m.histogram('split_depth', 'How many times a request\'s batch was split off from the one it came from', (0, 1, 2, 3, 4, 6, 8, 12, 16))
+    m.counter('requests_total', 'Attempts, by HTTP status or timeout')
+    m.counter('retries_total', 'Attempts after the first of a request')
+    m.counter('gave_up_total', 'Requests which ran out of retries, and were split')
+    m.counter('poisoned_requests_total', 'Requests ZKI failed on a battle ID in, and were isolated')
+    m.counter('backoffs_total', 'Times the adaptive controller backed off')
+    m.gauge('battles', 'Battles this run, by what became of them')
+    m.gauge('controller_rate', 'Requests per second the adaptive controller finished at')
+    m.gauge('controller_concurrency', 'Requests in flight the adaptive controller finished at')
+    m.gauge('controller_batch_size', 'Battles per request the adaptive controller finished at')
+    return m
+
 async def amain():
+    global API_URL
     parser = ArgumentParser(description="Fetch WHR data for all known battles")
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
     parser.add_argument('--input', '-i', default='public/data/live.json', help='Input JSON file with battle summaries (default: public/data/live.json)')
@@ -322,27 +776,66 @@ async def amain():
     parser.add_argument('--skipped-output', '-s', default='demos/fullwhr-skipped.json', help='Output JSON file for battle IDs which we had to not request to avoid ZKI errors (default: demos/fullwhr-skipped.json)')
     parser.add_argument('--missing-output', '-m', default='demos/fullwhr-missing.json', help='Output JSON file for battle IDs which ZKI silently did not provide responses for (default: demos/fullwhr-missing.json)')
     parser.add_argument('--limit', '-l', type=int, default=None, help='Limit to this many battles from the input file (default: all)')
+    parser.add_argument('--cache', '-c', default='demos/whr/cache.json', help='Persistent WHR cache (default: demos/whr/cache.json)')
+    parser.add_argument('--refresh-after', type=float, default=24, help='Hours before a cached battle is considered stale (default: 24)')
+    parser.add_argument('--refresh-recent', type=int, default=2000, help='Refetch up to this many of the most recent stale battles per run (default: 2000)')
+    parser.add_argument('--refresh-oldest', type=int, default=1000, help='Refetch up to this many of the least recently fetched stale battles per run (default: 1000)')
+    parser.add_argument('--full', action='store_true', help='Ignore the cache and refetch every battle')
+    parser.add_argument('--api-url', default=API_URL, help=f'WHR battles API endpoint, eg a local bench/mock_zki.py (default: {API_URL})')
+    parser.add_argument('--max-rate', type=float, default=8, help='Most requests per second the adaptive controller may send (default: 8)')
+    parser.add_argument('--max-concurrency', type=int, default=20, help='Most requests the adaptive controller may have in flight at once (default: 20)')
+    parser.add_argument('--max-batch-size', type=int, default=2 * MAX_BATCH_SIZE, help=f'Most battles the adaptive controller may put in one request (default: {2 * MAX_BATCH_SIZE})')
+    parser.add_argument('--latency-target', type=float, default=5, help='Responses slower than this many seconds shrink the batch size (default: 5)')
+    parser.add_argument('--suspect-radius', type=int, default=2, help=f'Battle IDs within this distance of a known bad ID are requested in batches of {PROBE_BATCH_SIZE} (default: 2)')
+    parser.add_argument('--no-adaptive', action='store_true', help=f'Use a fixed 5 requests per second and batches of {MAX_BATCH_SIZE}, as before the adaptive controller')
+    parser.add_argument('--metrics', default=None, help='Write textfile metrics and a run report to this directory, eg: metrics (default: none)')
     args = parser.parse_args()
     logging.basicConfig(
         format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
         level=logging.DEBUG if args.verbose else logging.INFO
     )
+    API_URL = args.api_url
+    run_metrics = whr_metrics() if args.metrics else None
     with open(args.input, 'r') as f:
         all_summaries = json.load(f)
 
     battle_ids = [summary['gameid'] for summary in all_summaries if not summary.get('skip', False)]
     if args.limit is not None:
         battle_ids = battle_ids[:args.limit]
-    logging.info(f"Fetching WHR data for {len(battle_ids)} battles")
-    previously_skipped_ids: set[int] = set()
+    cache = WHRCache(args.cache) if args.full else WHRCache.load(args.cache)
+    new_ids, stale_ids = cache.select(battle_ids, timedelta(hours=args.refresh_after), args.refresh_recent, args.refresh_oldest)
+    fetch_ids = new_ids + stale_ids
+    logging.info(f"Fetching WHR data for {len(fetch_ids)}/{len(battle_ids)} battles: {len(new_ids)} new, {len(stale_ids)} stale, {len(cache)} cached")
+    previously_skipped_ids: set[int] = cache.ids_with_status('skipped')
     with suppress(FileNotFoundError):
         with open(args.skipped_output) as skipped_ids:
-            previously_skipped_ids = set(json.load(skipped_ids))
+            previously_skipped_ids |= set(json.load(skipped_ids))
+    # The whole history counts towards which IDs are suspect, even for battles we aren't refetching
+    quarantine = Quarantine(previously_skipped_ids, radius=args.suspect_radius)
+    previously_skipped_ids &= set(fetch_ids)
+    _, suspect_ids, clean_ids = quarantine.partition(fetch_ids)
+
+    controller = None if args.no_adaptive else AdaptiveController(
+        max_rate=args.max_rate,
+        max_concurrency=args.max_concurrency,
+        max_batch_size=args.max_batch_size,
+        latency_target=args.latency_target,
+    )
+    if controller is None:
+        limits = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+        max_batch_size = MAX_BATCH_SIZE
+    else:
+        # The controller keeps in flight requests within the pool, so requests never queue for a connection
+        # with the pool timeout running. That queueing was where the pool timeouts came from.
+        limits = httpx.Limits(max_connections=args.max_concurrency, max_keepalive_connections=args.max_concurrency)
+        max_batch_size = args.max_batch_size
 
     try:
         # Rate limit to 3 requests per 1 second
         # Update based on ZKI DosProtect.cs and empirical testing
+        # Unless --no-adaptive, this is only the starting point: AdaptiveController raises it while ZKI keeps up,
+        # and backs off on timeouts and 429s.
 
         # By DeinFreund's commentary, lookups are very fast, since it's all in ZKI memory.
         # In practice, read timeouts happen often if left at 5s. Tripling the read timeout still sees the occassional timeout, but infrequently.
@@ -350,19 +843,21 @@ async def amain():
         # The connection pool is halved to speculatively avoid locking hell. We should only need 5 or so parallel connections, but reducing
         # the number that far causes performance issues in practice.
         # XXX: There shouldn't be much non-I/O connection housekeeping required. Work out what's going on here.
+        # httpx ignores the client's http2 and limits once it's given a transport, so they're set on the pool itself
+        pool = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=0)
         async with httpx.AsyncClient(
-            http2=True,
             timeout=httpx.Timeout(5, read=15, pool=20),
-            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
-            transport=RateLimitTransport(max_calls=5, period=1, retries=4)
+            transport=RateLimitTransport(max_calls=5, period=1, retries=4, controller=controller, metrics=run_metrics, transport=pool)
         ) as client:
             # Assume that if IDs needed to be previously skipped, they probably need to be skipped again.
             # Note that these don't seem fully stable, and differ between the ZKI test and production environments.
             # All IDs which previously needed to be skipped are made into single requests.
             # These potentially killer IDs are removed from bulk requests, to maximize the odds that bulk requests succeed.
+            # Their neighbours are suspect, and are sent in small probe batches, so they are cheap to isolate if need be.
             result = sum(await asyncio.gather(
-                get_latest_ratings(list(previously_skipped_ids), client, max_batch_size=1),
-                get_latest_ratings([i for i in battle_ids if i not in previously_skipped_ids], client),
+                get_latest_ratings(list(previously_skipped_ids), client, 1, controller, quarantine),
+                get_latest_ratings(suspect_ids, client, PROBE_BATCH_SIZE, controller, quarantine),
+                get_latest_ratings(clean_ids, client, max_batch_size, controller, quarantine),
             ), WHRAggregateResult.empty())
     except httpx.HTTPStatusError as e:
         try:
@@ -376,6 +871,15 @@ async def amain():
     except Exception as e:
         logging.error(f"Error fetching WHR data: {e}")
         raise
+    finally:
+        # A failed run's metrics are the ones most worth seeing
+        if run_metrics is not None and sys.exc_info()[0] is not None:
+            run_metrics.write(args.metrics, success=False)
+
+    fetched = result
+    cache.update(fetched)
+    cache.save()
+    result = cache.result_for(battle_ids)
 
     with open(args.skipped_output, 'w') as f:
         json.dump(result.skipped, f)
@@ -393,7 +897,8 @@ async def amain():
     with open(args.output, 'w') as f:
         json.dump([battle.model_dump(by_alias=True) for battle in result.ratings], f)
 
-    logging.info(f"Fetched WHR data for {len(result.ratings)} battles, skipped {len(result.skipped)}/{len(battle_ids)}, server omitted {len(result.missing)}/{len(battle_ids)} battles")
+    logging.info(f"Fetched WHR data for {len(fetched.ratings)}/{len(fetch_ids)} requested battles")
+    logging.info(f"Have WHR data for {len(result.ratings)} battles, skipped {len(result.skipped)}/{len(battle_ids)}, server omitted {len(result.missing)}/{len(battle_ids)} battles")
     if result.skipped:
         logging.warning(f"Skipped error inducing battles for {len(result.skipped)} battles: {result.skipped[:10]=}")
     if result.missing:
@@ -401,6 +906,27 @@ async def amain():
     if null_data_battles:
         # Note: Frontend will categorize these as "Server sourced null" for WHR availability
         logging.warning(f"Received null WHR ratings for {len(null_data_battles)} battles: {null_data_battles[:10]=}")
+    if quarantine.poisoned_requests:
+        logging.info(f"Isolated bad battle IDs from {quarantine.poisoned_requests} poisoned requests")
+    if controller is not None:
+        logging.info(f"Adaptive controller finished at rate={controller.rate:.2f}/s concurrency={controller.concurrency} batch_size={controller.batch_size}, backed off {len(controller.backoffs)} times")
+        for backoff in controller.backoffs:
+            logging.debug(f"Backed off at {backoff.at:%H:%M:%S} after {backoff.reason}: rate={backoff.rate:.2f}/s concurrency={backoff.concurrency} batch_size={backoff.batch_size}")
+    if run_metrics is not None:
+        run_metrics.set('battles', len(new_ids), state='new')
+        run_metrics.set('battles', len(stale_ids), state='stale')
+        run_metrics.set('battles', len(fetched.ratings), state='fetched')
+        run_metrics.set('battles', len(result.ratings), state='rated')
+        run_metrics.set('battles', len(result.skipped), state='skipped')
+        run_metrics.set('battles', len(result.missing), state='missing')
+        run_metrics.set('battles', len(null_data_battles), state='null')
+        run_metrics.inc('poisoned_requests_total', quarantine.poisoned_requests)
+        if controller is not None:
+            run_metrics.inc('backoffs_total', len(controller.backoffs))
+            run_metrics.set('controller_rate', controller.rate)
+            run_metrics.set('controller_concurrency', controller.concurrency)
+            run_metrics.set('controller_batch_size', controller.batch_size)
+        run_metrics.write(args.metrics, success=True)
 
 def main():
     asyncio.run(amain())
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+'''
+Pack a shard's simulation logs into one compressed archive, with an index
+for reading any one battle's log back directly.
+
+Inputs, relative to a shard directory:
+    stats/<id>/events.log
+    stats/<id>/spring.log
+    summaries/shard.json.frags
+
+Outputs, relative to a shard directory:
+    stats/logs.pack (data)
+    stats/logs.idx (offset index)
+
+Once a battle has been postprocessed its logs are rarely read again, yet
+they're most of our disk use, and two inodes each. pack appends the logs of
+every battle older than the shard's last postprocess (shard.json.frags) to
+logs.pack, compressing each log separately, then rewrites logs.idx
+atomically to point at them, and only then removes the loose files. Each log
+is its own compressed stream, so reading one battle back is a seek and a
+read, and reading a shard's battles in ID order reads logs.pack front to
+back.
+
+logs.idx is a small header, then a fixed size record per log, sorted by
+battle ID: see INDEX_HEADER and INDEX_RECORD. It keeps the mtime of the file
+each log was packed from, so postprocess.py can still tell whether a summary
+is up to date. A battle simulated again gets a loose events.log again, which
+readers prefer, and which is appended on the next pack; the space its old
+entry held is reclaimed with --compact. Data past the end of the last log,
+left by an interrupted pack, is truncated on the next one.
+
+Readers: postprocess.py, timeseries.py, simulate.py and scheduler.py go
+through open_log(), log_mtime() and LogPack, so packed battles are neither
+simulated again nor lost to later processing. Makefile.shard leaves packed
+battles out of EVENTS, using the ids command.
+
+Usage:
+    logpack.py pack [--codec lzma|zlib] [--compact] SHARD_DIR...
+    logpack.py ids SHARD_DIR          Print the battles with packed logs
+    logpack.py cat SHARD_DIR ID [LOG] Print a battle's log (default: events.log)
+    logpack.py stats SHARD_DIR...
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections.abc import Iterator
+from dataclasses import dataclass
+import fcntl
+import io
+import logging
+import lzma
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+MAGIC = b'ZKLP'
+# Bump if the index or data layout changes. Older packs are then refused rather than misread.
+PACK_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sI')
+# gameid, log, codec, offset, compressed length, uncompressed length, source mtime (ns)
+INDEX_RECORD = struct.Struct('<IBB2xQQQq')
+
+LOGS = ('events.log', 'spring.log')
+LOG_CODES = {name: i for i, name in enumerate(LOGS)}
+
+CODECS = ('lzma', 'zlib')
+CODEC_CODES = {name: i for i, name in enumerate(CODECS)}
+
+
+@dataclass(slots=True, frozen=True)
+class Entry:
+    gameid: int
+    log: int
+    codec: int
+    offset: int
+    length: int
+    size: int
+    mtime: int
+
+    def pack(self) -> bytes:
+        return INDEX_RECORD.pack(self.gameid, self.log, self.codec, self.offset, self.length, self.size, self.mtime)
+
+
+def paths(shard_dir: str) -> tuple[str, str]:
+    stats_dir = os.path.join(shard_dir, 'stats')
+    return os.path.join(stats_dir, 'logs.pack'), os.path.join(stats_dir, 'logs.idx')
+
+
+def read_index(index_path: str) -> list[Entry]:
+    '''
+    The entries in a logs.idx, sorted by (gameid, log). A missing or empty index has none.
+    '''
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    if not data:
+        return []
+    magic, version = INDEX_HEADER.unpack_from(data)
+    if magic != MAGIC or version != PACK_VERSION:
+        raise ValueError(f"{index_path} is not a version {PACK_VERSION} log pack index")
+    return [Entry(*fields) for fields in INDEX_RECORD.iter_unpack(data[INDEX_HEADER.size:])]
+
+
+class LogPack:
+    '''
+    A shard's packed logs, for reading.
+    '''
+    def __init__(self, shard_dir: str) -> None:
+        self.pack_path, index_path = paths(shard_dir)
+        entries = read_index(index_path)
+        self._keys = [(entry.gameid, entry.log) for entry in entries]
+        self._entries = entries
+
+    def __len__(self) -> int:
+        return len(self.ids())
+
+    def __contains__(self, gameid: object) -> bool:
+        return self.entry(gameid, 'events.log') is not None if isinstance(gameid, int) else False
+
+    def ids(self) -> set[int]:
+        return {gameid for gameid, log in self._keys if log == LOG_CODES['events.log']}
+
+    def entries(self) -> list[Entry]:
+        return list(self._entries)
+
+    def entry(self, gameid: int, name: str = 'events.log') -> Entry | None:
+        key = (gameid, LOG_CODES[name])
+        i = bisect_left(self._keys, key)
+        return self._entries[i] if i < len(self._keys) and self._keys[i] == key else None
+
+    def members(self, name: str = 'events.log') -> Iterator[Entry]:
+        '''
+        Every packed log of one kind, in battle ID order, which is also the order they're laid out in.
+        '''
+        code = LOG_CODES[name]
+        return (entry for entry in self._entries if entry.log == code)
+
+    def read_compressed(self, entry: Entry) -> bytes:
+        with open(self.pack_path, 'rb') as f:
+            f.seek(entry.offset)
+            data = f.read(entry.length)
+        if len(data) != entry.length:
+            raise ValueError(f"{self.pack_path} is truncated at battle {entry.gameid}")
+        return data
+
+    def open(self, gameid: int, name: str = 'events.log') -> io.TextIOBase:
+        '''
+        A packed log, as text, decompressed as it's read.
+        '''
+        entry = self.entry(gameid, name)
+        if entry is None:
+            raise FileNotFoundError(f"No packed {name} for battle {gameid} in {self.pack_path}")
+        data = self.read_compressed(entry)
+        if entry.codec == CODEC_CODES['lzma']:
+            return io.TextIOWrapper(lzma.LZMAFile(io.BytesIO(data)), errors='replace')
+        return io.StringIO(zlib.decompress(data).decode(errors='replace'))
+
+
+# Shard directory -> (index stamp, LogPack), so a worker summarising many battles in a shard reads its index once
+_packs: dict[str, tuple[tuple[int, int] | None, LogPack]] = {}
+
+
+def load(shard_dir: str) -> LogPack:
+    '''
+    A shard's LogPack, reusing the one already loaded while its index is unchanged.
+    '''
+    index_path = paths(shard_dir)[1]
+    try:
+        st = os.stat(index_path)
+        index_stamp = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        index_stamp = None
+    key = os.path.realpath(shard_dir)
+    cached = _packs.get(key)
+    if cached is not None and cached[0] == index_stamp:
+        return cached[1]
+    logs = LogPack(shard_dir)
+    _packs[key] = (index_stamp, logs)
+    return logs
+
+
+def loose_path(shard_dir: str, gameid: int, name: str = 'events.log') -> str:
+    return os.path.join(shard_dir, 'stats', str(gameid), name)
+
+
+def open_log(shard_dir: str, gameid: int, name: str = 'events.log') -> io.TextIOBase:
+    '''
+    A battle's log, from its loose file if there is one, otherwise from the shard's pack.
+    '''
+    try:
+        return open(loose_path(shard_dir, gameid, name), 'r', errors='replace')
+    except FileNotFoundError:
+        return load(shard_dir).open(gameid, name)
+
+
+def log_mtime(shard_dir: str, gameid: int, name: str = 'events.log') -> int:
+    '''
+    st_mtime_ns of a battle's log, or of the file it was packed from.
+    '''
+    try:
+        return os.stat(loose_path(shard_dir, gameid, name)).st_mtime_ns
+    except FileNotFoundError:
+        entry = load(shard_dir).entry(gameid, name)
+        if entry is None:
+            raise
+        return entry.mtime
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == 'lzma':
+        return lzma.compress(data, preset=6)
+    return zlib.compress(data, 9)
+
+
+def pack(shard_dir: str, codec: str = 'lzma', compact: bool = False) -> tuple[int, int, int]:
+    '''
+    Pack the logs of every battle older than the shard's last postprocess, then remove them.
+    Returns (battles packed, bytes before, bytes after).
+    '''
+    pack_path, index_path = paths(shard_dir)
+    try:
+        cutoff = os.stat(os.path.join(shard_dir, 'summaries', 'shard.json.frags')).st_mtime_ns
+    except FileNotFoundError:
+        logging.info(f"Shard {shard_dir} hasn't been postprocessed yet, nothing to pack")
+        return 0, 0, 0
+
+    # Only one packer per shard at a time. The lock is on the data file, which is never replaced, except by --compact.
+    lock = os.open(pack_path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = {(entry.gameid, entry.log): entry for entry in read_index(index_path)}
+        end = max((entry.offset + entry.length for entry in entries.values()), default=0)
+
+        # Battle ID -> paths of the loose logs to pack
+        loose: dict[int, list[str]] = {}
+        with os.scandir(os.path.join(shard_dir, 'stats')) as it:
+            for battle_dir in it:
+                if not battle_dir.name.isdigit():
+                    continue
+                found = []
+                for name in LOGS:
+                    path = os.path.join(battle_dir.path, name)
+                    try:
+                        if os.stat(path).st_mtime_ns >= cutoff:
+                            # Postprocessed since, or being simulated right now
+                            found = []
+                            break
+                    except FileNotFoundError:
+                        continue
+                    found.append(path)
+                # A battle is only packed once it has an events.log, ie once it has been simulated
+                if any(path.endswith('events.log') for path in found):
+                    loose[int(battle_dir.name)] = found
+        if not loose and not compact:
+            return 0, 0, 0
+        # A battle packed again replaces everything packed for it before
+        for key in [key for key in entries if key[0] in loose]:
+            del entries[key]
+
+        if compact:
+            out = open(pack_path + '.tmp', 'wb')
+            position = 0
+            with open(pack_path, 'rb') as old:
+                for key in sorted(entries):
+                    entry = entries[key]
+                    old.seek(entry.offset)
+                    out.write(old.read(entry.length))
+                    entries[key] = Entry(entry.gameid, entry.log, entry.codec, position, entry.length, entry.size, entry.mtime)
+                    position += entry.length
+        else:
+            out = open(pack_path, 'r+b')
+            # Anything past the last log was left by an interrupted pack
+            out.truncate(end)
+            out.seek(end)
+            position = end
+
+        before = after = 0
+        with out:
+            for gameid in sorted(loose):
+                for path in loose[gameid]:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    compressed = compress(data, codec)
+                    out.write(compressed)
+                    log = LOG_CODES[os.path.basename(path)]
+                    entries[(gameid, log)] = Entry(gameid, log, CODEC_CODES[codec], position, len(compressed), len(data), os.stat(path).st_mtime_ns)
+                    position += len(compressed)
+                    before += len(data)
+                    after += len(compressed)
+            out.flush()
+            os.fsync(out.fileno())
+
+        # Data first, then the index that refers to it, and only then remove the originals
+        if compact:
+            os.replace(pack_path + '.tmp', pack_path)
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(INDEX_HEADER.pack(MAGIC, PACK_VERSION))
+            for key in sorted(entries):
+                f.write(entries[key].pack())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+        for gameid, found in loose.items():
+            for path in found:
+                os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(found[0]))
+            except OSError:
+                # Something else was left in there. Leave it be.
+                pass
+        return len(loose), before, after
+    finally:
+        # Closing the file releases the lock
+        os.close(lock)
+
+
+def main():
+    parser = ArgumentParser(description="Pack a shard's simulation logs into one compressed archive")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = subparsers.add_parser('pack', help='Pack the logs of postprocessed battles, then remove them')
+    pack_parser.add_argument('shards', nargs='+', help='Shard directories, eg: shards/160')
+    pack_parser.add_argument('--codec', choices=CODECS, default='lzma', help='Compression for newly packed logs (default: lzma)')
+    pack_parser.add_argument('--compact', action='store_true', help='Rewrite the pack without logs that have since been replaced')
+    ids_parser = subparsers.add_parser('ids', help='Print the battles with packed logs')
+    ids_parser.add_argument('shard', help='Shard directory, eg: shards/160')
+    cat_parser = subparsers.add_parser('cat', help="Print a battle's log")
+    cat_parser.add_argument('shard', help='Shard directory, eg: shards/160')
+    cat_parser.add_argument('id', type=int, help='Battle ID')
+    cat_parser.add_argument('log', nargs='?', choices=LOGS, default='events.log', help='Which log (default: events.log)')
+    stats_parser = subparsers.add_parser('stats', help='Print how much packing saved')
+    stats_parser.add_argument('shards', nargs='+', help='Shard directories, eg: shards/160')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    match args.command:
+        case 'pack':
+            for shard_dir in args.shards:
+                packed, before, after = pack(shard_dir, args.codec, args.compact)
+                if packed:
+                    logging.info(f"Shard {shard_dir}: packed {packed} battles, {before} bytes to {after}")
+        case 'ids':
+            print(' '.join(map(str, sorted(LogPack(args.shard).ids()))))
+        case 'cat':
+            try:
+                f = open_log(args.shard, args.id, args.log)
+            except FileNotFoundError as e:
+                logging.error(e)
+                sys.exit(1)
+            with f:
+                shutil.copyfileobj(f, sys.stdout)
+        case 'stats':
+            print('shard\tbattles\traw\tpacked\tratio')
+            for shard_dir in args.shards:
+                logs = LogPack(shard_dir)
+                entries = logs.entries()
+                raw = sum(entry.size for entry in entries)
+                packed = sum(entry.length for entry in entries)
+                print(f'{shard_dir}\t{len(logs)}\t{raw}\t{packed}\t{raw / packed if packed else 0:.1f}')
+
+if __name__ == '__main__':
+    main()
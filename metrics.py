@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+'''
+Per-stage pipeline metrics, as node exporter textfile metrics and a JSON run report.
+
+Outputs, for a stage run with --metrics DIR:
+    DIR/zkreplay_<stage>.prom
+    DIR/zkreplay_<stage>.json
+
+getwhr.py, postprocess.py --batch and simulate.py each record their own
+counters, gauges and histograms while they run, and write them out when
+they finish, however they finish. Each file describes the latest run of its
+stage, and is replaced whole, so node exporter's textfile collector never
+reads a partial one. Point it at DIR:
+    node_exporter --collector.textfile.directory=/var/lib/zkreplay/metrics
+
+Every stage also reports when its last run finished, how long it took, and
+whether it succeeded, as zkreplay_<stage>_last_run_timestamp_seconds,
+zkreplay_<stage>_run_duration_seconds and zkreplay_<stage>_last_run_success.
+
+The JSON run report holds the same metrics, with each histogram's mean and
+estimated quantiles, for reading without Prometheus, or for comparing a run
+against one from before a change.
+
+Usage:
+    metrics.py show REPORT...                Summarise run reports, eg: metrics/*.json
+    metrics.py compare BASELINE REPORT       Compare a stage's run with an earlier one of the same stage
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from datetime import datetime
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+PREFIX = 'zkreplay'
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Shared bucket layouts, upper bounds
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60)
+LONG_SECONDS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400)
+BYTES = tuple(2**n * 2**20 for n in range(7, 14))
+COUNTS = (1, 2, 4, 8, 16, 32, 64, 125, 250, 500, 1000)
+# Written for every stage by Metrics.write
+RUN_GAUGES = ('last_run_timestamp_seconds', 'run_duration_seconds', 'last_run_success')
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+@dataclass(slots=True)
+class Histogram:
+    buckets: tuple[float, ...]
+    # Observations per bucket, not cumulative; the last is +Inf
+    counts: list[int] = field(init=False)
+    count: int = 0
+    sum: float = 0
+    min: float = math.inf
+    max: float = -math.inf
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        '''
+        Estimate a quantile by interpolating within its bucket, as Prometheus' histogram_quantile does.
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else min(0, self.min)
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                # Never estimate outside what was actually observed
+                estimate = lower + (upper - lower) * (rank - seen) / n
+                return max(self.min, min(self.max, estimate))
+            seen += n
+        return self.max
+
+    def report(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            **{f'p{round(q * 100)}': self.quantile(q) for q in QUANTILES},
+            'buckets': {format_value(bound): n for bound, n in zip(self.buckets + (math.inf,), self.counts)},
+        }
+
+
+@dataclass(slots=True)
+class Family:
+    name: str
+    kind: str
+    help: str
+    buckets: tuple[float, ...] = ()
+    # Sorted (label, value) pairs -> a number, or a Histogram
+    samples: dict[tuple[tuple[str, str], ...], float | Histogram] = field(default_factory=dict)
+
+    def lines(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labels, sample in sorted(self.samples.items()):
+            if isinstance(sample, Histogram):
+                cumulative = 0
+                for bound, n in zip(sample.buckets + (math.inf,), sample.counts):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{format_labels(labels + (("le", format_value(bound)),))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(sample.sum)}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {sample.count}')
+            else:
+                lines.append(f'{self.name}{format_labels(labels)} {format_value(sample)}')
+        return lines
+
+    def report(self) -> dict:
+        return {
+            'type': self.kind,
+            'help': self.help,
+            'samples': [
+                {'labels': dict(labels), **(sample.report() if isinstance(sample, Histogram) else {'value': sample})}
+                for labels, sample in sorted(self.samples.items())
+            ],
+        }
+
+
+class Metrics:
+    '''
+    A stage's metrics for one run. Declare each metric before recording it; names are prefixed with zkreplay_<stage>_.
+    '''
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.started = time.time()
+        self._started = time.monotonic()
+        self._families: dict[str, Family] = {}
+
+    def _declare(self, name: str, kind: str, help: str, buckets: tuple[float, ...] = ()) -> None:
+        full = f'{PREFIX}_{self.stage}_{name}'
+        self._families[name] = Family(full, kind, help, tuple(sorted(buckets)))
+
+    def counter(self, name: str, help: str) -> None:
+        self._declare(name, 'counter', help)
+
+    def gauge(self, name: str, help: str) -> None:
+        self._declare(name, 'gauge', help)
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...]) -> None:
+        self._declare(name, 'histogram', help, buckets)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        family = self._families[name]
+        key = tuple(sorted(labels.items()))
+        family.samples[key] = family.samples.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        self._families[name].samples[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        family = self._families[name]
+        key = tuple(sorted(labels.items()))
+        if key not in family.samples:
+            family.samples[key] = Histogram(family.buckets)
+        family.samples[key].observe(value)
+
+    def write(self, directory: str, success: bool) -> None:
+        '''
+        Write the textfile and run report, finishing the run.
+        '''
+        finished = time.time()
+        duration = time.monotonic() - self._started
+        for name, help, value in zip(RUN_GAUGES, (
+            'When the last run finished, in seconds since the epoch',
+            'How long the last run took',
+            'Whether the last run succeeded',
+        ), (round(finished, 3), round(duration, 3), int(success))):
+            self.gauge(name, help)
+            self.set(name, value)
+
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f'{PREFIX}_{self.stage}')
+        text = '\n'.join(line for family in self._families.values() for line in family.lines()) + '\n'
+        report = {
+            'stage': self.stage,
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'finished': datetime.fromtimestamp(finished).isoformat(timespec='seconds'),
+            'duration': round(duration, 3),
+            'success': success,
+            'metrics': {family.name: family.report() for family in self._families.values()},
+        }
+        for path, content in ((base + '.prom', text), (base + '.json', json.dumps(report, indent=1) + '\n')):
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        logging.debug(f"Wrote {self.stage} metrics to {base}.prom and {base}.json")
+
+
+def describe(sample: dict) -> str:
+    '''
+    One sample from a run report, in a line.
+    '''
+    labels = ','.join(f'{name}={value}' for name, value in sample['labels'].items())
+    labels = f'{{{labels}}}' if labels else ''
+    if 'value' in sample:
+        return f'{labels} {sample["value"]:.12g}'
+    if not sample['count']:
+        return f'{labels} no observations'
+    quantiles = ' '.join(f'p{round(q * 100)}={sample[f"p{round(q * 100)}"]:.4g}' for q in QUANTILES)
+    return f'{labels} count={sample["count"]} mean={sample["mean"]:.4g} {quantiles} max={sample["max"]:.4g}'
+
+
+def show(report: dict) -> None:
+    print(f'{report["stage"]}: {report["started"]} to {report["finished"]}, {report["duration"]:.1f}s, {"succeeded" if report["success"] else "failed"}')
+    for name, family in report['metrics'].items():
+        for sample in family['samples']:
+            print(f'    {name}{describe(sample)}')
+
+
+def compare(baseline: dict, current: dict) -> None:
+    '''
+    Print how each metric moved between two runs of a stage. Histograms compare by mean and p90.
+    '''
+    def change(old: float | None, new: float | None) -> str:
+        if old is None or new is None:
+            return f'{old} -> {new}'
+        percent = f' ({(new - old) / old:+.0%})' if old else ''
+        return f'{old:.4g} -> {new:.4g}{percent}'
+
+    print(f'{current["stage"]}: {baseline["finished"]} -> {current["finished"]}')
+    print(f'    duration {change(baseline["duration"], current["duration"])}')
+    for name, family in current['metrics'].items():
+        if name.endswith(RUN_GAUGES):
+            continue
+        before = {json.dumps(s['labels'], sort_keys=True): s for s in baseline['metrics'].get(name, {}).get('samples', [])}
+        for sample in family['samples']:
+            old = before.get(json.dumps(sample['labels'], sort_keys=True))
+            labels = ','.join(f'{k}={v}' for k, v in sample['labels'].items())
+            labels = f'{{{labels}}}' if labels else ''
+            if 'value' in sample:
+                print(f'    {name}{labels} {change(old and old["value"], sample["value"])}')
+            else:
+                print(f'    {name}{labels} mean {change(old and old["mean"], sample["mean"])}, p90 {change(old and old["p90"], sample["p90"])}')
+
+
+def main():
+    parser = ArgumentParser(description="Summarise and compare pipeline run reports")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='Summarise run reports')
+    show_parser.add_argument('reports', nargs='+', help='Run reports, eg: metrics/zkreplay_simulate.json')
+    compare_parser = subparsers.add_parser('compare', help="Compare a stage's run with an earlier one")
+    compare_parser.add_argument('baseline', help='Run report from before a change')
+    compare_parser.add_argument('report', help='Run report from after it')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    def load(path: str) -> dict:
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    match args.command:
+        case 'show':
+            for path in args.reports:
+                show(load(path))
+        case 'compare':
+            baseline, current = load(args.baseline), load(args.report)
+            if baseline['stage'] != current['stage']:
+                logging.error(f"Can't compare a {baseline['stage']} run with a {current['stage']} run")
+                sys.exit(1)
+            compare(baseline, current)
+
+if __name__ == '__main__':
+    main()
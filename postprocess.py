@@ -1,158 +1,213 @@
 #!/usr/bin/env python3
 
+'''
+Summarise simulated replays.
+
+Single battle mode, as used by Makefile.shard:
+    postprocess.py EVENTS_LOG BATTLE_ID > summary.json
+
+Batch mode, processing whole shards in one interpreter:
+    postprocess.py --batch [--jobs N] [--force] [--db PATH] SHARD_DIR... [--ids ID...]
+
+Inputs, relative to a shard directory:
+    demos/<id>/detail.json (or detail.html, see detail.py)
+    stats/<id>/events.log (or stats/logs.pack, see logpack.py)
+
+Outputs:
+    stdout (single battle mode)
+    summaries/<id>/summary.json (batch mode)
+    summaries/extractors.json (batch mode)
+    The summary database, instead of summary.json files (batch mode with --db, see summarydb.py)
+    <metrics>/zkreplay_postprocess.prom and .json (batch mode with --metrics, see metrics.py)
+
+Each summary is built by a series of extractors, each responsible for some
+of its fields, and each with a version. A summary records the version of
+every extractor that built it, under "extractors". Bump an extractor's
+version when what it extracts changes, or add a new extractor for new
+fields; batch mode then reruns just the extractors whose version changed,
+merging their fields into each existing summary, and leaves the rest of the
+summary alone. Changing anything else in this file reprocesses nothing.
+
+summaries/extractors.json records the versions every summary in a shard is
+known to be up to date with, so batch mode only reads a shard's summaries
+when some extractor has changed since. With --db, the database is queried
+for outdated summaries instead.
+
+Logs simulated with SUMMARYONLY (see: Makefile.shard) end before the game
+does, with the widget's mark that every event was recorded. Their winner
+comes from the detail record, and their duration from the replay header.
+'''
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cached_property
 import json
 import math
+import os
 import re
 from sys import argv, stderr, exit
+import time
 
-filename = argv[1]
-id = int(argv[2])
+from detail import load as load_detail
+import exclusions
+import logpack
+from metrics import SECONDS, Metrics
+import sdfz
+from summarydb import StoredSummary, SummaryStore
 
-# Scrape detail.html
-premap = re.compile(r'a href="/Maps/Detail/')
-mapname = re.compile(r'Map: (?P<name>[^<]+)')
-# From 105.1.1-2314-g9e0bf7d, a new way of recording the timestamp in the replay filename was used.
-# Before: YYYYMMDD_HHMMSS_
-# After: YYYY-mm-dd_HH-MM-SS-mmm_
-timestamp = re.compile(r"a href='/replays/(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})_(?P<hours>[0-9]{2})-(?P<minutes>[0-9]{2})-(?P<seconds>[0-9]{2})-[0-9]{3}_")
-timestamp_pre_2314 = re.compile(r"a href='/replays/(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})_(?P<hours>[0-9]{2})(?P<minutes>[0-9]{2})(?P<seconds>[0-9]{2})_")
-userid = re.compile(r"href='/Users/Detail/(?P<userid>[0-9]+)'[^>]+>(?P<username>[^<]+)</a>")
+# Summaries are written to the store this many at a time
+STORE_BATCH_SIZE = 500
 
-name_to_userid = {}
-teamid_to_player = {}
-name_to_player = {}
+# Summaries have only ever recorded release versions of the game
+zkver = re.compile(r'Zero-K [v0-9.]+')
 
 # Scrape events.log
 playerinfo = re.compile(r'\[(?:0|1)\] (?P<name>.*), team: (?P<teamid>[0-9]+), elo:(?P<elo>[0-9]+)(?:, userid: (?P<userid>[0-9]+))?(?:, ai: (?P<ai>.*))?')
 facplop = re.compile(r'\[(?P<frame>[0-9]+)\] Event \[(?P<location>[^\]]+)\]: (?P<teamid>[0-9]+) finished unit (?P<fac>Cloakbot Factory|Shieldbot Factory|Rover Assembly|Hovercraft Platform|Gunship Plant|Airplane Plant|Spider Factory|Jumpbot Factory|Tank Foundry|Amphbot Factory|Shipyard|Strider Hub)')
 
 class SkipCondition(object):
-    def __init__(self, why, expr, extra=lambda: True):
+    """
+    A message which means the battle should not be used.
+
+    prefix is matched against the text following the frame tag, eg "autohost exit" for "[1234] autohost exit".
+    """
+    def __init__(self, why, prefix, extra=lambda win: True):
         self.why = why
-        self.expr = re.compile(expr)
+        self.prefix = prefix
         self.extra = extra
 
-    def satisfied(self, line):
-        return self.expr.match(line) and self.extra()
+    def satisfied(self, message, win):
+        return message.startswith(self.prefix) and self.extra(win)
 
 
 winner = re.compile(r'\[(?P<frame>[0-9]+)\] Received game_message: (?P<name>.*) wins!')
-statsheader = re.compile(r'\[(?P<frame>[0-9]+)\] Game End Stats Header: ')
-
-win = None
-duration = None
-battlemap = None
-started = None
-sp = None
-zk = None
-skip = False
 
-draw = SkipCondition('Game Draw', r'\[(?P<frame>[0-9]+)\] Received game_message: The game ended in a draw!')
-autohostexit = SkipCondition('Autohost exit', r'\[(?P<frame>[0-9]+)\] autohost exit')
-nostartpos = SkipCondition('No start placement', r'\[(?P<frame>[0-9]+)\] player nonplacement')
-all_players_exit = SkipCondition('All players disconnected', r'\[(?P<frame>[0-9]+)\] all players disconnected', lambda: win == None)
+draw = SkipCondition('Game Draw', 'Received game_message: The game ended in a draw!')
+autohostexit = SkipCondition('Autohost exit', 'autohost exit')
+nostartpos = SkipCondition('No start placement', 'player nonplacement')
+all_players_exit = SkipCondition('All players disconnected', 'all players disconnected', lambda win: win == None)
 
 skip_conditions = [draw, autohostexit, nostartpos, all_players_exit]
 
+# Every line the widget writes is of the form "[frame] message".
+# Dispatch on the start of the message, so each line costs one or two string comparisons rather than a regex per pattern.
+EVENT_PREFIX = 'Event ['
+GAME_MESSAGE_PREFIX = 'Received game_message: '
+STATS_HEADER_PREFIX = 'Game End Stats Header: '
+# Written by the widget when a summary only simulation stops early
+SUMMARY_COMPLETE_PREFIX = 'Summary events complete'
+# Frames per second of game time
+GAME_SPEED = 30
+
+# Chatty per-battle diagnostics. Batch mode turns these off unless asked.
+verbose = True
+
 def d(*args, **kwargs):
-    print(file=stderr, *args, **kwargs)
-
-# Scan through detail detail.html
-with open('demos/%d/detail.html' % id, 'r') as f:
-    mapflag = False
-    for line in f.readlines():
-        if mapflag:
-            m = mapname.search(line)
-            if m:
-                battlemap = m.group('name')
-                d('Found map:', battlemap)
-            else:
-                d('Whoops, something went wrong finding the map name!')
-            mapflag = False
-        if premap.search(line):
-            mapflag = True
-            continue
-        m = timestamp.search(line)
-        if not m:
-            m = timestamp_pre_2314.search(line)
-        if m:
-            started = '%s-%s-%s %s:%s:%s' % (m.group('year'), m.group('month'), m.group('day'), m.group('hours'), m.group('minutes'), m.group('seconds'))
-        m = userid.search(line)
-        if m:
-            name_to_userid[m.group('username')] = m.group('userid')
-
-mapdef = re.compile(r'\| maps/(?P<map>.*)\.html$')
-spver = re.compile(r'engine/linux64/(?P<spver>[^/]*)/')
-zkver = re.compile(r'\| games/(?P<zkver>Zero-K\\ [v0-9.]+)$')
-
-# Scan through the dependency information. This is derived from detail.html, but faster to read through here.
-with open('demos/%d/events.log.deps' % id, 'r') as f:
-    for line in f.readlines():
-        m = spver.search(line)
-        if m:
-            sp = m.group('spver')
-            continue
-        m = zkver.search(line)
-        if m:
-            zk = m.group('zkver').replace(r'\ ', ' ')
-            continue
-
-# Scan through the event log.
-with open(filename, 'r') as f:
-    for line in f.readlines():
-        m = playerinfo.match(line)
-        if m:
-            p = m.groupdict()
-            d('Found player', repr(p))
-            if p['name'] == '?':
-                d('Skipping spectator...')
+    if verbose:
+        print(file=stderr, *args, **kwargs)
+
+def scan_detail(id, base='.'):
+    '''
+    The map, start time, player name to userid mapping, and engine and game versions, from the battle's detail record.
+    '''
+    detail = load_detail(base, id)
+    d('Found map:', detail.map)
+    zk = detail.game if detail.game and zkver.fullmatch(detail.game) else None
+    return detail.map, detail.started, detail.players, detail.engine, zk
+
+def scan_events(f, stats=None):
+    '''
+    Scan through an open event log, closing it when done.
+
+    Lines are read one at a time, and reading stops as soon as we know the
+    outcome, so the (potentially huge) Game End Stats block is never read.
+
+    Returns (skip, win, duration, teamid_to_player, name_to_player, summary_only), where summary_only is whether the
+    log ended early, without the outcome, as logs simulated with SUMMARYONLY do.
+
+    With a stats dict, how many lines were read, and why the battle is skipped if it is, are recorded in it.
+    '''
+    win = None
+    duration = None
+    skip = False
+    skip_reason = None
+    summary_only = False
+    teamid_to_player = {}
+    name_to_player = {}
+    lines = 0
+    with f:
+        for lines, line in enumerate(f, 1):
+            tag, sep, message = line.partition('] ')
+            frame = tag[1:]
+            if not sep or tag[:1] != '[' or not (frame.isascii() and frame.isdigit()):
                 continue
-            p['facplop'] = []
-            teamid_to_player[p['teamid']] = p
-            name_to_player[p['name']] = p
-            continue
-        m = facplop.match(line)
-        if m:
-            d('Found facplop', repr(m.groupdict()))
-            p = teamid_to_player[m.group('teamid')]
-            p['facplop'].append(m.group('fac'))
-            continue
-        m = winner.match(line)
-        if m:
-            duration = m.group('frame')
-            win = m.group('name')
-            continue
-        for sc in skip_conditions:
-            if sc.satisfied(line):
-                d("Skip condition met: " + sc.why + ": " + line)
-                skip = True
+            if frame == '0' or frame == '1':
+                m = playerinfo.match(line)
+                if m:
+                    p = m.groupdict()
+                    d('Found player', repr(p))
+                    if p['name'] == '?':
+                        d('Skipping spectator...')
+                        continue
+                    p['facplop'] = []
+                    teamid_to_player[p['teamid']] = p
+                    name_to_player[p['name']] = p
+                    continue
+            if message.startswith(EVENT_PREFIX):
+                m = facplop.match(line)
+                if m:
+                    d('Found facplop', repr(m.groupdict()))
+                    p = teamid_to_player[m.group('teamid')]
+                    p['facplop'].append(m.group('fac'))
+                continue
+            if message.startswith(GAME_MESSAGE_PREFIX):
+                m = winner.match(line)
+                if m:
+                    duration = m.group('frame')
+                    win = m.group('name')
+                    continue
+            for sc in skip_conditions:
+                if sc.satisfied(message, win):
+                    d("Skip condition met: " + sc.why + ": " + line)
+                    skip = True
+                    skip_reason = sc.why
+                    break
+            if skip:
                 break
-        if skip:
-            break
-        if win is None:
-            continue
-        m = statsheader.match(line)
-        if m:
-            break
-
-if skip:
-    print(json.dumps({'skip': True}))
-    exit(0)
-
-if win is None:
-    d('WARNING: Could not find winner after reading file! What follows is probably garbage!')
+            if win is not None and message.startswith(STATS_HEADER_PREFIX):
+                break
+            if message.startswith(SUMMARY_COMPLETE_PREFIX):
+                summary_only = True
+                break
+    if stats is not None:
+        stats['lines'] = lines
+        stats['skip'] = skip_reason
+    return skip, win, duration, teamid_to_player, name_to_player, summary_only
+
+def summary_only_outcome(id, base='.'):
+    '''
+    (win, duration) for a log which ended before the game did: the winner from the detail record, and the duration
+    from the replay header. None for either if it's unknown.
+    '''
+    win = load_detail(base, id).winner
+    try:
+        header = sdfz.read(os.path.join(base, 'demos', str(id), 'replay.sdfz')).header
+    except (OSError, sdfz.ReplayError) as e:
+        d('Unreadable replay header:', e)
+        return win, None
+    return win, str(header.game_time * GAME_SPEED) if header.game_time else None
 
-def ensure_supplementary(player_data):
+def ensure_supplementary(player_data, name_to_userid):
     if 'userid' in player_data and player_data['userid'] is not None:
         return
     player_data['userid'] = name_to_userid[player_data['name']]
 
 
-def player_data_by_winning(name_to_player, win):
+def player_data_by_winning(name_to_player, win, name_to_userid):
     winning_player = name_to_player[win]
     losing_player = [p for p in name_to_player.values() if p['name'] != win][0]
-    ensure_supplementary(winning_player)
-    ensure_supplementary(losing_player)
+    ensure_supplementary(winning_player, name_to_userid)
+    ensure_supplementary(losing_player, name_to_userid)
     return winning_player, losing_player
 
 def truncate_if_numeric(v, truncate_to_bits=24):
@@ -186,38 +241,421 @@ def player_data_maps(name_to_player):
     # losing precision (yes, really - see Battle 855246 >_<;; )
     yield { truncate_if_numeric(k):v for k,v in name_to_player.items() }
 
-winning_player, losing_player = None,None
-err = None
-for m in player_data_maps(name_to_player):
+class Battle(object):
+    '''
+    What extractors read from. The detail record and events.log are each read at most once, and only if an extractor
+    asks for them.
+    '''
+    def __init__(self, filename, id, base='.', stats=None):
+        self.filename = filename
+        self.id = id
+        self.base = base
+        self.stats = stats
+
+    @cached_property
+    def detail(self):
+        # (map, started, name_to_userid, spring version, zk version)
+        return scan_detail(self.id, self.base)
+
+    @cached_property
+    def events(self):
+        # (skip, win, duration, teamid_to_player, name_to_player)
+        try:
+            f = open(self.filename, 'r')
+        except FileNotFoundError:
+            # Logs are packed once postprocessed. See: logpack.py
+            f = logpack.load(self.base).open(self.id)
+        skip, win, duration, teamid_to_player, name_to_player, summary_only = scan_events(f, self.stats)
+        if summary_only and not skip and win is None:
+            win, duration = summary_only_outcome(self.id, self.base)
+            if win is None or duration is None:
+                d('Skipping summary only log without a known winner and duration')
+                skip = True
+                if self.stats is not None:
+                    self.stats['skip'] = 'Summary only, no known winner and duration'
+        return skip, win, duration, teamid_to_player, name_to_player
+
+    @property
+    def skip(self):
+        return self.events[0]
+
+    @cached_property
+    def players(self):
+        '''
+        (winning player, losing player), as found in the events.log, with userids filled in from the detail record.
+        '''
+        skip, win, duration, teamid_to_player, name_to_player = self.events
+        name_to_userid = self.detail[2]
+
+        if win is None:
+            d('WARNING: Could not find winner after reading file! What follows is probably garbage!')
+
+        err = None
+        for m in player_data_maps(name_to_player):
+            try:
+                d('Trying',repr(m))
+                winning_player, losing_player = player_data_by_winning(m, win, name_to_userid)
+            except KeyError as e:
+                err = e
+                continue
+            break
+        else:
+            raise err
+
+        d('teamid', winning_player['teamid'], 'wins')
+        return winning_player, losing_player
+
+class Extractor(object):
+    '''
+    Fills in some of a summary's fields from a Battle.
+
+    Bump version whenever what extract returns changes, so existing summaries are brought up to date.
+    '''
+    def __init__(self, name, version, extract):
+        self.name = name
+        self.version = version
+        self.extract = extract
+
+# In the order they're run, and their fields appear in summaries
+EXTRACTORS = []
+
+def extractor(name, version):
+    def register(extract):
+        EXTRACTORS.append(Extractor(name, version, extract))
+        return extract
+    return register
+
+@extractor('outcome', 1)
+def extract_outcome(battle):
+    winning_player, losing_player = battle.players
+    return {
+        'winner_elo_lead': int(winning_player['elo']) - int(losing_player['elo']),
+        'winner_elo': int(winning_player['elo']),
+        'loser_elo': int(losing_player['elo']),
+        'winner_userid': winning_player['userid'],
+        'loser_userid': losing_player['userid'],
+        'duration': int(battle.events[2]),
+        'gameid': battle.id,
+    }
+
+@extractor('factories', 1)
+def extract_factories(battle):
+    winning_player, losing_player = battle.players
+    return {
+        'winner_fac': winning_player['facplop'][0] if len(winning_player['facplop']) else 'Never',
+        'winner_fac_prog': winning_player['facplop'],
+        'loser_fac': losing_player['facplop'][0] if len(losing_player['facplop']) else 'Never',
+        'loser_fac_prog': losing_player['facplop'],
+    }
+
+@extractor('detail', 1)
+def extract_detail(battle):
+    battlemap, started, name_to_userid, sp, zk = battle.detail
+    return {
+        'started': started,
+        'map': battlemap or 'Unknown',
+        'zk_version': zk,
+        'spring_version': sp,
+    }
+
+# Whether to use a battle at all is decided along with its outcome. If that changes, so might everything else.
+OUTCOME = 'outcome'
+
+# Summaries from before extractors were versioned are what version 1 of each extractor would have written
+LEGACY_VERSIONS = {'outcome': 1, 'factories': 1, 'detail': 1}
+
+def current_versions():
+    return {e.name: e.version for e in EXTRACTORS}
+
+def outdated_extractors(summary):
+    '''
+    The extractors whose version differs from the one recorded in summary.
+    '''
+    versions = summary.get('extractors', LEGACY_VERSIONS)
+    return [e for e in EXTRACTORS if versions.get(e.name) != e.version]
+
+def summarise(filename, id, base='.', previous=None, stats=None):
+    '''
+    Summarise a single battle, given the path to its events.log and its battle ID.
+
+    base is the shard directory that demos/ is found under.
+
+    With a previous summary of the battle, only the extractors that are outdated in it are run, and their fields merged
+    into it. A changed outcome extractor reruns everything.
+
+    With a stats dict, what was read of the events.log is recorded in it. See: scan_events
+
+    Returns the summary dict, or {'skip': True} if the battle should not be used, with the extractor versions used.
+    '''
+    battle = Battle(filename, id, base, stats)
+    outdated = outdated_extractors(previous) if previous is not None else EXTRACTORS
+    if previous is None or any(e.name == OUTCOME for e in outdated):
+        summary = {}
+        outdated = EXTRACTORS
+        skip = battle.skip
+    else:
+        summary = {k: v for k, v in previous.items() if k != 'extractors'}
+        skip = previous.get('skip', False)
+
+    if skip:
+        return {'skip': True, 'extractors': current_versions()}
+
+    for e in outdated:
+        d('Running extractor', e.name, 'version', e.version)
+        summary.update(e.extract(battle))
+    summary['extractors'] = current_versions()
+
+    d(repr(summary))
+
+    return summary
+
+#
+# Batch mode
+#
+
+def pending_battle_ids(base, force=False, store=None):
+    '''
+    Battle IDs in a shard with an events.log whose summary is missing or out of date.
+    With a store, summaries are looked up in it rather than stat'd as summary.json files.
+    '''
+    excluded = exclusions.load(os.path.join(base, '../../demos/exclude.txt'))
+    events = {}
+    with os.scandir(os.path.join(base, 'stats')) as it:
+        for entry in it:
+            if not entry.name.isdigit() or int(entry.name) in excluded:
+                continue
+            try:
+                events[int(entry.name)] = os.stat(os.path.join(entry.path, 'events.log')).st_mtime_ns
+            except FileNotFoundError:
+                continue
+    # A loose events.log is newer than any packed one
+    for entry in logpack.load(base).members('events.log'):
+        if entry.gameid not in excluded:
+            events.setdefault(entry.gameid, entry.mtime)
+    if force or not events:
+        return sorted(events)
+    if store is not None:
+        stored = store.source_mtimes(min(events), max(events))
+        return sorted(id for id, events_mtime in events.items() if stored.get(id, -1) < events_mtime)
+    ids = []
+    for id, events_mtime in events.items():
+        try:
+            summary_mtime = os.stat(os.path.join(base, 'summaries', str(id), 'summary.json')).st_mtime_ns
+            if summary_mtime >= events_mtime:
+                continue
+        except FileNotFoundError:
+            pass
+        ids.append(id)
+    return sorted(ids)
+
+def outdated_battle_ids(base, pending, store=None):
+    '''
+    Battle IDs in a shard, other than those pending, whose summary was built by an outdated extractor.
+    With a store, the store is queried instead of reading summary.json files.
+    '''
+    versions = current_versions()
+    excluded = exclusions.load(os.path.join(base, '../../demos/exclude.txt'))
+    if store is not None:
+        with os.scandir(os.path.join(base, 'stats')) as it:
+            gameids = [int(entry.name) for entry in it if entry.name.isdigit()]
+        gameids.extend(logpack.load(base).ids())
+        if not gameids:
+            return []
+        mismatched = store.mismatched(min(gameids), max(gameids), 'extractors', versions, LEGACY_VERSIONS)
+        return sorted(id for id in mismatched if id not in pending and id not in excluded)
+    try:
+        with open(os.path.join(base, 'summaries', 'extractors.json'), 'r') as f:
+            if json.load(f) == versions:
+                return []
+    except (FileNotFoundError, ValueError):
+        pass
+    ids = []
+    with os.scandir(os.path.join(base, 'summaries')) as it:
+        for entry in it:
+            if not entry.name.isdigit() or int(entry.name) in pending or int(entry.name) in excluded:
+                continue
+            try:
+                with open(os.path.join(entry.path, 'summary.json'), 'r') as f:
+                    summary = json.loads(f.read().strip() or '{}')
+            except (FileNotFoundError, ValueError):
+                continue
+            if summary and outdated_extractors(summary):
+                ids.append(int(entry.name))
+    return sorted(ids)
+
+def write_atomically(path, text):
+    '''
+    Write text to path via a temporary file in the same directory, so readers never see a partial file.
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def summarise_to_file(base, id, update=False):
+    '''
+    Worker entry point for batch mode. With update, only outdated extractors are rerun.
+    Returns (base, id, error, stats), stats being what summarise recorded, how many seconds it took, and whether the
+    battle is skipped.
+    '''
+    stats = {}
+    started = time.monotonic()
+    try:
+        previous = None
+        if update:
+            with open(os.path.join(base, 'summaries/%d/summary.json' % id), 'r') as f:
+                previous = json.load(f)
+        summary = summarise(os.path.join(base, 'stats/%d/events.log' % id), id, base, previous, stats)
+        # The summaries symlink may point to a per-shard directory that doesn't exist yet
+        os.makedirs(os.path.join(os.path.realpath(os.path.join(base, 'summaries')), str(id)), exist_ok=True)
+        write_atomically(os.path.join(base, 'summaries/%d/summary.json' % id), json.dumps(summary) + '\n')
+    except Exception as e:
+        return base, id, '%s: %s' % (type(e).__name__, e), stats
+    stats['seconds'] = time.monotonic() - started
+    stats['skipped'] = summary.get('skip', False)
+    return base, id, None, stats
+
+def summarise_for_store(base, id, previous=None):
+    '''
+    Worker entry point for batch mode with a store. With a previous summary, only outdated extractors are rerun.
+    Returns (id, events mtime, summary, error, stats), as for summarise_to_file.
+    '''
+    events = os.path.join(base, 'stats/%d/events.log' % id)
+    stats = {}
+    started = time.monotonic()
+    try:
+        # Taken before reading, so a log rewritten while we read it is picked up next time
+        mtime = logpack.log_mtime(base, id)
+        summary = summarise(events, id, base, previous, stats)
+    except Exception as e:
+        return id, None, None, '%s: %s' % (type(e).__name__, e), stats
+    stats['seconds'] = time.monotonic() - started
+    stats['skipped'] = summary.get('skip', False)
+    return id, mtime, summary, None, stats
+
+def batch_metrics():
+    '''
+    What batch mode records, per battle, for --metrics.
+    '''
+    m = Metrics('postprocess')
+    m.histogram('battle_seconds', 'Time to summarise a battle, from scratch or by updating outdated extractors', SECONDS)
+    m.histogram('lines_scanned', 'Lines of events.log read to summarise a battle', (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000))
+    m.counter('battles_total', 'Battles summarised, by result')
+    m.counter('skipped_total', 'Battles summarised as skipped, by reason')
+    return m
+
+def record_metrics(metrics, mode, err, stats):
+    '''
+    Record one battle's result and stats.
+    '''
+    if err is not None:
+        metrics.inc('battles_total', result='failed', mode=mode)
+        return
+    metrics.observe('battle_seconds', stats['seconds'], mode=mode)
+    if 'lines' in stats:
+        metrics.observe('lines_scanned', stats['lines'])
+    if stats['skipped']:
+        metrics.inc('battles_total', result='skipped', mode=mode)
+        # No reason when a battle already known to be skipped was only updated
+        metrics.inc('skipped_total', reason=stats.get('skip') or 'Previously skipped')
+    else:
+        metrics.inc('battles_total', result='summarised', mode=mode)
+
+def _init_worker(be_verbose):
+    global verbose
+    verbose = be_verbose
+
+def batch(shards, ids=None, jobs=None, force=False, be_verbose=False, db=None, metrics=None):
+    '''
+    Summarise many battles across a pool of worker processes.
+    With db, summaries go into that summary database rather than summary.json files.
+    With metrics, each battle's time, lines read and result are recorded in it.
+
+    Battles with a new or changed events.log are summarised from scratch. Unless given ids, existing summaries with an
+    outdated extractor then have just those extractors rerun.
+
+    Returns the number of battles which failed.
+    '''
+    store = SummaryStore(db) if db else None
+    work = []
+    updates = []
+    for base in shards:
+        if ids:
+            work.extend((base, id) for id in ids if os.path.exists(os.path.join(base, 'stats/%d/events.log' % id)) or id in logpack.load(base))
+        else:
+            pending = pending_battle_ids(base, force, store)
+            work.extend((base, id) for id in pending)
+            if not force:
+                updates.extend((base, id) for id in outdated_battle_ids(base, set(pending), store))
+    print('Summarising %d battles, and updating %d, across %d shards' % (len(work), len(updates), len(shards)), file=stderr)
+    failed = 0
+    # Shards with an update that failed, so whose summaries aren't all up to date yet
+    incomplete = set()
+    # Only this process writes to the store, in batches, so workers never contend for it
+    stored = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(be_verbose,)) as pool:
+        # Future -> the shard it updates, or None for a battle summarised from scratch
+        if store is None:
+            futures = {pool.submit(summarise_to_file, base, id): None for base, id in work}
+            futures |= {pool.submit(summarise_to_file, base, id, True): base for base, id in updates}
+        else:
+            futures = {pool.submit(summarise_for_store, base, id): None for base, id in work}
+            futures |= {pool.submit(summarise_for_store, base, id, store.get(id)): base for base, id in updates}
+        for future in as_completed(futures):
+            if store is None:
+                base, id, err, stats = future.result()
+            else:
+                id, mtime, summary, err, stats = future.result()
+                base = db
+                if err is None:
+                    stored.append(StoredSummary(id, mtime, summary))
+                    if len(stored) >= STORE_BATCH_SIZE:
+                        store.put_many(stored)
+                        stored = []
+            if err is not None:
+                failed += 1
+                if futures[future] is not None:
+                    incomplete.add(futures[future])
+                print('Failed to summarise %s battle %d: %s' % (base, id, err), file=stderr)
+            if metrics is not None:
+                record_metrics(metrics, 'new' if futures[future] is None else 'update', err, stats)
+    if store is not None:
+        if stored:
+            store.put_many(stored)
+        store.close()
+    elif not ids:
+        versions = json.dumps(current_versions()) + '\n'
+        for base in shards:
+            if base not in incomplete:
+                os.makedirs(os.path.realpath(os.path.join(base, 'summaries')), exist_ok=True)
+                write_atomically(os.path.join(base, 'summaries', 'extractors.json'), versions)
+    print('Summarised %d battles, %d failed' % (len(work) + len(updates) - failed, failed), file=stderr)
+    return failed
+
+def main():
+    # Single battle mode keeps its historical positional interface
+    if len(argv) == 3 and not argv[1].startswith('-'):
+        print(json.dumps(summarise(argv[1], int(argv[2]))))
+        exit(0)
+
+    parser = ArgumentParser(description='Summarise simulated replays')
+    parser.add_argument('--batch', action='store_true', required=True, help='Process whole shards in one interpreter')
+    parser.add_argument('shards', nargs='+', help='Shard directories to process, eg: shards/160')
+    parser.add_argument('--ids', type=int, nargs='+', default=None, help='Only process these battle IDs (default: all pending)')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', '-f', action='store_true', help='Resummarise battles from scratch, even if the summary is up to date')
+    parser.add_argument('--db', default=None, help='Write summaries to this summary database instead of summary.json files, eg: summaries/summaries.db')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Print per-battle diagnostics')
+    parser.add_argument('--metrics', default=None, help='Write textfile metrics and a run report to this directory, eg: metrics (default: none)')
+    args = parser.parse_args()
+    run_metrics = batch_metrics() if args.metrics else None
+    failed = None
     try:
-        d('Trying',repr(m))
-        winning_player, losing_player = player_data_by_winning(m, win)
-    except KeyError as e:
-        err = e
-        continue
-    break
-else:
-    raise err
-
-d('teamid', winning_player['teamid'], 'wins')
-
-summary = {}
-summary['winner_elo_lead'] = int(winning_player['elo']) - int(losing_player['elo'])
-summary['winner_elo'] = int(winning_player['elo'])
-summary['loser_elo'] = int(losing_player['elo'])
-summary['winner_fac'] = winning_player['facplop'][0] if len(winning_player['facplop']) else 'Never'
-summary['winner_fac_prog'] = winning_player['facplop']
-summary['loser_fac'] = losing_player['facplop'][0] if len(losing_player['facplop']) else 'Never'
-summary['loser_fac_prog'] = losing_player['facplop']
-summary['winner_userid'] = winning_player['userid']
-summary['loser_userid'] = losing_player['userid']
-summary['duration'] = int(duration)
-summary['gameid'] = id
-summary['started'] = started
-summary['map'] = battlemap or 'Unknown'
-summary['zk_version'] = zk
-summary['spring_version'] = sp
-
-d(repr(summary))
-
-print(json.dumps(summary))
+        failed = batch(args.shards, args.ids, args.jobs, args.force, args.verbose, args.db, run_metrics)
+    finally:
+        if run_metrics is not None:
+            run_metrics.write(args.metrics, success=failed == 0)
+    exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
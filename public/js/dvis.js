@@ -2,8 +2,8 @@ var dv = (function(dv) {
   "use strict";
   const hash = window.location.hash;
   const local = hash.substring(hash.indexOf('#')+1).split('|');
-  /* Cap factory progression depth */
-  const fac_progression_max = 5;
+  /* Cap factory progression depth, unless overridden by fac_progression_max in the configuration */
+  const default_fac_progression_max = 5;
   function assignWhr(match, fullWhrByMatch, fullWhrSkipped, fullWhrMissing) {
     const whrdata = fullWhrByMatch[match.gameid];
     if (whrdata) {
@@ -30,9 +30,9 @@ var dv = (function(dv) {
       } else {
         match.has_fullwhr = "UserID mismatch";
       }
-    } else if (fullWhrSkipped.includes(match.gameid)) {
+    } else if (fullWhrSkipped.has(match.gameid)) {
       match.has_fullwhr = "Skipped (Causing server error)";
-    } else if (fullWhrMissing.includes(match.gameid)) {
+    } else if (fullWhrMissing.has(match.gameid)) {
       match.has_fullwhr = "Missing (Silently ignored by server)";
     } else {
       match.has_fullwhr = "No data";
@@ -56,6 +56,7 @@ var dv = (function(dv) {
   }
   /* Coerce our data file before use elsewhere */
   function dataCoerce(data, config, mapTypes, fullWhr, fullWhrSkipped, fullWhrMissing) {
+    const fac_progression_max = config.fac_progression_max || default_fac_progression_max;
     const fac_progression_dch_fixup = a => {
       /* Strip duplicates */
       a = a.reduce((a,d) => a.includes(d) ? a : (a.push(d), a), []);
@@ -75,13 +76,22 @@ var dv = (function(dv) {
         fullWhrByMatch[match.id] = whrByPlayer;
       }
     }
+    const fullWhrSkippedSet = new Set(fullWhrSkipped);
+    const fullWhrMissingSet = new Set(fullWhrMissing);
     const ret = [];
     for (let match of data) {
       if (match.skip) {
         continue;
       }
-      if (local.includes("fullwhr")) {
-        assignWhr(match, fullWhrByMatch, fullWhrSkipped, fullWhrMissing);
+      /* Records with WHR joined server side (see whrjoin.py) already have it */
+      if (local.includes("fullwhr") && !('has_fullwhr' in match)) {
+        assignWhr(match, fullWhrByMatch, fullWhrSkippedSet, fullWhrMissingSet);
+      }
+
+      /* Records enriched server side (see enrich.py) already have everything below */
+      if ('map_type' in match) {
+        ret.push(match);
+        continue;
       }
 
       /* Track mirror match states for use as its own dimension. */
@@ -142,23 +152,28 @@ var dv = (function(dv) {
   dv.init = async function(configloc) {
     /* Fetch our configuration and data, coercing them as we go */
     let globalConfig = await d3.json(configloc);
-    let [data, mapTypes, fullWhr, fullWhrSkipped, fullWhrMissing] = await Promise.all([
-      d3.json(globalConfig.src),
+    /* With #server, groups come from queryserver.py rather than every match being downloaded. See: js/util/query.js */
+    const server = local.includes("server");
+    let [data, mapTypes] = await Promise.all([
+      server ? Promise.resolve([]) : columnar.load(globalConfig.src),
       d3.json("data/map-types.json"),
-      ...local.includes("fullwhr")
-        ? [
-          d3.json("data/fullwhr.json"),
-          d3.json("data/fullwhr-skipped.json"),
-          d3.json("data/fullwhr-missing.json"),
-        ]
-        : [Promise.resolve([]), Promise.resolve([]), Promise.resolve([])],
     ]);
+    /* Only download the full WHR data if some records weren't joined server side. See: whrjoin.py */
+    const whrUnjoined = local.includes("fullwhr") && data.some(match => !match.skip && !('has_fullwhr' in match));
+    const [fullWhr, fullWhrSkipped, fullWhrMissing] = whrUnjoined
+      ? await Promise.all([
+        d3.json("data/fullwhr.json"),
+        d3.json("data/fullwhr-skipped.json"),
+        d3.json("data/fullwhr-missing.json"),
+      ])
+      : [[], [], []];
 
     globalConfig = configCoerce(globalConfig);
     data = dataCoerce(data, globalConfig, mapTypes, fullWhr, fullWhrSkipped, fullWhrMissing);
 
     window.data = data;
-    const cfdata = crossfilter(data);
+    const remote = server ? await query.connect(globalConfig.query || "query") : null;
+    const cfdata = remote || crossfilter(data);
     window.cfdata = cfdata;
     const vis = d3.select("#vis");
     /* Track which dimensions we've created */
@@ -173,6 +188,15 @@ var dv = (function(dv) {
       if (heap.has(dl)) {
         return heap.get(dl);
       }
+      if (remote) {
+        /* Grouped, reduced and filtered server side. Dates arrive as naive ISO strings, read back as local time. */
+        const ret = {
+          dim: remote.dimension(dl),
+          group: remote.group(dl, conf.dates ? k => new Date(k) : undefined)
+        };
+        heap.set(dl, ret);
+        return ret;
+      }
       const d = cfdata.dimension(coerce);
       let grouper;
       if (conf.group) {
@@ -478,6 +502,9 @@ var dv = (function(dv) {
       ret
         .transitionDuration(500)
         ;
+      if (remote) {
+        ret.filterHandler(remote.filterHandler);
+      }
       charts.set(dimId(conf), ret);
       return ret;
     }
@@ -0,0 +1,95 @@
+/* Loader for the dictionary encoded columnar export. Expands it back into the row records crossfilter expects. See export_columnar.py */
+var columnar = (function(columnar) {
+  "use strict";
+  const pad = n => (n < 10 ? '0' : '') + n;
+  /* Timestamps were stored as if UTC; format them back to the "YYYY-MM-DD HH:MM:SS" form postprocess.py emits */
+  function formatStarted(t) {
+    const d = new Date(t * 1000);
+    return `${d.getUTCFullYear()}-${pad(d.getUTCMonth() + 1)}-${pad(d.getUTCDate())} ${pad(d.getUTCHours())}:${pad(d.getUTCMinutes())}:${pad(d.getUTCSeconds())}`;
+  }
+  /* Fields the exporter may omit, recomputed from the record */
+  const derivers = {
+    winner_elo_lead: r => r.winner_elo - r.loser_elo,
+    winner_fac: r => r.winner_fac_prog.length ? r.winner_fac_prog[0] : 'Never',
+    loser_fac: r => r.loser_fac_prog.length ? r.loser_fac_prog[0] : 'Never',
+    mirror_match: r => r.winner_fac === r.loser_fac,
+  };
+  /* Per step factory progression fields, eg winner_fac3 */
+  const facStep = /^(winner|loser)_fac([1-9][0-9]*)$/;
+  function deriver(name) {
+    if (name in derivers) {
+      return derivers[name];
+    }
+    const m = facStep.exec(name);
+    const prog = m[1] + '_fac_prog', depth = m[2] - 1;
+    return r => r[prog][depth] || 'Never';
+  }
+  /* Column decoders. Each fills in column.name on every row. */
+  const decoders = {
+    int: (rows, col) => {
+      for (let i = 0; i < rows.length; ++i) {
+        rows[i][col.name] = col.data[i];
+      }
+    },
+    delta: (rows, col) => {
+      let acc = 0;
+      for (let i = 0; i < rows.length; ++i) {
+        acc += col.data[i];
+        rows[i][col.name] = acc;
+      }
+    },
+    str: (rows, col, table) => {
+      for (let i = 0; i < rows.length; ++i) {
+        const v = col.data[i];
+        rows[i][col.name] = v === null ? null : table[v];
+      }
+    },
+    strlist: (rows, col, table) => {
+      for (let i = 0; i < rows.length; ++i) {
+        rows[i][col.name] = col.data[i].map(v => table[v]);
+      }
+    },
+    datetime: (rows, col) => {
+      for (let i = 0; i < rows.length; ++i) {
+        const v = col.data[i];
+        rows[i][col.name] = v === null ? null : formatStarted(v);
+      }
+    },
+    raw: (rows, col) => {
+      for (let i = 0; i < rows.length; ++i) {
+        rows[i][col.name] = col.data[i];
+      }
+    },
+  };
+  /* Whether a loaded payload is in the columnar format, rather than an array of records */
+  columnar.is = function(payload) {
+    return payload !== null && !Array.isArray(payload) && payload.format === 'zkstats-columnar';
+  };
+  /* Expand a columnar payload into an array of records */
+  columnar.decode = function(payload) {
+    if (payload.version !== 1) {
+      throw new Error(`Unsupported columnar format version ${payload.version}`);
+    }
+    const rows = new Array(payload.length);
+    for (let i = 0; i < payload.length; ++i) {
+      rows[i] = {};
+    }
+    for (let col of payload.columns) {
+      decoders[col.type](rows, col, col.table ? payload.tables[col.table] : undefined);
+    }
+    /* Derived fields may depend on each other (mirror_match needs winner_fac), so go in the exporter's order */
+    for (let name of payload.derived) {
+      const derive = deriver(name);
+      for (let row of rows) {
+        row[name] = derive(row);
+      }
+    }
+    return rows;
+  };
+  /* Fetch a dataset, which may be either format, and return an array of records */
+  columnar.load = async function(url) {
+    const payload = await d3.json(url);
+    return columnar.is(payload) ? columnar.decode(payload) : payload;
+  };
+  return columnar;
+}(columnar || {}));
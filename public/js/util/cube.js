@@ -0,0 +1,84 @@
+/* Loader for the precomputed matchup count cube. See cube.py. Not loaded by index.html: every chart there filters one crossfilter of the matches. */
+var cube = (function(cube) {
+  "use strict";
+  const arrayTypes = { uint16: Uint16Array, uint32: Uint32Array };
+  /* Wrap a loaded header and count array with slicing helpers */
+  function Cube(header, counts) {
+    this.header = header;
+    this.dims = header.dims;
+    this.shape = header.shape;
+    this.counts = counts;
+    /* Row-major strides, so counts[sum(index[i] * strides[i])] is the cell at index */
+    this.strides = [];
+    let stride = 1;
+    for (let i = this.shape.length - 1; i >= 0; --i) {
+      this.strides[i] = stride;
+      stride *= this.shape[i];
+    }
+  }
+  /*
+   * Winner by loser match counts, summed over every other axis subject to filters.
+   * filters maps an axis name to a predicate over that axis' labels, eg { month: m => m >= "2020-01" }
+   * Returns a nested array, result[winner][loser], indexed in the order of the fac labels.
+   */
+  Cube.prototype.matchups = function(filters = {}) {
+    const [nw, nl] = this.shape;
+    const result = Array.from({ length: nw }, () => new Array(nl).fill(0));
+    /* Precompute which positions along each remaining axis pass the filters */
+    const allowed = this.dims.map(dim => dim.labels.map(label => !(dim.name in filters) || filters[dim.name](label)));
+    const inner = this.strides[1];
+    for (let w = 0; w < nw; ++w) {
+      if (!allowed[0][w]) continue;
+      for (let l = 0; l < nl; ++l) {
+        if (!allowed[1][l]) continue;
+        const base = w * this.strides[0] + l * this.strides[1];
+        let sum = 0;
+        /* Walk every cell of the remaining axes for this winner/loser pair */
+        for (let offset = 0; offset < inner; ++offset) {
+          let ok = true;
+          let rem = offset;
+          for (let axis = 2; axis < this.shape.length; ++axis) {
+            const pos = Math.floor(rem / this.strides[axis]);
+            rem -= pos * this.strides[axis];
+            if (!allowed[axis][pos]) {
+              ok = false;
+              break;
+            }
+          }
+          if (ok) {
+            sum += this.counts[base + offset];
+          }
+        }
+        result[w][l] = sum;
+      }
+    }
+    return result;
+  };
+  /*
+   * The matchups in the same form as dvis.js' triangle group: keys of the form [lower, higher],
+   * values of the form [lower wins, lower losses], with mirror matches counted as both.
+   */
+  Cube.prototype.triangle = function(filters = {}) {
+    const facs = this.dims[0].labels;
+    const m = this.matchups(filters);
+    const ret = [];
+    for (let i = 0; i < facs.length; ++i) {
+      for (let j = 0; j < facs.length; ++j) {
+        if (facs[i] > facs[j]) continue;
+        const wins = m[i][j], losses = i === j ? m[i][j] : m[j][i];
+        if (wins || losses) {
+          ret.push({ key: [facs[i], facs[j]], value: [wins, losses] });
+        }
+      }
+    }
+    return ret;
+  };
+  /* Fetch a cube header, and the gzipped body it refers to, resolved relative to the header */
+  cube.load = async function(url) {
+    const header = await d3.json(url);
+    const response = await fetch(new URL(header.body, new URL(url, window.location.href)));
+    const body = await new Response(response.body.pipeThrough(new DecompressionStream("gzip"))).arrayBuffer();
+    return new Cube(header, new arrayTypes[header.dtype](body));
+  };
+  return cube;
+}(cube || {}));
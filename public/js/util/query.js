@@ -0,0 +1,96 @@
+/* Remote stand-in for crossfilter, backed by queryserver.py. See queryserver.py */
+var query = (function(query) {
+  "use strict";
+  /* Naive seconds since the epoch of a local Date, as started is stored and queryserver.py filters on */
+  const naiveSeconds = d => Date.UTC(d.getFullYear(), d.getMonth(), d.getDate(), d.getHours(), d.getMinutes(), d.getSeconds()) / 1000;
+  const filterValue = v => v instanceof Date ? naiveSeconds(v) : v;
+  /* A dc filter, as queryserver.py takes them */
+  function encodeFilter(f) {
+    if (f.filterType === 'RangedFilter') {
+      return { range: [filterValue(f[0]), filterValue(f[1])] };
+    }
+    if (f instanceof Array) {
+      return f.slice().sort();
+    }
+    return f;
+  }
+  function Remote(url) {
+    this.url = url;
+    this.filters = {};
+    this.response = null;
+    /* Only the latest request's response is shown, whatever order they arrive in */
+    this.sequence = 0;
+    /* dc calls this with a chart's dimension and filters, in place of filtering a crossfilter dimension */
+    this.filterHandler = (dimension, filters) => {
+      this.filters[dimension.id] = filters.map(encodeFilter);
+      this.refresh().then(changed => changed && dc.redrawAll());
+      return filters;
+    };
+  }
+  /* Fetch groups for the current filters. Resolves to whether they're the latest. */
+  Remote.prototype.refresh = async function() {
+    const sequence = ++this.sequence;
+    const filters = {};
+    for (let id in this.filters) {
+      if (this.filters[id].length) {
+        filters[id] = this.filters[id];
+      }
+    }
+    const response = await d3.json(this.url, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ filters: filters }),
+    });
+    if (sequence !== this.sequence) {
+      return false;
+    }
+    this.response = response;
+    return true;
+  };
+  Remote.prototype.size = function() {
+    return this.response.size;
+  };
+  Remote.prototype.groupAll = function() {
+    return { value: () => this.response.count };
+  };
+  /*
+   * A dimension, as far as dc's charts use them.
+   * top and bottom give the records chart's battles if there is one, or else the dimension's extent, as { [id]: value }.
+   */
+  Remote.prototype.dimension = function(id) {
+    const remote = this;
+    const ends = (n, end) => {
+      if (id in remote.response.records) {
+        return remote.response.records[id].slice(0, n);
+      }
+      const extent = remote.response.extents[id];
+      return extent ? [{ [id]: extent[end] }] : [];
+    };
+    return {
+      id: id,
+      top: n => ends(n, 1),
+      bottom: n => ends(n, 0),
+      /* Filtering happens through filterHandler, so these are no-ops */
+      filter: () => {},
+      filterAll: () => {},
+      dispose: () => {},
+    };
+  };
+  /* A group, with keys optionally transformed, eg into Dates */
+  Remote.prototype.group = function(id, keyTransform = k => k) {
+    const remote = this;
+    const all = () => (remote.response.groups[id] || []).map(([key, value]) => ({ key: keyTransform(key), value: value }));
+    return {
+      all: all,
+      top: n => all().sort((l, r) => r.value - l.value).slice(0, n),
+      size: () => (remote.response.groups[id] || []).length,
+    };
+  };
+  /* Connect to a queryserver.py, resolving once the unfiltered groups have arrived */
+  query.connect = async function(url) {
+    const remote = new Remote(url);
+    await remote.refresh();
+    return remote;
+  };
+  return query;
+}(query || {}));
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+'''
+Serve the dashboard's filtered group counts from memory, so the browser
+doesn't need to download every match.
+
+Inputs:
+    summaries/all.json (or any file of summaries, enriched or not, see enrich.py)
+    public/data/config.json
+    public/data/map-types.json
+
+Outputs:
+    HTTP: the public/ directory, and /query
+
+Summaries are held column by column: every chart dimension in config.json
+becomes an array of small integer codes into its sorted group keys, plus
+the raw values bar charts filter ranges on. Keys follow what dvis.js would
+have made of each record in the browser: pie keys are the value as a
+string, bar keys are bucketed by the chart's group size or time interval,
+and the triangle matchups group counts [lower wins, lower losses] for each
+[lower, higher] pair of factories.
+
+A query gives the active filters of each dimension, keyed by the chart's
+dimension ID, and gets back the groups of every chart. As in crossfilter,
+each chart's groups observe every filter except its own:
+    POST /query {"filters": {"map": ["Comet Catcher Redux v3.1"], "duration": [{"range": [900, 1800]}],
+                             "matchups": [["Cloakbot Factory", "Tank Foundry"]]}}
+    {"size": 1424, "count": 12, "groups": {"map": [["Comet Catcher Redux v3.1", 12], ...], ...},
+     "records": {"gameid": [{"gameid": 1606223}, ...]}, "extents": {"duration": [450, 96000], ...}}
+GET /query?filters=... takes the same filters, URL encoded. Responses to
+the most recent filter states are kept in an LRU cache. When the summaries
+file changes, it's reloaded on the next query, and the cache dropped.
+
+Times are naive, as in the summaries: started is grouped by the chart's
+d3 interval (eg Week rounds to the nearest Sunday) without regard to time
+zone, group keys are "YYYY-MM-DDTHH:MM:SS", and range filters on them are
+seconds since 1970-01-01 00:00:00 in that same naive time.
+
+Sunburst charts aren't supported in this mode, and the WHR charts are only
+filled in if aggregate.py joined the ratings on (see: whrjoin.py).
+See: public/js/util/query.js
+
+Usage:
+    queryserver.py [--port 8000] [--src summaries/all.json]
+    Then open http://localhost:8000/#server
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import os
+import re
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from enrich import Enricher
+
+# Seconds in each fixed length d3 time interval config.json may group by
+FIXED_INTERVALS = {'Second': 1, 'Minute': 60, 'Hour': 3600, 'Day': 86400}
+LEADING_INT = re.compile(r'\s*([-+]?[0-9]+)')
+
+
+def js_string(value: object) -> str:
+    '''
+    What JavaScript's "" + value gives for a JSON value.
+    '''
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, list):
+        return ','.join('' if v is None else js_string(v) for v in value)
+    return str(value)
+
+
+def js_parse_int(value: object) -> int:
+    '''
+    What JavaScript's parseInt(value) || 0 gives for a JSON value.
+    '''
+    if isinstance(value, bool) or value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value) if math.isfinite(value) else 0
+    m = LEADING_INT.match(str(value))
+    return int(m.group(1)) if m else 0
+
+
+def naive_seconds(values: list) -> np.ndarray:
+    '''
+    "YYYY-MM-DD HH:MM:SS" strings as seconds since the epoch, taken as naive. Missing values are NaT.
+    '''
+    return np.array([v if isinstance(v, str) and v else 'NaT' for v in values], dtype='M8[s]')
+
+
+def round_to_interval(times: np.ndarray, interval: str) -> np.ndarray:
+    '''
+    d3.time<interval>.round, in naive time: the nearer of the interval boundaries either side.
+    '''
+    t = times.astype(np.int64)
+    if interval in FIXED_INTERVALS:
+        step = FIXED_INTERVALS[interval]
+        floor = t // step * step
+        ceil = floor + step
+    elif interval == 'Week':
+        # Weeks start on Sunday. 1970-01-01 was a Thursday.
+        days = t // 86400
+        floor = (days - (days + 4) % 7) * 86400
+        ceil = floor + 7 * 86400
+    elif interval in ('Month', 'Year'):
+        unit = 'M8[M]' if interval == 'Month' else 'M8[Y]'
+        start = times.astype(unit)
+        floor = start.astype('M8[s]').astype(np.int64)
+        ceil = (start + 1).astype('M8[s]').astype(np.int64)
+    else:
+        raise ValueError(f"Unsupported time interval {interval}")
+    ceil = np.where(t == floor, floor, ceil)
+    return np.where(t - floor < ceil - t, floor, ceil).astype('M8[s]')
+
+
+@dataclass(slots=True)
+class Dimension:
+    '''
+    One chart's dimension: a group index per record, and how to filter records.
+    '''
+    id: str
+    vis: str
+    # Group keys, sorted, as sent to the client
+    keys: list = field(default_factory=list)
+    # Index into keys per record, or -1 if the record is in no group
+    index: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    # What range filters compare against, for bar charts
+    values: np.ndarray | None = None
+    extent: list | None = None
+    # Per record increments to [lower wins, lower losses], for the triangle group
+    weights: tuple[np.ndarray, np.ndarray] | None = None
+    # Keys reduced to 0, from the chart's ignore_values
+    ignore: set[int] = field(default_factory=set)
+
+    def filter(self, filters: list) -> np.ndarray:
+        '''
+        Records passing any of the filters, each a key, a [lower, higher] pair, or {"range": [low, high]}.
+        '''
+        positions = {key if not isinstance(key, list) else tuple(key): i for i, key in enumerate(self.keys)}
+        wanted = []
+        mask = np.zeros(len(self.index), dtype=bool)
+        for f in filters:
+            if isinstance(f, dict):
+                if self.values is None:
+                    raise ValueError(f"{self.id} can't be filtered by range")
+                low, high = f['range']
+                mask |= (self.values >= low) & (self.values < high)
+            else:
+                key = tuple(f) if isinstance(f, list) else f
+                if key in positions:
+                    wanted.append(positions[key])
+        if wanted:
+            mask |= np.isin(self.index, wanted)
+        return mask
+
+    def group(self, mask: np.ndarray) -> list:
+        '''
+        [key, value] for every group, counting only records in mask.
+        '''
+        index = self.index[mask]
+        valid = index >= 0
+        if self.weights is not None:
+            wins = np.bincount(index[valid], weights=self.weights[0][mask][valid], minlength=len(self.keys))
+            losses = np.bincount(index[valid], weights=self.weights[1][mask][valid], minlength=len(self.keys))
+            return [[key, [int(w), int(l)]] for key, w, l in zip(self.keys, wins, losses)]
+        counts = np.bincount(index[valid], minlength=len(self.keys))
+        return [[key, 0 if i in self.ignore else int(count)] for i, (key, count) in enumerate(zip(self.keys, counts))]
+
+
+def encode(keys_per_record: list) -> tuple[list, np.ndarray]:
+    '''
+    Sorted distinct keys, and each record's index into them. None means no group.
+    '''
+    keys = sorted({key for key in keys_per_record if key is not None})
+    positions = {key: i for i, key in enumerate(keys)}
+    index = np.array([-1 if key is None else positions[key] for key in keys_per_record], dtype=np.int32)
+    return keys, index
+
+
+def build_dimension(conf: dict, records: list[dict]) -> Dimension | None:
+    vis = conf['vis']
+    dim = conf['dim']
+    dim_id = (dim['id'] if isinstance(dim, dict) else dim).lower()
+    if vis in ('count', 'records'):
+        # Neither is grouped. See: Dataset.records
+        return None
+    if vis == 'matchups':
+        rows = [js_string(r.get(dim['rows'])) for r in records]
+        cols = [js_string(r.get(dim['cols'])) for r in records]
+        # Keys are [lower, higher], by JavaScript's default sort of the pair
+        pairs = [(min(row, col), max(row, col)) for row, col in zip(rows, cols)]
+        keys, index = encode(pairs)
+        wins = np.array([row <= col for row, col in zip(rows, cols)], dtype=np.float64)
+        losses = np.array([col <= row for row, col in zip(rows, cols)], dtype=np.float64)
+        return Dimension(dim_id, vis, [list(key) for key in keys], index, weights=(wins, losses))
+    if vis in ('bar', 'bar-fixed'):
+        if conf.get('dates'):
+            times = naive_seconds([r.get(dim_id) for r in records])
+            grouped = round_to_interval(times, conf['group']) if conf.get('group') else times
+            valid = ~np.isnat(grouped)
+            keys = np.unique(grouped[valid])
+            index = np.full(len(records), -1, dtype=np.int32)
+            index[valid] = np.searchsorted(keys, grouped[valid])
+            present = times[~np.isnat(times)]
+            extent = [str(present.min()), str(present.max())] if len(present) else None
+            return Dimension(dim_id, vis, [str(key) for key in keys], index, times.astype(np.int64).astype(np.float64), extent)
+        values = np.array([js_parse_int(r.get(dim_id)) for r in records], dtype=np.int64)
+        grouped = values // conf['group'] * conf['group'] if conf.get('group') else values
+        keys, inverse = np.unique(grouped, return_inverse=True)
+        extent = [int(values.min()), int(values.max())] if len(values) else None
+        return Dimension(dim_id, vis, keys.tolist(), inverse.astype(np.int32), values, extent)
+    if vis == 'pie':
+        keys, index = encode([js_string(r.get(dim_id)) if dim_id in r else 'undefined' for r in records])
+        ignore_values = conf.get('ignore_values', [])
+        ignore_values = ignore_values if isinstance(ignore_values, list) else [ignore_values]
+        ignore = {keys.index(js_string(v)) for v in ignore_values if js_string(v) in keys}
+        return Dimension(dim_id, vis, keys, index, ignore=ignore)
+    logging.warning(f"Chart {dim_id}: {vis} charts aren't supported, leaving it empty")
+    return Dimension(dim_id, vis, [], np.full(len(records), -1, dtype=np.int32))
+
+
+class Dataset:
+    '''
+    The summaries, as chart dimensions.
+    '''
+    def __init__(self, records: list[dict], config: dict) -> None:
+        self.size = len(records)
+        self.dimensions: dict[str, Dimension] = {}
+        # Records charts: dimension ID -> (sort values, descending, columns to return, how many)
+        self.tables: dict[str, tuple[np.ndarray, bool, dict[str, list], int]] = {}
+        for column in config['columns']:
+            for conf in column['charts']:
+                dim = build_dimension(conf, records)
+                if dim is not None:
+                    self.dimensions[dim.id] = dim
+                elif conf['vis'] == 'records':
+                    dim_id = conf['dim'].lower()
+                    props = {c['prop'] for c in conf.get('columns', [])} | {dim_id}
+                    order = np.array([js_parse_int(r.get(dim_id)) for r in records], dtype=np.int64)
+                    self.tables[dim_id] = (order, conf.get('order') == 'descending', {p: [r.get(p) for r in records] for p in props}, conf.get('count', 30))
+
+    def query(self, filters: dict[str, list]) -> dict:
+        for dim_id in filters:
+            if dim_id not in self.dimensions:
+                raise ValueError(f"No such dimension: {dim_id}")
+        masks = {dim_id: self.dimensions[dim_id].filter(f) for dim_id, f in filters.items() if f}
+        everything = np.ones(self.size, dtype=bool)
+        # Every filter except each one in turn, from running ANDs of the filters before and after it
+        order = list(masks)
+        before = [everything]
+        for dim_id in order:
+            before.append(before[-1] & masks[dim_id])
+        after = [everything]
+        for dim_id in reversed(order):
+            after.append(after[-1] & masks[dim_id])
+        after.reverse()
+        all_filters = before[-1]
+        excluding = {dim_id: before[i] & after[i + 1] for i, dim_id in enumerate(order)}
+
+        groups = {dim_id: dim.group(excluding.get(dim_id, all_filters)) for dim_id, dim in self.dimensions.items()}
+        records = {}
+        for dim_id, (order_by, descending, props, count) in self.tables.items():
+            selected = np.flatnonzero(all_filters)
+            ranked = selected[np.argsort(order_by[selected], kind='stable')]
+            top = ranked[::-1][:count] if descending else ranked[:count]
+            records[dim_id] = [{p: values[i] for p, values in props.items()} for i in top.tolist()]
+        return {
+            'size': self.size,
+            'count': int(all_filters.sum()),
+            'groups': groups,
+            'records': records,
+            'extents': {dim_id: dim.extent for dim_id, dim in self.dimensions.items() if dim.extent is not None},
+        }
+
+
+def load_records(src: str, enricher: Enricher) -> list[dict]:
+    with open(src, 'r') as f:
+        data = json.load(f)
+    records = []
+    for record in data:
+        if record.get('skip'):
+            continue
+        # As dataCoerce in dvis.js: only records not already enriched server side
+        if 'map_type' not in record:
+            record = enricher(record)
+        records.append(record)
+    return records
+
+
+class QueryService:
+    '''
+    A Dataset kept in step with its source file, and an LRU cache of responses.
+    '''
+    def __init__(self, src: str, config_path: str, map_types_path: str, cache_size: int) -> None:
+        self.src = src
+        self.config_path = config_path
+        self.map_types_path = map_types_path
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._stamp: tuple[int, int] | None = None
+        self._dataset: Dataset | None = None
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+
+    def dataset(self) -> Dataset:
+        st = os.stat(self.src)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp != self._stamp:
+                with open(self.config_path, 'r') as f:
+                    config = json.load(f)
+                records = load_records(self.src, Enricher.load(self.config_path, self.map_types_path))
+                self._dataset = Dataset(records, config)
+                self._stamp = stamp
+                self._cache.clear()
+                logging.info(f"Loaded {len(records)} summaries from {self.src}")
+            return self._dataset
+
+    def query(self, filters: dict[str, list]) -> bytes:
+        dataset = self.dataset()
+        # Filters are sets, so their order doesn't make a different state
+        key = json.dumps({k: sorted(v, key=json.dumps) for k, v in filters.items() if v}, sort_keys=True)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        body = json.dumps(dataset.query(filters), separators=(',', ':')).encode()
+        with self._lock:
+            self._cache[key] = body
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return body
+
+
+class QueryHandler(SimpleHTTPRequestHandler):
+    service: QueryService
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send_json(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, filters: object) -> None:
+        if not isinstance(filters, dict) or not all(isinstance(v, list) for v in filters.values()):
+            self.send_json(400, json.dumps({'error': 'filters must map dimension IDs to lists of filters'}).encode())
+            return
+        try:
+            body = self.service.query(filters)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, json.dumps({'error': f'{type(e).__name__}: {e}'}).encode())
+            return
+        self.send_json(200, body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != '/query':
+            return super().do_GET()
+        try:
+            filters = json.loads(parse_qs(url.query).get('filters', ['{}'])[0])
+        except ValueError as e:
+            self.send_json(400, json.dumps({'error': f'Bad filters: {e}'}).encode())
+            return
+        self.answer(filters)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/query':
+            self.send_json(404, b'{"error": "Not found"}')
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as e:
+            self.send_json(400, json.dumps({'error': f'Bad request: {e}'}).encode())
+            return
+        self.answer(request.get('filters', {}) if isinstance(request, dict) else None)
+
+
+def main():
+    parser = ArgumentParser(description="Serve the dashboard's filtered group counts from memory")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--src', default='summaries/all.json', help='Summaries to serve (default: summaries/all.json)')
+    parser.add_argument('--config', default='public/data/config.json', help='Dashboard configuration (default: public/data/config.json)')
+    parser.add_argument('--map-types', default='public/data/map-types.json', help='Map types, for summaries not yet enriched (default: public/data/map-types.json)')
+    parser.add_argument('--public', default='public', help='Static files to serve alongside /query (default: public)')
+    parser.add_argument('--bind', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', '-p', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--cache', type=int, default=256, help='Filter states to keep responses for (default: 256)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    QueryHandler.service = QueryService(args.src, args.config, args.map_types, args.cache)
+    # Load up front, so the first page load doesn't wait on it
+    QueryHandler.service.dataset()
+    server = ThreadingHTTPServer((args.bind, args.port), partial(QueryHandler, directory=args.public))
+    logging.info(f"Serving {args.public} and /query on http://{args.bind}:{args.port}/#server")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+'''
+Drive battles through the pipeline from a per-battle state table, rather
+than having make stat every file of every battle ever seen.
+
+Inputs:
+    pipeline/state.db
+    shards/<shard>/demos/index.mk (scan only)
+    demos/exclude.txt
+
+Outputs:
+    pipeline/state.db
+    Whatever each stage produces, via Makefile.shard
+
+Every battle has a row recording the last stage it completed:
+    scraped -> detail -> replay -> simulated -> postprocessed
+and whether it is ready for the next stage, running, failed, done, or
+excluded. Pending work is found through a partial index over ready rows,
+so deciding what to run next costs O(pending battles), not O(all battles).
+
+Each stage has its own queue and concurrency limit. A stage is run for a
+single battle by asking Makefile.shard for that one target, with
+ALLBATTLEIDS set to that one battle so it doesn't look at the rest of the
+shard. Failures are retried with exponential backoff, up to a limit.
+
+A battle is only marked as having completed a stage once the stage's
+output exists, and rows left running by a crash are made ready again on
+the next run, so an interrupted run resumes where it left off.
+
+Fetching and processing run as different users in different sandboxes,
+so run the network stages and the local stages as separate schedulers
+against the same state table:
+    scheduler.py run --stages detail replay
+    scheduler.py run --stages simulated postprocessed
+
+Usage:
+    scheduler.py add [ID...]      Add battles as scraped, reading IDs from stdin if none are given
+    scheduler.py scan             Add battles from every shard's index.mk, at the stage their files show
+    scheduler.py run              Work through pending battles until there are none
+    scheduler.py retry            Make failed battles ready again
+    scheduler.py status           Count battles by stage and state
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+from collections.abc import Iterable
+from contextlib import suppress
+from dataclasses import dataclass
+from enum import IntEnum
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import exclusions
+import logpack
+
+DEFAULT_PATH = 'pipeline/state.db'
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS battles (
+    gameid INTEGER PRIMARY KEY,
+    -- Last stage completed, see Stage
+    stage INTEGER NOT NULL,
+    -- ready, running, failed, done, or excluded
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- Unix time before which a ready battle shouldn't be retried
+    not_before REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    error TEXT
+);
+-- Only ready battles are ever queried for work, so only they are indexed
+CREATE INDEX IF NOT EXISTS battles_ready ON battles (stage, not_before, gameid) WHERE state = 'ready';
+'''
+
+
+class Stage(IntEnum):
+    SCRAPED = 0
+    DETAIL = 1
+    REPLAY = 2
+    SIMULATED = 3
+    POSTPROCESSED = 4
+
+
+STAGE_NAMES = {stage: stage.name.lower() for stage in Stage}
+FINAL_STAGE = Stage.POSTPROCESSED
+
+
+def shard_of(gameid: int) -> str:
+    return str(gameid // 10000)
+
+
+def target(stage: Stage, gameid: int) -> str:
+    '''
+    The Makefile.shard target whose existence means the stage completed, relative to the shard.
+    '''
+    match stage:
+        case Stage.DETAIL:
+            return f'demos/{gameid}/detail.html'
+        case Stage.REPLAY:
+            return f'demos/{gameid}/replay.sdfz'
+        case Stage.SIMULATED:
+            return f'stats/{gameid}/events.log'
+        case Stage.POSTPROCESSED:
+            return f'summaries/{gameid}/summary.json'
+    raise ValueError(f"No target for stage {stage}")
+
+
+class StateTable:
+    def __init__(self, path: str = DEFAULT_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.isolation_level = None
+        # Fetch and process schedulers share this table, so let them read while the other writes
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            if version != 0:
+                raise RuntimeError(f"{path} has schema version {version}, expected {SCHEMA_VERSION}")
+            self._db.executescript(SCHEMA)
+            self._db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def close(self) -> None:
+        self._db.close()
+
+    def add(self, gameids: Iterable[int], stage: Stage = Stage.SCRAPED) -> int:
+        '''
+        Add battles at the given stage. Battles already known only ever move forwards. Returns the number added or advanced.
+        '''
+        now = time.time()
+        state = 'done' if stage == FINAL_STAGE else 'ready'
+        with self._db:
+            self._db.execute('BEGIN')
+            cursor = self._db.executemany(
+                'INSERT INTO battles (gameid, stage, state, updated) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (gameid) DO UPDATE SET stage = excluded.stage, state = excluded.state, attempts = 0, updated = excluded.updated, error = NULL '
+                "WHERE battles.stage < excluded.stage AND battles.state != 'excluded'",
+                ((gameid, int(stage), state, now) for gameid in gameids),
+            )
+        return cursor.rowcount
+
+    def known(self, gameids: Iterable[int]) -> set[int]:
+        '''
+        Which of these battles are already in the table, at any stage.
+        '''
+        gameids = list(gameids)
+        found = set()
+        # Keep well within SQLite's limit on bound parameters
+        for i in range(0, len(gameids), 500):
+            chunk = gameids[i:i + 500]
+            found.update(row[0] for row in self._db.execute(
+                f'SELECT gameid FROM battles WHERE gameid IN ({",".join("?" * len(chunk))})', chunk
+            ))
+        return found
+
+    def exclude(self, gameids: Iterable[int]) -> int:
+        with self._db:
+            self._db.execute('BEGIN')
+            cursor = self._db.executemany(
+                "UPDATE battles SET state = 'excluded', updated = ? WHERE gameid = ? AND state != 'excluded'",
+                ((time.time(), gameid) for gameid in gameids),
+            )
+        return cursor.rowcount
+
+    def recover(self, stages: Iterable[Stage]) -> int:
+        '''
+        Make battles left running stages by an interrupted run ready again.
+        Only the given stages, since another scheduler may be running the others right now.
+        '''
+        with self._db:
+            self._db.execute('BEGIN')
+            cursor = self._db.executemany(
+                "UPDATE battles SET state = 'ready' WHERE state = 'running' AND stage = ?",
+                ((int(stage) - 1,) for stage in stages),
+            )
+        return cursor.rowcount
+
+    def retry_failed(self) -> int:
+        with self._db:
+            self._db.execute('BEGIN')
+            cursor = self._db.execute("UPDATE battles SET state = 'ready', attempts = 0, not_before = 0 WHERE state = 'failed'")
+        return cursor.rowcount
+
+    def claim(self, stage: Stage, limit: int) -> list[int]:
+        '''
+        Mark up to limit battles ready to run stage as running, and return them.
+        '''
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            gameids = [row[0] for row in self._db.execute(
+                "SELECT gameid FROM battles WHERE state = 'ready' AND stage = ? AND not_before <= ? ORDER BY gameid LIMIT ?",
+                (int(stage) - 1, time.time(), limit),
+            )]
+            self._db.executemany("UPDATE battles SET state = 'running', updated = ? WHERE gameid = ?", ((time.time(), gameid) for gameid in gameids))
+        return gameids
+
+    def next_retry(self, stage: Stage) -> float | None:
+        '''
+        When the earliest battle waiting on stage becomes ready, or None if none are.
+        '''
+        row = self._db.execute("SELECT min(not_before) FROM battles WHERE state = 'ready' AND stage = ?", (int(stage) - 1,)).fetchone()
+        return row[0]
+
+    def complete(self, gameid: int, stage: Stage) -> None:
+        state = 'done' if stage == FINAL_STAGE else 'ready'
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute(
+                'UPDATE battles SET stage = ?, state = ?, attempts = 0, not_before = 0, updated = ?, error = NULL WHERE gameid = ?',
+                (int(stage), state, time.time(), gameid),
+            )
+
+    def fail(self, gameid: int, error: str, max_attempts: int, backoff: float) -> str:
+        '''
+        Record a failed attempt. Returns the battle's new state: ready to retry, failed, or excluded if it was excluded meanwhile.
+        '''
+        with self._db:
+            self._db.execute('BEGIN')
+            state, attempts = self._db.execute('SELECT state, attempts FROM battles WHERE gameid = ?', (gameid,)).fetchone()
+            if state == 'excluded':
+                self._db.execute('UPDATE battles SET error = ? WHERE gameid = ?', (error, gameid))
+                return state
+            attempts += 1
+            state = 'ready' if attempts < max_attempts else 'failed'
+            self._db.execute(
+                'UPDATE battles SET state = ?, attempts = ?, not_before = ?, updated = ?, error = ? WHERE gameid = ?',
+                (state, attempts, time.time() + backoff * 2 ** (attempts - 1), time.time(), error, gameid),
+            )
+        return state
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        counts: dict[str, dict[str, int]] = {}
+        for stage, state, count in self._db.execute('SELECT stage, state, count(*) FROM battles GROUP BY stage, state'):
+            counts.setdefault(STAGE_NAMES[Stage(stage)], {})[state] = count
+        return counts
+
+
+@dataclass(slots=True)
+class StageConfig:
+    stage: Stage
+    jobs: int
+
+
+class Scheduler:
+    def __init__(
+        self,
+        table: StateTable,
+        root: str,
+        stages: list[StageConfig],
+        exclude: str,
+        summarydb: str | None = None,
+        max_attempts: int = 3,
+        backoff: float = 60,
+        poll: float = 5,
+    ) -> None:
+        self._table = table
+        self._root = root
+        self._stages = stages
+        self._exclude = exclude
+        self._exclude_stamp: tuple[int, int] | None = None
+        self._summarydb = summarydb
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._poll = poll
+        # Shards with new summaries, whose stamp must be touched for aggregate.py
+        self._dirty_shards: set[str] = set()
+        self.completed = {config.stage: 0 for config in stages}
+        self.failed = {config.stage: 0 for config in stages}
+
+    def refresh_exclusions(self) -> None:
+        '''
+        Pick up battles newly added to exclude.txt, by us or by a stage's recipe.
+        '''
+        try:
+            st = os.stat(self._exclude)
+            exclude_stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            exclude_stamp = None
+        if exclude_stamp == self._exclude_stamp:
+            return
+        self._exclude_stamp = exclude_stamp
+        excluded = self._table.exclude(exclusions.load(self._exclude))
+        if excluded:
+            logging.info(f"Excluded {excluded} battles")
+
+    def command(self, stage: Stage, gameid: int) -> list[str]:
+        '''
+        The command to run stage for one battle, from its shard directory.
+        '''
+        if stage == Stage.POSTPROCESSED and self._summarydb:
+            return ['python3', 'postprocess.py', '--batch', '--db', os.path.abspath(self._summarydb), '--ids', str(gameid), '.']
+        # Restricting ALLBATTLEIDS to this battle stops Makefile.shard listing and filtering the whole shard
+        return ['make', '-Rr', f'ALLBATTLEIDS={gameid}', target(stage, gameid)]
+
+    def produced(self, stage: Stage, gameid: int) -> bool:
+        if stage == Stage.POSTPROCESSED and self._summarydb:
+            # Checked by postprocess.py's exit status instead
+            return True
+        path = os.path.join(self._root, 'shards', shard_of(gameid), target(stage, gameid))
+        try:
+            return os.path.getsize(path) > 0
+        except FileNotFoundError:
+            return False
+
+    async def run_one(self, stage: Stage, gameid: int) -> None:
+        cwd = os.path.join(self._root, 'shards', shard_of(gameid))
+        proc = await asyncio.create_subprocess_exec(
+            *self.command(stage, gameid),
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        output, _ = await proc.communicate()
+        if proc.returncode == 0 and self.produced(stage, gameid):
+            self._table.complete(gameid, stage)
+            self.completed[stage] += 1
+            if stage == Stage.POSTPROCESSED:
+                self._dirty_shards.add(shard_of(gameid))
+            logging.debug(f"Battle {gameid}: {STAGE_NAMES[stage]}")
+            return
+        # The recipe may have given up on the battle by excluding it, which isn't a failure to retry
+        self.refresh_exclusions()
+        tail = output.decode(errors='replace').strip().splitlines()[-5:]
+        error = f"exit {proc.returncode}: " + ' | '.join(tail) if proc.returncode else f"no {target(stage, gameid)} produced"
+        match self._table.fail(gameid, error, self._max_attempts, self._backoff):
+            case 'excluded':
+                logging.info(f"Battle {gameid} was excluded during {STAGE_NAMES[stage]}")
+            case 'ready':
+                logging.info(f"Battle {gameid} failed {STAGE_NAMES[stage]}, will retry: {error}")
+            case _:
+                self.failed[stage] += 1
+                logging.warning(f"Battle {gameid} failed {STAGE_NAMES[stage]}, giving up: {error}")
+
+    async def run_stage(self, config: StageConfig, upstream_done: asyncio.Event, done: asyncio.Event) -> None:
+        '''
+        Keep up to config.jobs battles running through this stage, until there is nothing left for it to do.
+        '''
+        running: set[asyncio.Task] = set()
+        try:
+            while True:
+                free = config.jobs - len(running)
+                if free > 0:
+                    for gameid in self._table.claim(config.stage, free):
+                        running.add(asyncio.create_task(self.run_one(config.stage, gameid)))
+                if running:
+                    _, running = await asyncio.wait(running, timeout=self._poll, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                # Nothing running here. Finished once upstream can't hand us anything more, and nothing is waiting to be retried.
+                if upstream_done.is_set():
+                    next_retry = self._table.next_retry(config.stage)
+                    if next_retry is None:
+                        break
+                    await asyncio.sleep(max(0, min(self._poll, next_retry - time.time())))
+                    continue
+                # Wake early if upstream finishes, rather than waiting out the poll
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(upstream_done.wait(), self._poll)
+        finally:
+            for task in running:
+                task.cancel()
+            done.set()
+
+    def touch_dirty_shards(self) -> None:
+        for shard in sorted(self._dirty_shards):
+            path = os.path.join(self._root, 'shards', shard, 'summaries', 'shard.json.frags')
+            with open(path, 'a'):
+                os.utime(path)
+        self._dirty_shards.clear()
+
+    async def run(self) -> None:
+        recovered = self._table.recover(config.stage for config in self._stages)
+        if recovered:
+            logging.info(f"Recovered {recovered} battles left running by an interrupted run")
+        self.refresh_exclusions()
+        # Each stage finishes once the stage feeding it has. The earliest stage run is fed only by what's already in the table.
+        done = [asyncio.Event() for _ in self._stages]
+        upstream = asyncio.Event()
+        upstream.set()
+        tasks = []
+        for config, stage_done in zip(self._stages, done):
+            tasks.append(asyncio.create_task(self.run_stage(config, upstream, stage_done)))
+            upstream = stage_done
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.touch_dirty_shards()
+
+
+def scan(table: StateTable, root: str, exclude: str) -> None:
+    '''
+    Add every battle in every shard's index.mk, and every battle with a demos directory, at the stage its files show.
+    '''
+    shards_dir = os.path.join(root, 'shards')
+    by_stage: dict[Stage, list[int]] = {stage: [] for stage in Stage}
+    with os.scandir(shards_dir) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            gameids = set()
+            try:
+                with open(os.path.join(shard.path, 'demos', 'index.mk'), 'r') as f:
+                    for line in f:
+                        if line.startswith('BATTLEIDS:='):
+                            gameids.update(int(field) for field in line[len('BATTLEIDS:='):].split())
+            except FileNotFoundError:
+                pass
+            with os.scandir(os.path.join(shard.path, 'demos')) as it:
+                gameids.update(int(entry.name) for entry in it if entry.name.isdigit())
+            # A packed battle's events.log is no longer a file of its own. See: logpack.py
+            packed = logpack.load(shard.path).ids()
+            for gameid in gameids:
+                stage = Stage.SCRAPED
+                for candidate in (Stage.POSTPROCESSED, Stage.SIMULATED, Stage.REPLAY, Stage.DETAIL):
+                    if os.path.exists(os.path.join(shard.path, target(candidate, gameid))):
+                        stage = candidate
+                        break
+                if gameid in packed and stage < Stage.SIMULATED:
+                    stage = Stage.SIMULATED
+                by_stage[stage].append(gameid)
+    for stage, gameids in by_stage.items():
+        logging.info(f"{len(gameids)} battles at {STAGE_NAMES[stage]}, {table.add(gameids, stage)} added or advanced")
+    excluded = table.exclude(exclusions.load(exclude))
+    logging.info(f"Excluded {excluded} battles")
+
+
+def main():
+    parser = ArgumentParser(description="Drive battles through the pipeline from a per-battle state table")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--state', '-s', default=DEFAULT_PATH, help=f'State table (default: {DEFAULT_PATH})')
+    parser.add_argument('--root', '-r', default='.', help='Base directory containing shards/ (default: .)')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Add battles as scraped')
+    add_parser.add_argument('ids', type=int, nargs='*', help='Battle IDs, read from stdin if none are given')
+    subparsers.add_parser('scan', help="Add battles from every shard's index.mk, at the stage their files show")
+    run_parser = subparsers.add_parser('run', help='Work through pending battles until there are none')
+    run_parser.add_argument('--stages', nargs='+', choices=[STAGE_NAMES[s] for s in Stage if s != Stage.SCRAPED], default=[STAGE_NAMES[s] for s in Stage if s != Stage.SCRAPED], help='Stages to run (default: all)')
+    run_parser.add_argument('--detail-jobs', type=int, default=2, help='Battle detail pages to fetch at once (default: 2)')
+    run_parser.add_argument('--replay-jobs', type=int, default=2, help='Replays to fetch at once (default: 2)')
+    run_parser.add_argument('--simulated-jobs', type=int, default=1, help='Replays to simulate at once (default: 1)')
+    run_parser.add_argument('--postprocessed-jobs', type=int, default=os.cpu_count() or 1, help='Battles to postprocess at once (default: number of CPUs)')
+    run_parser.add_argument('--max-attempts', type=int, default=3, help='Attempts at a stage before a battle is marked failed (default: 3)')
+    run_parser.add_argument('--backoff', type=float, default=60, help='Seconds before the first retry, doubling after each (default: 60)')
+    run_parser.add_argument('--db', default=None, help='Postprocess into this summary database instead of summary.json files, see summarydb.py')
+    subparsers.add_parser('retry', help='Make failed battles ready again')
+    subparsers.add_parser('status', help='Count battles by stage and state')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    table = StateTable(args.state)
+    try:
+        match args.command:
+            case 'add':
+                gameids = args.ids
+                if not gameids:
+                    gameids = [int(line) for line in sys.stdin if line.strip().isdigit()]
+                logging.info(f"Added {table.add(gameids)} of {len(gameids)} battles")
+            case 'scan':
+                scan(table, args.root, args.exclude)
+            case 'run':
+                stages = [StageConfig(stage, getattr(args, f'{STAGE_NAMES[stage]}_jobs')) for stage in Stage if STAGE_NAMES[stage] in args.stages]
+                # One scheduler per set of stages, so a timer firing during a long run doesn't start a second one
+                lock_path = f"{args.state}.{'-'.join(STAGE_NAMES[c.stage] for c in stages)}.lock"
+                with open(lock_path, 'w') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        logging.info(f"Another scheduler holds {lock_path}, exiting")
+                        return
+                    scheduler = Scheduler(table, args.root, stages, args.exclude, args.db, args.max_attempts, args.backoff)
+                    asyncio.run(scheduler.run())
+                for config in stages:
+                    logging.info(f"{STAGE_NAMES[config.stage]}: {scheduler.completed[config.stage]} completed, {scheduler.failed[config.stage]} failed")
+            case 'retry':
+                logging.info(f"Made {table.retry_failed()} failed battles ready again")
+            case 'status':
+                print(json.dumps(table.counts(), indent=2))
+    finally:
+        table.close()
+
+if __name__ == '__main__':
+    main()
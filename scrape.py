@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+'''
+Find new battle IDs on zero-k.info, and add them to the shard indexes.
+
+Inputs:
+    https://zero-k.info/Battles, 40 battles a page, newest first
+    shards/<shard>/demos/index.mk
+    demos/<shard>/<id>/
+    demos/exclude.txt
+    pipeline/state.db (with --state)
+
+Outputs:
+    shards/<shard>/demos/index.mk, and the shard itself if it's new
+    pipeline/state.db (with --state)
+
+The in-process equivalent of bin/scrape.sh's page loop and shardify. Pages
+are requested in rounds of 1, 2, 4, ... up to --jobs at once, within the
+same rate budget as fetch.py (see: RateLimitTransport in getwhr.py). Since
+the list is newest first, scraping stops at the first page with no battle
+we don't already know of, so a routine update costs a couple of pages
+rather than the whole START to END sweep. --full sweeps the whole range
+regardless, for deepening history. See: bin/deepen.sh
+
+A battle is known if it's in its shard's index.mk, has a demos directory,
+is excluded, or, with --state, is in the state table. New IDs are merged
+into each shard's index.mk, which is rewritten atomically, and only if it
+changed. Shards are written oldest first, so if a run is interrupted, the
+newest pages still have unknown battles on them and are scraped again.
+
+Usage:
+    scrape.py [--full] [--state pipeline/state.db] [START [END]]
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+import httpx
+import logging
+import os
+import re
+import sys
+
+import exclusions
+from getwhr import MaxRetryError, RateLimitTransport
+from scheduler import StateTable, shard_of
+
+BASE_URL = 'https://zero-k.info'
+# 1v1 matchmaking battles with two players, newest first. See: bin/scrape.sh
+QUERY = 'Title=&Map=&PlayersFrom=2&PlayersTo=2&Age=0&MinLength=&MaxLength=&Mission=2&Bots=2&Rank=8&Victory=0&Matchmaker=0&Rating=3'
+PAGE_SIZE = 40
+
+BATTLE_LINK = re.compile(r"<a href='/Battles/Detail/([0-9]+)'")
+
+
+def setup_shard(root: str, shard: str) -> None:
+    '''
+    First time setup of a shard. Setup is only complete once the shard has an index.mk. See: commit_shard in bin/scrape.sh
+    '''
+    shard_dir = os.path.join(root, 'shards', shard)
+    # stats/ and summaries/ are owned by the process side, so are created by them
+    os.makedirs(os.path.join(root, 'demos', shard), exist_ok=True)
+    os.makedirs(shard_dir, exist_ok=True)
+    links = {name: f'../../{name}/{shard}' for name in ('demos', 'stats', 'summaries')}
+    links |= {name: f'../../{name}' for name in ('games', 'maps')}
+    links |= {'Makefile': '../../Makefile.shard', 'postprocess.py': '../../postprocess.py'}
+    for name, target in links.items():
+        path = os.path.join(shard_dir, name)
+        if os.path.islink(path) and os.readlink(path) == target:
+            continue
+        os.symlink(target, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+
+def write_index(root: str, shard: str, new_ids: set[int]) -> int:
+    '''
+    Merge new battle IDs into a shard's index.mk. Returns how many weren't already there.
+    '''
+    path = os.path.join(root, 'demos', shard, 'index.mk')
+    ids = set()
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith('BATTLEIDS:='):
+                    ids.update(int(field) for field in line[len('BATTLEIDS:='):].split())
+    else:
+        setup_shard(root, shard)
+    added = len(new_ids - ids)
+    if not added:
+        # Don't touch the timestamp, or the top level Makefile would refetch the shard
+        return 0
+    with open(path + '.tmp', 'w') as f:
+        f.write('BATTLEIDS:=' + ' '.join(map(str, sorted(ids | new_ids))) + '\n')
+    os.replace(path + '.tmp', path)
+    return added
+
+
+class Scraper:
+    def __init__(self, client: httpx.AsyncClient, root: str, excluded: exclusions.Exclusions, table: StateTable | None) -> None:
+        self._client = client
+        self._root = root
+        self._excluded = excluded
+        self._table = table
+        # Shard -> battles known in it, read the first time the shard comes up
+        self._known: dict[str, set[int]] = {}
+        self.pages = 0
+
+    async def page(self, offset: int) -> list[int]:
+        response = await self._client.get(f'{BASE_URL}/Battles?{QUERY}&Offset={offset}')
+        response.raise_for_status()
+        self.pages += 1
+        return [int(battle_id) for battle_id in BATTLE_LINK.findall(response.text)]
+
+    def unknown(self, ids: list[int]) -> set[int]:
+        unknown = set()
+        for battle_id in ids:
+            shard = shard_of(battle_id)
+            if shard not in self._known:
+                shard_dir = os.path.join(self._root, 'shards', shard)
+                self._known[shard] = exclusions.shard_battle_ids(shard_dir) if os.path.isdir(os.path.join(shard_dir, 'demos')) else set()
+            if battle_id not in self._known[shard] and battle_id not in self._excluded:
+                unknown.add(battle_id)
+        if self._table is not None and unknown:
+            unknown -= self._table.known(unknown)
+        return unknown
+
+    async def scrape(self, start: int, end: int, jobs: int, full: bool) -> set[int]:
+        '''
+        New battle IDs from the pages between offsets start and end inclusive, stopping early unless full.
+        '''
+        offsets = list(range(start, end + 1, PAGE_SIZE))
+        found = set()
+        wave = 1
+        while offsets:
+            batch, offsets = offsets[:wave], offsets[wave:]
+            pages = await asyncio.gather(*(self.page(offset) for offset in batch))
+            for offset, ids in zip(batch, pages):
+                if not ids:
+                    logging.info(f"No battles at offset {offset}, reached the end of the list")
+                    return found
+                new = self.unknown(ids) - found
+                logging.debug(f"Offset {offset}: {len(new)}/{len(ids)} battles new")
+                found |= new
+                if not new and not full:
+                    logging.info(f"Nothing new at offset {offset}, stopping")
+                    return found
+            wave = min(wave * 2, jobs)
+        return found
+
+
+async def amain() -> int:
+    global BASE_URL
+    parser = ArgumentParser(description="Find new battle IDs on zero-k.info, and add them to the shard indexes")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('start', type=int, nargs='?', default=0, help='Offset of the first battle to look at (default: 0)')
+    parser.add_argument('end', type=int, nargs='?', default=600, help='Offset of the last battle to look at, rounded up to a page (default: 600)')
+    parser.add_argument('--full', action='store_true', help="Scrape every page from START to END, even once there's nothing new")
+    parser.add_argument('--jobs', '-j', type=int, default=8, help='Most pages to request at once (default: 8)')
+    parser.add_argument('--rate', type=float, default=5, help='Most requests per second (default: 5)')
+    parser.add_argument('--root', default='.', help='zkstats directory, containing shards/ and demos/ (default: .)')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    parser.add_argument('--state', '-s', default=None, help='Also add new battles to this scheduler.py state table, eg: pipeline/state.db')
+    parser.add_argument('--base-url', default=BASE_URL, help=f'Where to scrape from, eg a local mock (default: {BASE_URL})')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    logging.getLogger('httpx').setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    BASE_URL = args.base_url.rstrip('/')
+
+    table = StateTable(args.state) if args.state else None
+    # httpx ignores the client's http2 and limits once it's given a transport, so they're set on the pool itself
+    jobs = max(1, args.jobs)
+    pool = httpx.AsyncHTTPTransport(http2=True, limits=httpx.Limits(max_connections=jobs, max_keepalive_connections=jobs), retries=0)
+    try:
+        async with httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(10, read=30, pool=60),
+            transport=RateLimitTransport(max_calls=max(1, round(args.rate)), period=max(1, round(args.rate)) / args.rate, retries=4, transport=pool),
+        ) as client:
+            scraper = Scraper(client, args.root, exclusions.load(args.exclude), table)
+            new_ids = await scraper.scrape(args.start, args.end, jobs, args.full)
+    except (httpx.HTTPError, MaxRetryError) as e:
+        logging.error(f"Scraping failed, nothing written: {type(e).__name__}: {e}")
+        return 1
+
+    by_shard: dict[str, set[int]] = {}
+    for battle_id in new_ids:
+        by_shard.setdefault(shard_of(battle_id), set()).add(battle_id)
+    if table is not None:
+        table.add(sorted(new_ids))
+        table.close()
+    for shard in sorted(by_shard, key=int):
+        added = write_index(args.root, shard, by_shard[shard])
+        logging.info(f"Shard {shard}: {added} new battles")
+    logging.info(f"Found {len(new_ids)} new battles in {scraper.pages} pages")
+    return 0
+
+
+def main():
+    sys.exit(asyncio.run(amain()))
+
+if __name__ == '__main__':
+    main()
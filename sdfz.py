@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+'''
+Read .sdfz replay headers, and triage replays before simulating them.
+
+Inputs:
+    shards/<shard>/demos/<id>/replay.sdfz
+    demos/exclude.txt
+
+Outputs:
+    demos/exclude.txt (replays certain to be skipped)
+    stdout (info)
+
+A .sdfz is a gzipped Spring demo: a fixed size header, the start script,
+the demo stream, then the IDs of the winning ally teams and end of game
+statistics. The header and start script are all that's needed to learn
+the engine version, how long the game ran, and who played, so only the
+demo stream has to be decompressed past, never simulated.
+
+The header is written at the start of recording, and filled in when the
+game ends. A header which was never filled in (no demo stream size) means
+the game never ended, and playback runs off the end of the demo, which
+bin/run-simulation.sh and simulate.py would only catch once spring-headless
+had got there.
+
+A replay is excluded without being simulated if it's certain to be skipped
+later on:
+    it can't be read as a Spring demo at all
+    the game never ended
+    no ally team won, as for a draw or everyone leaving (see: skip_conditions in postprocess.py)
+    an AI played
+    it isn't between exactly two players
+Anything uncertain, such as a demo version this doesn't know, is left to be
+simulated as before.
+
+Usage:
+    sdfz.py info REPLAY...                 Print what the header and start script say, as JSON
+    sdfz.py triage SHARD_DIR...            Exclude a shard's pending replays which are certain to be skipped
+    sdfz.py triage --replay REPLAY ID      Exclude one replay if it's certain to be skipped, exiting 1 if so
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass, field
+import gzip
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import zlib
+
+import exclusions
+import logpack
+
+DEMOFILE_MAGIC = b'spring demofile\0'
+DEMOFILE_VERSION = 5
+# magic, version, headerSize, versionString, gameID, unixTime, then twelve ints:
+# scriptSize, demoStreamSize, gameTime, wallclockTime, numPlayers, playerStatSize, playerStatElemSize,
+# numTeams, teamStatSize, teamStatElemSize, teamStatPeriod, winningAllyTeamsSize
+HEADER = struct.Struct('<16sii256s16sQ12i')
+
+# Reasons, as written to exclude.txt. See: exclusions.REASON_MESSAGES
+UNREADABLE = 'Unreadable replay, replay skipped'
+UNFINISHED = 'Replay of an unfinished game, replay skipped'
+NO_WINNER = 'No winner in replay, replay skipped'
+AI_PLAYED = 'AI in replay, replay skipped'
+NOT_1V1 = 'Replay is not a 1v1, replay skipped'
+
+# Start script tokens: a section opening, a section closing, or a key=value; pair
+SCRIPT_TOKEN = re.compile(r'\[([^\]]*)\]\s*\{|(\})|([^=;{}\[\]]+)=([^;]*);')
+
+
+class ReplayError(Exception):
+    pass
+
+
+class UnsupportedVersion(ReplayError):
+    '''
+    Perhaps a perfectly good demo, just not one this knows how to read.
+    '''
+
+
+@dataclass(slots=True, frozen=True)
+class DemoHeader:
+    version: int
+    header_size: int
+    engine: str
+    game_id: str
+    unix_time: int
+    script_size: int
+    demo_stream_size: int
+    # Seconds of game time and of wall clock time the game ran for
+    game_time: int
+    wallclock_time: int
+    num_players: int
+    player_stat_size: int
+    player_stat_elem_size: int
+    num_teams: int
+    team_stat_size: int
+    team_stat_elem_size: int
+    team_stat_period: int
+    winning_ally_teams_size: int
+
+    @staticmethod
+    def unpack(data: bytes) -> DemoHeader:
+        if len(data) < HEADER.size:
+            raise ReplayError(f"Header truncated at {len(data)} bytes")
+        magic, version, header_size, engine, game_id, unix_time, *ints = HEADER.unpack_from(data)
+        if magic != DEMOFILE_MAGIC:
+            raise ReplayError(f"Not a Spring demo, magic {magic!r}")
+        return DemoHeader(
+            version,
+            header_size,
+            engine.split(b'\0', 1)[0].decode('utf-8', 'replace'),
+            game_id.hex(),
+            unix_time,
+            *ints,
+        )
+
+
+def parse_script(text: str) -> dict:
+    '''
+    A start script as nested dicts, with section names and keys lowercased as Spring treats them.
+    '''
+    root: dict = {}
+    stack = [root]
+    for m in SCRIPT_TOKEN.finditer(text):
+        section, close, key, value = m.groups()
+        if section is not None:
+            child: dict = {}
+            stack[-1][section.strip().lower()] = child
+            stack.append(child)
+        elif close is not None:
+            if len(stack) > 1:
+                stack.pop()
+        else:
+            stack[-1][key.strip().lower()] = value.strip()
+    return root
+
+
+@dataclass(slots=True)
+class Replay:
+    header: DemoHeader
+    script: dict
+    # Only read if asked for, since it means decompressing the whole demo stream
+    winning_ally_teams: list[int] | None = None
+    sections: dict[str, dict] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.sections = self.script.get('game', {})
+
+    def numbered(self, prefix: str) -> dict[int, dict]:
+        '''
+        The start script sections named prefix followed by a number, eg PLAYER0, by that number.
+        '''
+        return {
+            int(name[len(prefix):]): section for name, section in self.sections.items()
+            if name.startswith(prefix) and name[len(prefix):].isdigit() and isinstance(section, dict)
+        }
+
+    @property
+    def players(self) -> dict[int, dict]:
+        return {n: p for n, p in self.numbered('player').items() if p.get('spectator', '0') == '0'}
+
+    @property
+    def ais(self) -> dict[int, dict]:
+        return self.numbered('ai')
+
+    @property
+    def game(self) -> str | None:
+        return self.sections.get('gametype')
+
+    @property
+    def map(self) -> str | None:
+        return self.sections.get('mapname')
+
+    def info(self) -> dict:
+        return {
+            'header': asdict(self.header),
+            'engine': self.header.engine,
+            'game': self.game,
+            'map': self.map,
+            'players': [{'name': p.get('name'), 'accountid': p.get('accountid'), 'team': p.get('team')} for p in self.players.values()],
+            'ais': [{'name': ai.get('name'), 'shortname': ai.get('shortname'), 'team': ai.get('team')} for ai in self.ais.values()],
+            'teams': len(self.numbered('team')),
+            'winning_ally_teams': self.winning_ally_teams,
+        }
+
+
+def read(path: str, winners: bool = False) -> Replay:
+    '''
+    A replay's header and start script, and with winners, the winning ally teams.
+    '''
+    try:
+        with gzip.open(path, 'rb') as f:
+            header = DemoHeader.unpack(f.read(HEADER.size))
+            if header.version != DEMOFILE_VERSION:
+                raise UnsupportedVersion(f"Unsupported demo version {header.version}")
+            # Later minor versions may have grown the header
+            f.read(max(0, header.header_size - HEADER.size))
+            script = f.read(header.script_size)
+            if len(script) != header.script_size:
+                raise ReplayError(f"Start script truncated at {len(script)}/{header.script_size} bytes")
+            replay = Replay(header, parse_script(script.decode('utf-8', 'replace')))
+            if winners and header.demo_stream_size > 0:
+                f.seek(header.demo_stream_size, os.SEEK_CUR)
+                ids = f.read(header.winning_ally_teams_size)
+                if len(ids) != header.winning_ally_teams_size:
+                    raise ReplayError("Winning ally teams truncated")
+                replay.winning_ally_teams = list(ids)
+            return replay
+    except FileNotFoundError:
+        raise
+    except (OSError, EOFError, zlib.error) as e:
+        # gzip raises BadGzipFile, an OSError, for anything that isn't gzip
+        raise ReplayError(f"{type(e).__name__}: {e}") from e
+
+
+def triage(path: str) -> str | None:
+    '''
+    Why a replay is certain to be skipped, or None if it should be simulated.
+    '''
+    try:
+        replay = read(path)
+    except (FileNotFoundError, UnsupportedVersion) as e:
+        logging.debug(f"{path}: {e}")
+        return None
+    except ReplayError as e:
+        logging.debug(f"{path}: {e}")
+        return UNREADABLE
+    if replay.ais:
+        return AI_PLAYED
+    if len(replay.players) != 2:
+        return NOT_1V1
+    if replay.header.demo_stream_size == 0 or replay.header.game_time == 0:
+        return UNFINISHED
+    if replay.header.winning_ally_teams_size == 0:
+        return NO_WINNER
+    return None
+
+
+def pending_replays(shard_dir: str, excluded: exclusions.Exclusions) -> list[tuple[int, str]]:
+    '''
+    (Battle ID, replay) for a shard's battles with a replay but no events.log, loose or packed. See: simulate.pending_jobs
+    '''
+    packed = logpack.load(shard_dir).ids()
+    pending = []
+    with os.scandir(os.path.join(shard_dir, 'demos')) as it:
+        for entry in it:
+            if not entry.name.isdigit() or int(entry.name) in excluded or int(entry.name) in packed:
+                continue
+            replay = os.path.join(entry.path, 'replay.sdfz')
+            if not os.path.exists(replay) or os.path.exists(os.path.join(shard_dir, 'stats', entry.name, 'events.log')):
+                continue
+            pending.append((int(entry.name), replay))
+    return sorted(pending)
+
+
+def exclude_if_skipped(exclude_path: str, battle_id: int, replay: str, dry_run: bool = False) -> bool:
+    '''
+    Exclude a battle if its replay is certain to be skipped. Returns whether it should be.
+    '''
+    reason = triage(replay)
+    if reason is None:
+        return False
+    logging.info(f"Battle {battle_id}: {reason}{' (dry run)' if dry_run else ', excluding'}")
+    if not dry_run:
+        exclusions.add(exclude_path, battle_id, reason)
+    return True
+
+
+def main():
+    parser = ArgumentParser(description="Read .sdfz replay headers, and triage replays before simulating them")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='Print what the header and start script say, as JSON')
+    info_parser.add_argument('replays', nargs='+', help='Replay files')
+    triage_parser = subparsers.add_parser('triage', help='Exclude pending replays which are certain to be skipped')
+    triage_parser.add_argument('shards', nargs='*', help='Shard directories, eg: shards/160')
+    triage_parser.add_argument('--replay', nargs=2, metavar=('REPLAY', 'ID'), default=None, help='Triage just this replay of this battle, exiting 1 if it was excluded')
+    triage_parser.add_argument('--dry-run', '-n', action='store_true', help="Say what would be excluded, but don't")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    match args.command:
+        case 'info':
+            failed = False
+            for path in args.replays:
+                try:
+                    info = read(path, winners=True).info()
+                except ReplayError as e:
+                    logging.error(f"{path}: {e}")
+                    failed = True
+                    continue
+                print(json.dumps({'replay': path, **info}))
+            sys.exit(1 if failed else 0)
+        case 'triage' if args.replay:
+            replay, battle_id = args.replay
+            sys.exit(1 if exclude_if_skipped(args.exclude, int(battle_id), replay, args.dry_run) else 0)
+        case 'triage':
+            excluded = exclusions.load(args.exclude)
+            checked = skipped = 0
+            for shard_dir in args.shards:
+                for battle_id, replay in pending_replays(shard_dir, excluded):
+                    checked += 1
+                    skipped += exclude_if_skipped(args.exclude, battle_id, replay, args.dry_run)
+            logging.info(f"Triaged {checked} pending replays, {skipped} certain to be skipped")
+
+if __name__ == '__main__':
+    main()
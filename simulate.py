@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+'''
+Simulate replays in parallel, admitting jobs while there is memory for them.
+
+Inputs, relative to a shard directory:
+    demos/<id>/replay.sdfz
+    demos/<id>/detail.json or detail.html (for the engine version, see: detail.py)
+    $ZKDIR/springsettings.cfg
+    ../../demos/exclude.txt
+
+Outputs, relative to a shard directory:
+    stats/<id>/spring.log
+    stats/<id>/events.log
+    ../../demos/exclude.txt (battles which can't be simulated, or needn't be)
+
+The in-process equivalent of running bin/run-simulation.sh for each battle:
+each job gets its own springsettings with ZKHeadlessReplay set, runs
+spring-headless under /usr/bin/time -v, is killed after --max-sim-time,
+and has its spring.log watched for the conditions the replay stats widget
+can't handle on its own. spring's output is read through a pipe and
+written to spring.log as it arrives, so no tail -F is needed per job.
+
+A job is only started if the memory reserved for the running jobs plus
+one more job's worth fits in the budget. Each running job reserves the
+larger of its current RSS and the peak RSS expected of a job, which
+starts at --initial-estimate and thereafter follows the largest peak
+/usr/bin/time has reported so far. Each job is pinned to its own set of
+cores.
+
+Before anything is simulated, replays whose header shows they're certain
+to be skipped are excluded instead. See: sdfz.py
+
+With --summary-only, the replay stats widget quits once it has recorded
+every event a summary needs, or at --summary-frames, and postprocess.py
+takes the winner and duration from the battle's metadata. Should spring
+not exit by itself within the grace period, it's killed, and the run
+still counts as a success. See: SUMMARYONLY in Makefile.shard
+
+With --metrics DIR, each simulation's wall time, peak RSS and speed, and
+what became of it, are written to DIR/zkreplay_simulate.prom and .json.
+See: metrics.py
+
+Usage:
+    simulate.py [--jobs N] [--memory-budget MB] SHARD_DIR... [--ids ID...]
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass, field
+import logging
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from detail import load as load_detail
+import exclusions
+import logpack
+from metrics import BYTES, LONG_SECONDS, Metrics
+import sdfz
+
+ZKDIR = '/var/lib/zkreplay/Zero-K'
+TIME = '/usr/bin/time'
+
+# Example line: [t=00:00:16.943076][f=-000001] Loaded widget:  SpringRTS Replay Stats  <replay_stats.lua>
+WIDGET_LOADED = re.compile(r'^\[t=[0-9:.]+\]\[f=-000001\] Loaded widget: +SpringRTS Replay Stats +<replay_stats\.lua>$')
+# Any line with a non-negative frame number, eg: [t=00:00:37.065796][f=0000000] Playback continued
+SIMULATION_STARTED = re.compile(r'^\[t=[0-9:.]+\]\[f=[^-]')
+FRAME = re.compile(r'^\[t=[0-9:.]+\]\[f=(-?[0-9]+)\]')
+# Frames per second of game time
+GAME_SPEED = 30
+END_OF_DEMO = 'End of demo reached'
+# The widget's mark that a summary only run has everything, eg: [t=00:03:12.501234][f=0021004] <Replay Stats> [21004] Summary events complete
+SUMMARY_COMPLETE = re.compile(r'<Replay Stats> \[[0-9]+\] Summary events complete$')
+# Seconds past the end of the replay to wait for a normal exit
+END_OF_DEMO_GRACE = 15
+MAX_RSS = re.compile(r'Maximum resident set size \(kbytes\): ([0-9]+)')
+# Spammy stderr from every run, not worth keeping
+STDERR_NOISE = 'lups/ParticleClasses/nanolasersnoshader.lua'
+
+
+def parse_duration(text: str) -> float:
+    '''
+    A duration in timeout(1)'s format, eg: 4h, 30m, 90
+    '''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def cgroup_memory_limit() -> int | None:
+    '''
+    The lower of memory.high and memory.max for our cgroup, as set by MemoryHigh/MemoryMax in the systemd unit.
+    '''
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            path = next(line.split('::', 1)[1].strip() for line in f if line.startswith('0::'))
+    except (FileNotFoundError, StopIteration):
+        return None
+    limits = []
+    for name in ('memory.high', 'memory.max'):
+        try:
+            with open(os.path.join('/sys/fs/cgroup', path.lstrip('/'), name), 'r') as f:
+                value = f.read().strip()
+        except FileNotFoundError:
+            continue
+        if value != 'max':
+            limits.append(int(value))
+    return min(limits) if limits else None
+
+
+def mem_available() -> int:
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def process_group_rss(pgids: set[int]) -> dict[int, int]:
+    '''
+    Total RSS in bytes of every process in each of the given process groups.
+    '''
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    totals = dict.fromkeys(pgids, 0)
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                stat = f.read()
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+        # The command name may contain spaces and parentheses, so split after its closing parenthesis
+        fields = stat[stat.rindex(')') + 2:].split()
+        pgid = int(fields[2])
+        if pgid in totals:
+            totals[pgid] += int(fields[21]) * page_size
+    return totals
+
+
+@dataclass(slots=True)
+class Job:
+    battle_id: int
+    shard_dir: str
+    cores: set[int] = field(default_factory=set)
+    pgid: int | None = None
+    rss: int = 0
+    killed_because: str | None = None
+    # Summary only runs: the widget has recorded everything, so however spring exits is fine
+    summary_complete: bool = False
+    # The last frame spring logged, for how fast it simulated
+    frames: int = 0
+
+
+class MemoryBudget:
+    def __init__(self, budget: int, initial_estimate: int, margin: float) -> None:
+        self.budget = budget
+        self.estimate = initial_estimate
+        self.margin = margin
+        self.peaks: list[int] = []
+
+    def reservation(self, job: Job) -> int:
+        return max(job.rss, int(self.estimate * self.margin))
+
+    def admits(self, running: list[Job]) -> bool:
+        reserved = sum(self.reservation(job) for job in running)
+        wanted = int(self.estimate * self.margin)
+        if running and reserved + wanted > self.budget:
+            return False
+        # Something outside our control may be using the memory too
+        unreserved = sum(max(0, self.reservation(job) - job.rss) for job in running)
+        return not running or mem_available() - unreserved >= wanted
+
+    def observe_peak(self, peak: int) -> None:
+        self.peaks.append(peak)
+        # Replays vary a lot in size, so plan for the worst seen rather than the average
+        self.estimate = max(self.peaks)
+
+
+class Simulator:
+    def __init__(
+        self,
+        zkdir: str,
+        max_sim_time: float,
+        jobs: int,
+        cores_per_job: int,
+        budget: MemoryBudget,
+        exclude_path: str,
+        summary_frames: int | None = None,
+        metrics: Metrics | None = None,
+        poll: float = 2,
+    ) -> None:
+        self._zkdir = zkdir
+        self._max_sim_time = max_sim_time
+        self._jobs = jobs
+        self._cores_per_job = cores_per_job
+        self._budget = budget
+        self._exclude_path = exclude_path
+        self._summary_frames = summary_frames
+        self._metrics = metrics
+        self._poll = poll
+        self._free_cores = sorted(os.sched_getaffinity(0))
+        self._running: list[Job] = []
+        self.succeeded = 0
+        self.failed = 0
+
+    def exclude(self, job: Job, reason: str) -> None:
+        logging.warning(f"Battle {job.battle_id}: {reason}, excluding")
+        exclusions.add(self._exclude_path, job.battle_id, reason)
+
+    def kill(self, job: Job, reason: str) -> None:
+        if job.killed_because is not None or job.pgid is None:
+            return
+        job.killed_because = reason
+        with suppress(ProcessLookupError):
+            os.killpg(job.pgid, signal.SIGKILL)
+
+    def stop(self, job: Job) -> None:
+        '''
+        End a summary only run that's outstayed its widget quitting.
+        '''
+        if job.pgid is None:
+            return
+        logging.debug(f"Battle {job.battle_id}: still running {END_OF_DEMO_GRACE}s after its summary was complete, killing")
+        with suppress(ProcessLookupError):
+            os.killpg(job.pgid, signal.SIGKILL)
+
+    async def watch_log(self, job: Job, stdout: asyncio.StreamReader, log_path: str) -> None:
+        '''
+        Copy spring's stdout to spring.log, watching for conditions the replay stats widget can't handle.
+        '''
+        seen_widget = False
+        last_timed = ''
+        grace: asyncio.TimerHandle | None = None
+        loop = asyncio.get_running_loop()
+        try:
+            with open(log_path, 'wb') as log:
+                while line := await stdout.readline():
+                    log.write(line)
+                    text = line.decode(errors='replace').rstrip('\r\n')
+                    if text.startswith('[t='):
+                        last_timed = text
+                    if self._summary_frames is not None and not job.summary_complete and SUMMARY_COMPLETE.search(text):
+                        logging.debug(f"Battle {job.battle_id}: summary events complete")
+                        job.summary_complete = True
+                        if grace is not None:
+                            grace.cancel()
+                        grace = loop.call_later(END_OF_DEMO_GRACE, self.stop, job)
+                    elif text.endswith(END_OF_DEMO) and grace is None:
+                        logging.debug(f"Battle {job.battle_id}: replay EOF detected")
+                        grace = loop.call_later(END_OF_DEMO_GRACE, self.kill, job, 'Non-terminating replay detected')
+                    elif not seen_widget:
+                        if WIDGET_LOADED.match(text):
+                            seen_widget = True
+                        elif SIMULATION_STARTED.match(text):
+                            self.kill(job, 'Could not load replay_stats.lua')
+        finally:
+            if grace is not None:
+                grace.cancel()
+            if m := FRAME.match(last_timed):
+                job.frames = max(0, int(m.group(1)))
+
+    async def read_stderr(self, stderr: asyncio.StreamReader) -> int | None:
+        '''
+        Pass spring's stderr through, minus noise, and return the peak RSS /usr/bin/time reports at the end.
+        '''
+        peak = None
+        while line := await stderr.readline():
+            text = line.decode(errors='replace').rstrip('\n')
+            if STDERR_NOISE in text:
+                continue
+            if m := MAX_RSS.search(text):
+                peak = int(m.group(1)) * 1024
+            logging.debug(text)
+        return peak
+
+    def finish(self, job: Job, result: str, elapsed: float | None = None, peak: int | None = None) -> None:
+        '''
+        Count a job as done, and record how it went.
+        '''
+        if result == 'succeeded':
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if self._metrics is None:
+            return
+        self._metrics.inc('battles_total', result=result)
+        if job.killed_because is not None:
+            self._metrics.inc('watchdog_kills_total', reason=job.killed_because)
+        if elapsed is None:
+            return
+        self._metrics.observe('wall_seconds', elapsed)
+        if peak is not None:
+            self._metrics.observe('peak_rss_bytes', peak)
+        if job.frames and elapsed > 0:
+            self._metrics.observe('speed', job.frames / GAME_SPEED / elapsed)
+            self._metrics.inc('game_seconds_total', job.frames / GAME_SPEED)
+
+    async def run(self, job: Job) -> None:
+        stats_dir = os.path.join(job.shard_dir, 'stats', str(job.battle_id))
+        # The stats symlink may point to a per-shard directory that doesn't exist yet
+        os.makedirs(os.path.realpath(stats_dir), exist_ok=True)
+        widget_log_dir = os.path.join(self._zkdir, 'LuaUI', 'Logs', 'replay_stats', str(job.battle_id))
+        os.makedirs(widget_log_dir, exist_ok=True)
+        version = load_detail(job.shard_dir, job.battle_id).engine
+        if version is None:
+            logging.error(f"Battle {job.battle_id}: no engine version in detail.html")
+            self.finish(job, 'no engine')
+            return
+        spring_bin = os.path.join(self._zkdir, 'engine', 'linux64', version, 'spring-headless')
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            config = os.path.join(work_dir, f'springsettings.{job.battle_id}.cfg')
+            shutil.copyfile(os.path.join(self._zkdir, 'springsettings.cfg'), config)
+            with open(config, 'a') as f:
+                f.write(f'\nZKHeadlessReplay={job.battle_id}\n')
+                if self._summary_frames is not None:
+                    f.write(f'ZKHeadlessReplaySummaryOnly=1\nZKHeadlessReplaySummaryFrames={self._summary_frames}\n')
+
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                'taskset', '--cpu-list', ','.join(map(str, sorted(job.cores))),
+                TIME, '-v', spring_bin, '-write-dir', self._zkdir, '-config', config,
+                os.path.join(job.shard_dir, 'demos', str(job.battle_id), 'replay.sdfz'),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                # Own process group, so the whole simulation can be killed at once
+                start_new_session=True,
+            )
+            job.pgid = proc.pid
+            watcher = asyncio.create_task(self.watch_log(job, proc.stdout, os.path.join(stats_dir, 'spring.log')))
+            stderr = asyncio.create_task(self.read_stderr(proc.stderr))
+            try:
+                await asyncio.wait_for(proc.wait(), self._max_sim_time)
+            except TimeoutError:
+                self.kill(job, 'Timeout reached, replay skipped')
+                await proc.wait()
+            finally:
+                if proc.returncode is None:
+                    # We're being cancelled; don't leave the simulation behind
+                    self.kill(job, 'Interrupted')
+                    await proc.wait()
+                await watcher
+                peak = await stderr
+        if peak is not None:
+            self._budget.observe_peak(peak)
+
+        elapsed = time.monotonic() - started
+        if job.killed_because is not None:
+            if job.killed_because != 'Interrupted':
+                self.exclude(job, job.killed_because)
+            self.finish(job, 'killed', elapsed, peak)
+            return
+        if proc.returncode != 0 and not job.summary_complete:
+            logging.error(f"Battle {job.battle_id}: spring exited with {proc.returncode} after {elapsed:.0f}s")
+            self.finish(job, 'crashed', elapsed, peak)
+            return
+        events = os.path.join(widget_log_dir, 'events.log')
+        if not os.path.exists(events):
+            logging.error(f"Battle {job.battle_id}: simulation produced no events.log")
+            self.finish(job, 'no events', elapsed, peak)
+            return
+        shutil.move(events, os.path.join(stats_dir, 'events.log'))
+        self.finish(job, 'succeeded', elapsed, peak)
+        logging.info(f"Battle {job.battle_id}: simulated in {elapsed:.0f}s, peak RSS {(peak or 0) // 2**20}MiB")
+
+    async def sample(self) -> None:
+        '''
+        Keep each running job's RSS up to date, for admission decisions.
+        '''
+        while True:
+            pgids = {job.pgid for job in self._running if job.pgid is not None}
+            if pgids:
+                rss = await asyncio.to_thread(process_group_rss, pgids)
+                for job in self._running:
+                    if job.pgid in rss:
+                        job.rss = rss[job.pgid]
+            await asyncio.sleep(self._poll)
+
+    async def run_all(self, jobs: list[Job]) -> None:
+        pending = list(reversed(jobs))
+        tasks: dict[asyncio.Task, Job] = {}
+        sampler = asyncio.create_task(self.sample())
+        try:
+            while pending or tasks:
+                while (
+                    pending
+                    and len(tasks) < self._jobs
+                    and len(self._free_cores) >= self._cores_per_job
+                    and self._budget.admits(self._running)
+                ):
+                    job = pending.pop()
+                    job.cores = set(self._free_cores[:self._cores_per_job])
+                    del self._free_cores[:self._cores_per_job]
+                    self._running.append(job)
+                    tasks[asyncio.create_task(self.run(job))] = job
+                    logging.debug(f"Battle {job.battle_id}: started on cores {sorted(job.cores)}, {len(tasks)} running")
+                done, _ = await asyncio.wait(tasks, timeout=self._poll, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job = tasks.pop(task)
+                    self._running.remove(job)
+                    self._free_cores = sorted(set(self._free_cores) | job.cores)
+                    if (e := task.exception()) is not None:
+                        logging.error(f"Battle {job.battle_id}: {type(e).__name__}: {e}")
+                        self.finish(job, 'error')
+        finally:
+            sampler.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def pending_jobs(shard_dir: str, excluded: exclusions.Exclusions) -> list[Job]:
+    '''
+    Battles in a shard with a replay but no events.log, loose or packed.
+    '''
+    packed = logpack.load(shard_dir).ids()
+    jobs = []
+    with os.scandir(os.path.join(shard_dir, 'demos')) as it:
+        for entry in it:
+            if not entry.name.isdigit() or int(entry.name) in excluded or int(entry.name) in packed:
+                continue
+            if not os.path.exists(os.path.join(entry.path, 'replay.sdfz')):
+                continue
+            if os.path.exists(os.path.join(shard_dir, 'stats', entry.name, 'events.log')):
+                continue
+            jobs.append(Job(int(entry.name), shard_dir))
+    return sorted(jobs, key=lambda job: job.battle_id)
+
+
+def simulate_metrics() -> Metrics:
+    '''
+    What a run records, as Simulator.finish and main fill it in.
+    '''
+    m = Metrics('simulate')
+    m.histogram('wall_seconds', 'Wall clock time a simulation ran for', LONG_SECONDS)
+    m.histogram('peak_rss_bytes', 'Peak resident set size of a simulation, as /usr/bin/time reports it', BYTES)
+    m.histogram('speed', 'Seconds of game time simulated per second of wall clock time', (1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 100))
+    m.counter('game_seconds_total', 'Seconds of game time simulated')
+    m.counter('battles_total', 'Simulations, by result')
+    m.counter('watchdog_kills_total', 'Simulations killed, by reason')
+    m.counter('triaged_total', 'Replays excluded from their header, so never simulated')
+    m.gauge('budget_bytes', 'Memory simulations were kept within')
+    m.gauge('jobs', 'Most simulations run at once')
+    return m
+
+
+def main():
+    parser = ArgumentParser(description="Simulate replays in parallel, admitting jobs while there is memory for them")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('shards', nargs='+', help='Shard directories to simulate, eg: shards/160')
+    parser.add_argument('--ids', type=int, nargs='+', default=None, help='Only simulate these battle IDs (default: all pending)')
+    parser.add_argument('--zkdir', default=ZKDIR, help=f'Zero-K installation (default: {ZKDIR})')
+    parser.add_argument('--exclude', '-e', default='demos/exclude.txt', help='Exclusion list (default: demos/exclude.txt)')
+    parser.add_argument('--max-sim-time', default='4h', help='Kill and exclude simulations running longer than this (default: 4h)')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Most simulations to run at once (default: available cores / cores per job)')
+    parser.add_argument('--cores-per-job', type=int, default=1, help='Cores to pin each simulation to (default: 1)')
+    parser.add_argument('--memory-budget', type=int, default=None, help="MiB to keep simulations within (default: 90%% of the cgroup's MemoryHigh/MemoryMax, or of available memory)")
+    parser.add_argument('--initial-estimate', type=int, default=1536, help='MiB to expect a simulation to peak at, until one has finished (default: 1536)')
+    parser.add_argument('--margin', type=float, default=1.2, help='Multiple of the expected peak to reserve per simulation (default: 1.2)')
+    parser.add_argument('--summary-only', action='store_true', help='Stop each simulation once the widget has every event a summary needs, without Game End Stats')
+    parser.add_argument('--summary-frames', type=int, default=54000, help='With --summary-only, stop by this frame at the latest, cutting factory progressions short; 0 for no limit (default: 54000)')
+    parser.add_argument('--no-triage', action='store_true', help="Simulate replays even if their header shows they'll be skipped")
+    parser.add_argument('--metrics', default=None, help='Write textfile metrics and a run report to this directory, eg: metrics (default: none)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    if args.memory_budget is not None:
+        budget = args.memory_budget * 2**20
+    else:
+        budget = int(0.9 * (cgroup_memory_limit() or mem_available()))
+    cores = len(os.sched_getaffinity(0))
+    jobs = args.jobs or max(1, cores // args.cores_per_job)
+
+    excluded = exclusions.load(args.exclude)
+    work = []
+    for shard_dir in args.shards:
+        if args.ids:
+            work.extend(Job(i, shard_dir) for i in args.ids if os.path.exists(os.path.join(shard_dir, 'demos', str(i), 'replay.sdfz')))
+        else:
+            work.extend(pending_jobs(shard_dir, excluded))
+    run_metrics = simulate_metrics() if args.metrics else None
+    if not args.no_triage:
+        pending = len(work)
+        work = [job for job in work if not sdfz.exclude_if_skipped(args.exclude, job.battle_id, os.path.join(job.shard_dir, 'demos', str(job.battle_id), 'replay.sdfz'))]
+        if run_metrics is not None:
+            run_metrics.inc('triaged_total', pending - len(work))
+    logging.info(f"Simulating {len(work)} battles, up to {jobs} at once within {budget // 2**20}MiB")
+
+    simulator = Simulator(
+        args.zkdir,
+        parse_duration(args.max_sim_time),
+        jobs,
+        args.cores_per_job,
+        MemoryBudget(budget, args.initial_estimate * 2**20, args.margin),
+        args.exclude,
+        args.summary_frames if args.summary_only else None,
+        run_metrics,
+    )
+    try:
+        asyncio.run(simulator.run_all(work))
+    finally:
+        if run_metrics is not None:
+            run_metrics.set('budget_bytes', budget)
+            run_metrics.set('jobs', jobs)
+            run_metrics.write(args.metrics, success=simulator.failed == 0)
+    logging.info(f"Simulated {simulator.succeeded} battles, {simulator.failed} failed")
+    sys.exit(1 if simulator.failed else 0)
+
+if __name__ == '__main__':
+    main()
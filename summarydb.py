@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+'''
+SQLite store of battle summaries, in place of one summary.json per battle.
+
+Inputs:
+    summaries/summaries.db
+    shards/<shard>/summaries/<id>/summary.json (import only)
+
+Outputs:
+    summaries/summaries.db
+    stdout (export only)
+
+One row per battle, keyed by gameid, holding the summary exactly as
+postprocess.py would have written it, plus the mtime of the events.log it
+was summarised from. postprocess.py --batch --db writes here directly, and
+aggregate.py --db publishes all.json from it in a single scan in gameid
+order.
+
+The database is in WAL mode, so aggregate.py and the dashboard tooling can
+read while postprocess.py writes. Every write transaction bumps a
+generation counter, so readers can cheaply tell whether anything changed.
+
+Usage:
+    summarydb.py import [--db PATH] SHARD_DIR...   Load existing summary.json files
+    summarydb.py export [--db PATH]                Print all published summaries as a JSON array
+    summarydb.py stats [--db PATH]
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+SCHEMA_VERSION = 1
+DEFAULT_PATH = 'summaries/summaries.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS summaries (
+    gameid INTEGER PRIMARY KEY,
+    skip INTEGER NOT NULL,
+    started TEXT,
+    map TEXT,
+    winner_fac TEXT,
+    loser_fac TEXT,
+    -- st_mtime_ns of the events.log this was summarised from
+    source_mtime INTEGER NOT NULL,
+    -- Generation of the transaction which last wrote this row
+    generation INTEGER NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS summaries_started ON summaries (started);
+CREATE INDEX IF NOT EXISTS summaries_map ON summaries (map);
+CREATE INDEX IF NOT EXISTS summaries_facs ON summaries (winner_fac, loser_fac);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+'''
+
+
+@dataclass(slots=True, frozen=True)
+class StoredSummary:
+    gameid: int
+    source_mtime: int
+    summary: dict
+
+
+def first_factory(progression: list[str] | None) -> str | None:
+    if progression is None:
+        return None
+    return progression[0] if progression else 'Never'
+
+
+class SummaryStore:
+    def __init__(self, path: str = DEFAULT_PATH, readonly: bool = False) -> None:
+        self.path = path
+        if readonly:
+            self._db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=60)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=60)
+        # Transactions are managed explicitly, one per put_many
+        self._db.isolation_level = None
+        if not readonly:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # Durable across application crashes, which is all we need: summaries can always be regenerated
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._migrate()
+
+    def _migrate(self) -> None:
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        if version not in (0, SCHEMA_VERSION):
+            raise RuntimeError(f"{self.path} has schema version {version}, expected {SCHEMA_VERSION}")
+        self._db.executescript(SCHEMA)
+        self._db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> SummaryStore:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    @property
+    def generation(self) -> int:
+        return self._db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT count(*) FROM summaries').fetchone()[0]
+
+    def count_skipped(self) -> int:
+        return self._db.execute('SELECT count(*) FROM summaries WHERE skip').fetchone()[0]
+
+    def put_many(self, summaries: Iterable[StoredSummary]) -> int:
+        '''
+        Insert or replace summaries, in one transaction. Returns the number written.
+        '''
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            generation = self.generation
+            cursor = self._db.executemany(
+                'INSERT OR REPLACE INTO summaries (gameid, skip, started, map, winner_fac, loser_fac, source_mtime, generation, body) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (
+                        s.gameid,
+                        int(s.summary.get('skip', False)),
+                        s.summary.get('started'),
+                        s.summary.get('map'),
+                        first_factory(s.summary.get('winner_fac_prog')),
+                        first_factory(s.summary.get('loser_fac_prog')),
+                        s.source_mtime,
+                        generation,
+                        json.dumps(s.summary),
+                    )
+                    for s in summaries
+                ),
+            )
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return cursor.rowcount
+
+    def source_mtimes(self, low: int, high: int) -> dict[int, int]:
+        '''
+        The events.log mtime each stored battle in [low, high] was summarised from.
+        '''
+        return dict(self._db.execute('SELECT gameid, source_mtime FROM summaries WHERE gameid BETWEEN ? AND ?', (low, high)))
+
+    def mismatched(self, low: int, high: int, key: str, expected: dict, default: dict) -> list[int]:
+        '''
+        Battles in [low, high] whose summary's key isn't expected, taking it to be default where it's missing.
+        '''
+        compact = lambda value: json.dumps(value, separators=(',', ':'))
+        return [gameid for gameid, in self._db.execute(
+            'SELECT gameid FROM summaries WHERE gameid BETWEEN ? AND ? AND coalesce(json_extract(body, ?), ?) IS NOT ?',
+            (low, high, f'$.{key}', compact(default), compact(expected)),
+        )]
+
+    def get(self, gameid: int) -> dict | None:
+        row = self._db.execute('SELECT body FROM summaries WHERE gameid = ?', (gameid,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def published(self) -> Iterator[tuple[int, str]]:
+        '''
+        (gameid, summary JSON) for every battle not marked skip, in gameid order. A scan of the table in rowid order.
+        '''
+        yield from self._db.execute('SELECT gameid, body FROM summaries WHERE skip = 0 ORDER BY gameid')
+
+
+def import_shards(store: SummaryStore, shards: list[str], batch_size: int = 5000) -> int:
+    '''
+    Load the summary.json files under each shard into the store. Returns the number imported.
+    '''
+    imported = 0
+    pending: list[StoredSummary] = []
+    for shard in shards:
+        summaries_dir = os.path.join(shard, 'summaries')
+        with os.scandir(summaries_dir) as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                path = os.path.join(entry.path, 'summary.json')
+                try:
+                    with open(path, 'r') as f:
+                        text = f.read().strip()
+                    # Taken to be as new as the events.log it came from; newer events.logs will be resummarised
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if not text:
+                    logging.warning(f"Empty summary at {path}, ignoring")
+                    continue
+                pending.append(StoredSummary(int(entry.name), mtime, json.loads(text)))
+                if len(pending) >= batch_size:
+                    imported += store.put_many(pending)
+                    pending = []
+        logging.info(f"Imported {shard}, {imported + len(pending)} battles so far")
+    if pending:
+        imported += store.put_many(pending)
+    return imported
+
+
+def main():
+    parser = ArgumentParser(description="SQLite store of battle summaries")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    parser.add_argument('--db', '-d', default=DEFAULT_PATH, help=f'Summary database (default: {DEFAULT_PATH})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Load existing summary.json files from shards')
+    import_parser.add_argument('shards', nargs='+', help='Shard directories to import, eg: shards/160')
+    subparsers.add_parser('export', help='Print all published summaries as a JSON array')
+    subparsers.add_parser('stats', help='Print counts from the store')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+    match args.command:
+        case 'import':
+            with SummaryStore(args.db) as store:
+                imported = import_shards(store, args.shards)
+                logging.info(f"Imported {imported} summaries, {len(store)} in {args.db}")
+        case 'export':
+            with SummaryStore(args.db, readonly=True) as store:
+                sys.stdout.write('[')
+                for i, (_, body) in enumerate(store.published()):
+                    sys.stdout.write(',' + body if i else body)
+                sys.stdout.write(']\n')
+        case 'stats':
+            with SummaryStore(args.db, readonly=True) as store:
+                print(json.dumps({'battles': len(store), 'skipped': store.count_skipped(), 'generation': store.generation}))
+
+if __name__ == '__main__':
+    main()
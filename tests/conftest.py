@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts under test live at the top of the repository, and import each other from there
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,51 @@
+'''
+detail.parse on saved ZKI battle pages in fixtures/detail, one from before and one from after the replay file name
+timestamp format changed in 105.1.1-2314.
+'''
+
+import os
+
+import pytest
+
+import detail
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'detail')
+
+EXPECTED = {
+    1606223: detail.BattleDetail(
+        gameid=1606223,
+        map='Fairyland 1.31',
+        map_id=7514,
+        started='2023-01-02 03:04:05',
+        engine='105.1.1-2314-g9e0bf7d',
+        game='Zero-K v1.11.4.0',
+        replay='2023-01-02_03-04-05-678_Fairyland 1.31_105.1.1-2314-g9e0bf7d.sdfz',
+        players={'Nightwatch': '1', 'Bob': '67890', 'Alice': '12345', 'Carol': '555'},
+        winner='Alice',
+    ),
+    855246: detail.BattleDetail(
+        gameid=855246,
+        map='Comet Catcher Redux',
+        map_id=3512,
+        started='2020-03-04 05:06:07',
+        engine='104.0.1-1435-g79d77ca',
+        game='Zero-K v1.8.3.5',
+        replay='20200304_050607_Comet Catcher Redux_104.0.1-1435-g79d77ca.sdfz',
+        players={'1234567890': '4242', 'Winnerwinner': '9001'},
+        winner='1234567890',
+    ),
+}
+
+@pytest.mark.parametrize('gameid', sorted(EXPECTED))
+def test_parse(gameid):
+    html = detail.read_html(os.path.join(FIXTURES, f'{gameid}.html'))
+    assert detail.parse(gameid, html) == EXPECTED[gameid]
+
+def test_no_winner():
+    # Text mentioning a winner is not the winning team's box
+    html = detail.read_html(os.path.join(FIXTURES, '1606223.html')).replace('battle_winner', 'battle_loser')
+    assert detail.parse(1606223, html).winner is None
+
+def test_round_trip():
+    record = EXPECTED[1606223]
+    assert detail.BattleDetail.from_json(record.to_json()) == record
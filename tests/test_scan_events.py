@@ -0,0 +1,157 @@
+'''
+postprocess.scan_events against the regex per pattern parser it replaced, on the events.logs in fixtures/events.
+
+Both must agree on whether each battle is skipped, on its winner and duration, and on the players and factories,
+and so on the summaries written from them.
+'''
+
+import os
+import re
+
+import pytest
+
+import postprocess
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'events')
+LOGS = sorted(name for name in os.listdir(FIXTURES) if name.endswith('.log'))
+
+# A detail record: (map, started, name_to_userid, spring version, zk version). See: postprocess.scan_detail
+DETAIL = ('Comet Catcher Redux', '2023-04-01T12:34:56', {'Alice': '101', 'Bob': '102'}, '105.1.1-1544-g058c8ea BAR105', 'Zero-K v1.11.4.0')
+
+#
+# The parser from before scan_events dispatched on message prefixes, as it was
+#
+
+playerinfo = re.compile(r'\[(?:0|1)\] (?P<name>.*), team: (?P<teamid>[0-9]+), elo:(?P<elo>[0-9]+)(?:, userid: (?P<userid>[0-9]+))?(?:, ai: (?P<ai>.*))?')
+facplop = re.compile(r'\[(?P<frame>[0-9]+)\] Event \[(?P<location>[^\]]+)\]: (?P<teamid>[0-9]+) finished unit (?P<fac>Cloakbot Factory|Shieldbot Factory|Rover Assembly|Hovercraft Platform|Gunship Plant|Airplane Plant|Spider Factory|Jumpbot Factory|Tank Foundry|Amphbot Factory|Shipyard|Strider Hub)')
+winner = re.compile(r'\[(?P<frame>[0-9]+)\] Received game_message: (?P<name>.*) wins!')
+statsheader = re.compile(r'\[(?P<frame>[0-9]+)\] Game End Stats Header: ')
+
+class SkipCondition(object):
+    def __init__(self, why, expr, extra=lambda win: True):
+        self.why = why
+        self.expr = re.compile(expr)
+        self.extra = extra
+
+    def satisfied(self, line, win):
+        return self.expr.match(line) and self.extra(win)
+
+skip_conditions = [
+    SkipCondition('Game Draw', r'\[(?P<frame>[0-9]+)\] Received game_message: The game ended in a draw!'),
+    SkipCondition('Autohost exit', r'\[(?P<frame>[0-9]+)\] autohost exit'),
+    SkipCondition('No start placement', r'\[(?P<frame>[0-9]+)\] player nonplacement'),
+    SkipCondition('All players disconnected', r'\[(?P<frame>[0-9]+)\] all players disconnected', lambda win: win == None),
+]
+
+def baseline_scan_events(filename):
+    win = None
+    duration = None
+    skip = False
+    teamid_to_player = {}
+    name_to_player = {}
+    with open(filename, 'r') as f:
+        for line in f.readlines():
+            m = playerinfo.match(line)
+            if m:
+                p = m.groupdict()
+                if p['name'] == '?':
+                    continue
+                p['facplop'] = []
+                teamid_to_player[p['teamid']] = p
+                name_to_player[p['name']] = p
+                continue
+            m = facplop.match(line)
+            if m:
+                p = teamid_to_player[m.group('teamid')]
+                p['facplop'].append(m.group('fac'))
+                continue
+            m = winner.match(line)
+            if m:
+                duration = m.group('frame')
+                win = m.group('name')
+                continue
+            for sc in skip_conditions:
+                if sc.satisfied(line, win):
+                    skip = True
+                    break
+            if skip:
+                break
+            if win is None:
+                continue
+            m = statsheader.match(line)
+            if m:
+                break
+    return skip, win, duration, teamid_to_player, name_to_player
+
+def baseline_summarise(filename, id):
+    battlemap, started, name_to_userid, sp, zk = DETAIL
+    skip, win, duration, teamid_to_player, name_to_player = baseline_scan_events(filename)
+    if skip:
+        return {'skip': True}
+    winning_player, losing_player = postprocess.player_data_by_winning(name_to_player, win, name_to_userid)
+    return {
+        'winner_elo_lead': int(winning_player['elo']) - int(losing_player['elo']),
+        'winner_elo': int(winning_player['elo']),
+        'loser_elo': int(losing_player['elo']),
+        'winner_fac': winning_player['facplop'][0] if len(winning_player['facplop']) else 'Never',
+        'winner_fac_prog': winning_player['facplop'],
+        'loser_fac': losing_player['facplop'][0] if len(losing_player['facplop']) else 'Never',
+        'loser_fac_prog': losing_player['facplop'],
+        'winner_userid': winning_player['userid'],
+        'loser_userid': losing_player['userid'],
+        'duration': int(duration),
+        'gameid': id,
+        'started': started,
+        'map': battlemap or 'Unknown',
+        'zk_version': zk,
+        'spring_version': sp,
+    }
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(postprocess, 'verbose', False)
+    monkeypatch.setattr(postprocess, 'scan_detail', lambda id, base='.': DETAIL)
+
+@pytest.mark.parametrize('name', LOGS)
+def test_scan_events(name):
+    path = os.path.join(FIXTURES, name)
+    stats = {}
+    skip, win, duration, teamid_to_player, name_to_player, summary_only = postprocess.scan_events(open(path, 'r'), stats)
+    assert (skip, win, duration, teamid_to_player, name_to_player) == baseline_scan_events(path)
+    assert not summary_only
+    assert (stats['skip'] is not None) == skip
+
+@pytest.mark.parametrize('name', LOGS)
+def test_battle_events(name):
+    path = os.path.join(FIXTURES, name)
+    assert postprocess.Battle(path, 1234567).events == baseline_scan_events(path)
+
+@pytest.mark.parametrize('name', [name for name in LOGS if name != 'no_winner.log'])
+def test_summarise(name):
+    path = os.path.join(FIXTURES, name)
+    summary = postprocess.summarise(path, 1234567)
+    assert summary.pop('extractors') == postprocess.current_versions()
+    assert summary == baseline_summarise(path, 1234567)
+
+def test_no_winner():
+    # Neither parser can say who won, so neither can write a summary
+    path = os.path.join(FIXTURES, 'no_winner.log')
+    with pytest.raises(KeyError):
+        baseline_summarise(path, 1234567)
+    with pytest.raises(KeyError):
+        postprocess.summarise(path, 1234567)
+
+@pytest.mark.parametrize('name, why', [
+    ('win.log', None),
+    ('draw.log', 'Game Draw'),
+    ('autohost_exit.log', 'Autohost exit'),
+    ('nonplacement.log', 'No start placement'),
+    ('disconnected_no_winner.log', 'All players disconnected'),
+    ('disconnected_after_winner.log', None),
+    ('malformed.log', None),
+])
+def test_fixture_covers(name, why):
+    # Every skip condition is met by some fixture, and all players disconnecting only skips a battle without a winner
+    stats = {}
+    postprocess.scan_events(open(os.path.join(FIXTURES, name), 'r'), stats)
+    assert stats['skip'] == why
@@ -0,0 +1,61 @@
+'''
+whrjoin.WHRData.join on summaries as postprocess.py writes them, against getwhr.py's outputs.
+'''
+
+import json
+import os
+
+import pytest
+
+import postprocess
+import whrjoin
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'events')
+GAMEID = 1606223
+
+# A detail record: (map, started, name_to_userid, spring version, zk version). See: postprocess.scan_detail
+DETAIL = ('Fairyland 1.31', '2023-01-02 03:04:05', {'Alice': '101', 'Bob': '102'}, '105.1.1-2314-g9e0bf7d', 'Zero-K v1.11.4.0')
+
+@pytest.fixture
+def summary(monkeypatch):
+    monkeypatch.setattr(postprocess, 'verbose', False)
+    monkeypatch.setattr(postprocess, 'scan_detail', lambda id, base='.': DETAIL)
+    # Alice, userid 101 and Elo 1612, beats Bob, userid 102 and Elo 1544
+    return postprocess.summarise(os.path.join(FIXTURES, 'win.log'), GAMEID)
+
+def whr_data(tmp_path, players):
+    path = tmp_path / 'fullwhr.json'
+    path.write_text(json.dumps([{'id': GAMEID, 'players': players}]))
+    return whrjoin.WHRData.load(str(path))
+
+def test_available(tmp_path, summary):
+    data = whr_data(tmp_path, [
+        {'rating': 1566.5, 'stdev': 110.25, 'accountId': 101},
+        {'rating': 1409.5, 'stdev': 137.75, 'accountId': 102},
+    ])
+    record = data.join(summary)
+    assert record['has_fullwhr'] == 'Available'
+    assert (record['winner_whr'], record['winner_whr_stdev']) == (1566.5, 110.25)
+    assert (record['loser_whr'], record['loser_whr_stdev']) == (1409.5, 137.75)
+    assert record['winner_whr_lead'] == 157
+
+def test_server_sourced_null(tmp_path, summary):
+    data = whr_data(tmp_path, [
+        {'rating': None, 'stdev': None, 'accountId': 101},
+        {'rating': 1409.5, 'stdev': 137.75, 'accountId': 102},
+    ])
+    record = data.join(summary)
+    assert record['has_fullwhr'] == 'Server-sourced null'
+    # The winner falls back to their Elo
+    assert (record['winner_whr'], record['winner_whr_stdev']) == (1612, whrjoin.FALLBACK_STDEV)
+    assert (record['loser_whr'], record['loser_whr_stdev']) == (1409.5, 137.75)
+    assert record['winner_whr_lead'] == 1612 - 1409.5
+
+def test_mismatch(tmp_path, summary):
+    data = whr_data(tmp_path, [
+        {'rating': 1566.5, 'stdev': 110.25, 'accountId': 101},
+        {'rating': 1409.5, 'stdev': 137.75, 'accountId': 103},
+    ])
+    record = data.join(summary)
+    assert record['has_fullwhr'] == 'UserID mismatch'
+    assert record['winner_whr_lead'] == 1612 - 1544
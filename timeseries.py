@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+'''
+Keep the Game End Stats time series the replay stats widget writes, in a
+memory mapped columnar store per shard.
+
+Inputs, relative to a shard directory:
+    stats/<id>/events.log (or stats/logs.pack, see logpack.py)
+
+Outputs, relative to a shard directory:
+    stats/timeseries.json (header: version, dtype, stat names)
+    stats/timeseries.f32 (data)
+    stats/timeseries.index.npy (offset table)
+
+The widget ends each events.log with a header naming a column per team and
+statistic, eg team0_metal_income, then one row of values per history frame.
+Each battle becomes one block of float32s in the data file, shaped
+(statistic, team, sample) in C order, so one statistic of one battle is one
+contiguous run. Missing values ("-") are stored as NaN. Only the per team
+columns are kept: in a 1v1, each ally team is just its one team.
+
+The offset table is a sorted NumPy structured array with one row per
+battle, giving the block's offset into the data file, its sample and team
+counts, the team IDs in block order, and the events.log mtime it was read
+from. Both files are opened with mmap, so reading a statistic across every
+battle in a shard is a couple of vectorised gathers, with no text parsed.
+See: TimeSeriesStore.matrix
+
+Blocks are only ever appended. A battle whose events.log changed gets a new
+block, and the offset table is rewritten atomically to point at it, so a
+reader never sees a half written battle. Space held by replaced blocks is
+reclaimed with --compact. Data past the end of the last block, left by an
+interrupted build, is truncated on the next one.
+
+Usage:
+    timeseries.py build [--compact] SHARD_DIR...
+    timeseries.py curve [--samples N] STAT SHARD_DIR...
+'''
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from collections.abc import Iterable
+import io
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+import logpack
+
+# Bump if the layout changes, to rebuild every store from scratch
+TIMESERIES_VERSION = 1
+DTYPE = np.dtype('<f4')
+MAX_TEAMS = 8
+
+# Every statistic the widget records. See: rulesParamStats and directStats in Widgets/replay_stats.lua
+STATS = (
+    'metalProduced',
+    'metalUsed',
+    'metal_excess',
+    'metal_overdrive',
+    'metal_reclaim',
+    'unit_value',
+    'unit_value_army',
+    'unit_value_def',
+    'unit_value_econ',
+    'unit_value_other',
+    'unit_value_killed',
+    'unit_value_lost',
+    'metal_income',
+    'energy_income',
+    'damage_dealt',
+    'damage_received',
+)
+STAT_INDEX = {name: i for i, name in enumerate(STATS)}
+
+INDEX_DTYPE = np.dtype([
+    ('gameid', '<u4'),
+    # In values, not bytes
+    ('offset', '<u8'),
+    ('samples', '<u4'),
+    ('teams', '<u1'),
+    # -1 for unused slots
+    ('team_ids', '<i2', (MAX_TEAMS,)),
+    ('source_mtime', '<i8'),
+])
+
+HEADER_PREFIX = 'Game End Stats Header: '
+VALUES_PREFIX = 'Game End Stats Values: '
+
+
+def parse_stats(text: str) -> tuple[list[int], np.ndarray] | None:
+    '''
+    The team IDs, and a (statistic, team, sample) array, from the Game End Stats at the end of an events.log.
+    None if the log has no stats.
+    '''
+    start = text.rfind(HEADER_PREFIX)
+    if start < 0:
+        return None
+    lines = iter(text[start:].splitlines())
+    columns = next(lines)[len(HEADER_PREFIX):].split(',')
+    rows = []
+    for line in lines:
+        _, _, message = line.partition('] ')
+        if not message.startswith(VALUES_PREFIX):
+            break
+        rows.append(message[len(VALUES_PREFIX):].replace('"-"', 'nan'))
+    if not rows:
+        return None
+    values = np.loadtxt(io.StringIO('\n'.join(rows)), delimiter=',', dtype=np.float64, ndmin=2)
+    if values.shape[1] != len(columns):
+        raise ValueError(f"{len(columns)} columns in the header, but {values.shape[1]} in the values")
+
+    # Column names are team<id>_<stat> or allyTeam<id>_<stat>, in whatever order the widget's tables iterated in
+    placement = []
+    team_ids = set()
+    for i, column in enumerate(columns):
+        if not column.startswith('team'):
+            continue
+        team, _, stat = column[len('team'):].partition('_')
+        if team.isdigit() and stat in STAT_INDEX:
+            placement.append((i, int(team), STAT_INDEX[stat]))
+            team_ids.add(int(team))
+    teams = sorted(team_ids)
+    if not teams:
+        return None
+    if len(teams) > MAX_TEAMS:
+        raise ValueError(f"{len(teams)} teams, at most {MAX_TEAMS} are supported")
+    team_slot = {team: slot for slot, team in enumerate(teams)}
+    block = np.full((len(STATS), len(teams), len(rows)), np.nan, dtype=DTYPE)
+    for column, team, stat in placement:
+        block[stat, team_slot[team]] = values[:, column]
+    return teams, block
+
+
+def paths(shard_dir: str) -> tuple[str, str, str]:
+    stats_dir = os.path.join(shard_dir, 'stats')
+    return (
+        os.path.join(stats_dir, 'timeseries.json'),
+        os.path.join(stats_dir, 'timeseries.f32'),
+        os.path.join(stats_dir, 'timeseries.index.npy'),
+    )
+
+
+class TimeSeriesStore:
+    '''
+    A shard's time series, read through mmap.
+    '''
+    def __init__(self, shard_dir: str) -> None:
+        header_path, data_path, index_path = paths(shard_dir)
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        if header['version'] != TIMESERIES_VERSION or header['stats'] != list(STATS):
+            raise ValueError(f"{header_path} is from another version, rebuild it")
+        self.index = np.load(index_path, mmap_mode='r')
+        end = int((self.index['offset'] + self.index['samples'].astype(np.uint64) * self.index['teams'] * len(STATS)).max(initial=0))
+        self.data = np.memmap(data_path, dtype=DTYPE, mode='r', shape=(end,)) if end else np.empty(0, dtype=DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, gameid: int) -> bool:
+        i = np.searchsorted(self.index['gameid'], gameid)
+        return bool(i < len(self.index) and self.index['gameid'][i] == gameid)
+
+    def series(self, gameid: int, stat: str) -> tuple[list[int], np.ndarray]:
+        '''
+        The team IDs, and a (team, sample) array of one statistic for one battle. Both are empty if it had no stats.
+        '''
+        i = np.searchsorted(self.index['gameid'], gameid)
+        if i >= len(self.index) or self.index['gameid'][i] != gameid:
+            raise KeyError(gameid)
+        row = self.index[i]
+        teams, samples = int(row['teams']), int(row['samples'])
+        start = int(row['offset']) + STAT_INDEX[stat] * teams * samples
+        return row['team_ids'][:teams].tolist(), np.asarray(self.data[start:start + teams * samples]).reshape(teams, samples)
+
+    def matrix(self, stat: str, samples: int, teams: int = 2) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        The battle IDs, and a (battle, team slot, sample) array of one statistic across every battle in the shard,
+        truncated or NaN padded to samples, for battles with exactly this many teams.
+        '''
+        index = self.index[self.index['teams'] == teams]
+        n = index['samples'].astype(np.int64)
+        # Where each team's run of this statistic starts, for each battle
+        base = index['offset'].astype(np.int64) + STAT_INDEX[stat] * teams * n
+        starts = base[:, None] + np.arange(teams)[None, :] * n[:, None]
+        t = np.arange(samples)
+        positions = starts[:, :, None] + t[None, None, :]
+        present = np.broadcast_to((t[None, :] < n[:, None])[:, None, :], positions.shape)
+        values = np.where(present, self.data[np.where(present, positions, 0)] if len(self.data) else np.nan, np.nan)
+        return index['gameid'].copy(), values.astype(DTYPE)
+
+
+def build(shard_dir: str, compact: bool = False) -> tuple[int, int]:
+    '''
+    Add or replace the time series of every battle whose events.log is newer than its block. Returns (added, failed).
+    '''
+    header_path, data_path, index_path = paths(shard_dir)
+    index = np.empty(0, dtype=INDEX_DTYPE)
+    try:
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        if header['version'] == TIMESERIES_VERSION and header['stats'] == list(STATS):
+            index = np.load(index_path)
+        else:
+            logging.info(f"{header_path} is from another version, rebuilding")
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    known = {int(row['gameid']): int(row['source_mtime']) for row in index}
+
+    mtimes = {}
+    with os.scandir(os.path.join(shard_dir, 'stats')) as it:
+        for entry in it:
+            if not entry.name.isdigit():
+                continue
+            try:
+                mtimes[int(entry.name)] = os.stat(os.path.join(entry.path, 'events.log')).st_mtime_ns
+            except FileNotFoundError:
+                continue
+    # A loose events.log is newer than any packed one
+    for entry in logpack.load(shard_dir).members('events.log'):
+        mtimes.setdefault(entry.gameid, entry.mtime)
+    events = {gameid: mtime for gameid, mtime in mtimes.items() if known.get(gameid) != mtime}
+    if not events and not compact:
+        return 0, 0
+
+    rows = {int(row['gameid']): row.copy() for row in index}
+    end = int((index['offset'] + index['samples'].astype(np.uint64) * index['teams'] * len(STATS)).max(initial=0))
+    data_in = None
+    # Rows of battles being replaced, whose old blocks aren't copied into a compacted file unless reparsing them fails
+    replaced = {}
+    if compact or not len(index):
+        data_in = np.memmap(data_path, dtype=DTYPE, mode='r') if compact and end else None
+        out = open(data_path + '.tmp', 'wb')
+        position = 0
+        replaced = {gameid: rows.pop(gameid) for gameid in events if gameid in rows}
+        # Copy the blocks we're keeping, in battle order, leaving out anything replaced
+        for gameid in sorted(rows):
+            row = rows[gameid]
+            size = int(row['samples']) * int(row['teams']) * len(STATS)
+            if size:
+                out.write(np.asarray(data_in[int(row['offset']):int(row['offset']) + size]).tobytes())
+            row['offset'] = position
+            position += size
+    else:
+        out = open(data_path, 'r+b')
+        # Anything past the last block was left by an interrupted build
+        out.truncate(end * DTYPE.itemsize)
+        out.seek(0, os.SEEK_END)
+        position = end
+
+    added = failed = 0
+    with out:
+        for gameid in sorted(events):
+            try:
+                with logpack.open_log(shard_dir, gameid) as f:
+                    parsed = parse_stats(f.read())
+            except (OSError, ValueError) as e:
+                logging.warning(f"Battle {gameid}: {type(e).__name__}: {e}")
+                failed += 1
+                if gameid in replaced:
+                    # Keep the old series until the log can be read, as a build that isn't compacting does
+                    row = replaced[gameid]
+                    size = int(row['samples']) * int(row['teams']) * len(STATS)
+                    if size:
+                        out.write(np.asarray(data_in[int(row['offset']):int(row['offset']) + size]).tobytes())
+                    row['offset'] = position
+                    rows[gameid] = row
+                    position += size
+                continue
+            # Battles without stats get an empty row, so their logs aren't reread by every build
+            teams, block = parsed if parsed is not None else ([], np.empty((len(STATS), 0, 0), dtype=DTYPE))
+            out.write(block.tobytes(order='C'))
+            row = np.zeros((), dtype=INDEX_DTYPE)
+            row['gameid'] = gameid
+            row['offset'] = position
+            row['samples'] = block.shape[2]
+            row['teams'] = len(teams)
+            row['team_ids'] = teams + [-1] * (MAX_TEAMS - len(teams))
+            row['source_mtime'] = events[gameid]
+            rows[gameid] = row
+            position += block.size
+            added += 1
+        out.flush()
+        os.fsync(out.fileno())
+    del data_in
+
+    new_index = np.array([rows[gameid] for gameid in sorted(rows)], dtype=INDEX_DTYPE)
+    # Data first, then the index that refers to it, then the header that describes them both
+    if compact or not len(index):
+        os.replace(data_path + '.tmp', data_path)
+    with open(index_path + '.tmp', 'wb') as f:
+        np.save(f, new_index)
+    os.replace(index_path + '.tmp', index_path)
+    with open(header_path + '.tmp', 'w') as f:
+        json.dump({'version': TIMESERIES_VERSION, 'dtype': DTYPE.str, 'stats': list(STATS), 'max_teams': MAX_TEAMS}, f)
+    os.replace(header_path + '.tmp', header_path)
+    return added, failed
+
+
+def curve(shards: Iterable[str], stat: str, samples: int) -> None:
+    '''
+    Print the median and interquartile range of a statistic at each sample, across every 1v1 in the shards.
+    '''
+    matrices = []
+    for shard_dir in shards:
+        try:
+            store = TimeSeriesStore(shard_dir)
+        except FileNotFoundError:
+            continue
+        matrices.append(store.matrix(stat, samples)[1])
+    values = np.concatenate(matrices) if matrices else np.empty((0, 2, samples), dtype=DTYPE)
+    # Battles still going at each sample
+    battles = (~np.isnan(values)).any(axis=1).sum(axis=0)
+    print('sample\tbattles\tp25\tmedian\tp75')
+    for t in range(samples):
+        column = values[:, :, t].ravel()
+        column = column[~np.isnan(column)]
+        if not len(column):
+            break
+        p25, median, p75 = np.percentile(column, [25, 50, 75])
+        print(f'{t}\t{battles[t]}\t{p25:g}\t{median:g}\t{p75:g}')
+
+
+def main():
+    parser = ArgumentParser(description="Keep Game End Stats time series in a memory mapped columnar store per shard")
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Add the time series of new or changed battles')
+    build_parser.add_argument('shards', nargs='+', help='Shard directories, eg: shards/160')
+    build_parser.add_argument('--compact', action='store_true', help='Rewrite the data file without replaced blocks')
+    curve_parser = subparsers.add_parser('curve', help='Print the spread of a statistic over time, across every 1v1')
+    curve_parser.add_argument('stat', choices=STATS, help='Statistic, eg: metal_income')
+    curve_parser.add_argument('shards', nargs='+', help='Shard directories, eg: shards/160')
+    curve_parser.add_argument('--samples', type=int, default=60, help='How many history frames to show (default: 60)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s [%(asctime)s] %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    match args.command:
+        case 'build':
+            failed = 0
+            for shard_dir in args.shards:
+                added, shard_failed = build(shard_dir, args.compact)
+                failed += shard_failed
+                if added or shard_failed:
+                    logging.info(f"Shard {shard_dir}: {added} battles added, {shard_failed} failed")
+            sys.exit(1 if failed else 0)
+        case 'curve':
+            curve(args.shards, args.stat, args.samples)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Join getwhr.py's WHR ratings onto published summaries.
+
+Inputs:
+    demos/fullwhr.json
+    demos/fullwhr-skipped.json
+    demos/fullwhr-missing.json
+
+The same fields assignWhr in public/js/dvis.js derives in the browser with
+#fullwhr: has_fullwhr, the winner's and loser's WHR and its stdev, and the
+winner's WHR lead, falling back to Elo where there's no rating. Records
+which already have has_fullwhr are used as they are by the dashboard.
+
+Each battle's WHR inputs are boiled down to a short key, so aggregate.py
+can store it in its index, and only rejoin battles whose key changed when
+getwhr.py's outputs do. See: aggregate.py --whr
+'''
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+
+WHR_FIELDS = ('has_fullwhr', 'winner_whr', 'winner_whr_stdev', 'loser_whr', 'loser_whr_stdev', 'winner_whr_lead')
+# There's no best approximation of stdev for an Elo standing in for a rating
+FALLBACK_STDEV = 80
+
+
+def input_paths(fullwhr: str) -> tuple[str, str, str]:
+    '''
+    The ratings, skipped and missing outputs of getwhr.py, named as its defaults are.
+    '''
+    base, ext = os.path.splitext(fullwhr)
+    return fullwhr, f'{base}-skipped{ext}', f'{base}-missing{ext}'
+
+
+@dataclass(slots=True)
+class WHRData:
+    # Battle ID -> account ID, as a string as summaries' userids are -> that player's rating and stdev
+    ratings: dict[int, dict[str, dict]]
+    skipped: set[int]
+    missing: set[int]
+
+    @staticmethod
+    def load(fullwhr: str) -> WHRData:
+        ratings_path, skipped_path, missing_path = input_paths(fullwhr)
+        with open(ratings_path, 'r') as f:
+            ratings = {battle['id']: {str(player['accountId']): player for player in battle['players']} for battle in json.load(f)}
+        ids = []
+        for path in (skipped_path, missing_path):
+            try:
+                with open(path, 'r') as f:
+                    ids.append(set(json.load(f)))
+            except FileNotFoundError:
+                ids.append(set())
+        return WHRData(ratings, *ids)
+
+    def key(self, gameid: int) -> str:
+        '''
+        A digest of everything the join reads for this battle.
+        '''
+        if gameid in self.ratings:
+            state = sorted(self.ratings[gameid].items())
+        elif gameid in self.skipped:
+            state = 'skipped'
+        elif gameid in self.missing:
+            state = 'missing'
+        else:
+            state = None
+        return hashlib.blake2b(json.dumps(state, separators=(',', ':')).encode(), digest_size=8).hexdigest()
+
+    def join(self, record: dict) -> dict:
+        '''
+        Set the WHR fields of an enriched record, as assignWhr would.
+        '''
+        strip(record)
+        players = self.ratings.get(record['gameid'])
+        if players is not None:
+            # getwhr.py's account IDs are numbers, summaries' userids strings
+            winner, loser = players.get(str(record.get('winner_userid'))), players.get(str(record.get('loser_userid')))
+            if winner and loser:
+                if winner['rating'] and loser['rating']:
+                    record['has_fullwhr'] = 'Available'
+                    record['winner_whr'] = winner['rating']
+                    record['winner_whr_stdev'] = winner['stdev']
+                    record['loser_whr'] = loser['rating']
+                    record['loser_whr_stdev'] = loser['stdev']
+                    record['winner_whr_lead'] = record['winner_whr'] - record['loser_whr']
+                    return record
+                record['has_fullwhr'] = 'Server-sourced null'
+                if winner['rating']:
+                    record['winner_whr'] = winner['rating']
+                    record['winner_whr_stdev'] = winner['stdev']
+                elif loser['rating']:
+                    record['loser_whr'] = loser['rating']
+                    record['loser_whr_stdev'] = loser['stdev']
+            else:
+                record['has_fullwhr'] = 'UserID mismatch'
+        elif record['gameid'] in self.skipped:
+            record['has_fullwhr'] = 'Skipped (Causing server error)'
+        elif record['gameid'] in self.missing:
+            record['has_fullwhr'] = 'Missing (Silently ignored by server)'
+        else:
+            record['has_fullwhr'] = 'No data'
+        # For meaningful results, filter by "Available" in WHR Availability
+        for player in ('winner', 'loser'):
+            if not record.get(player + '_whr'):
+                record[player + '_whr'] = record[player + '_elo']
+                record[player + '_whr_stdev'] = FALLBACK_STDEV
+        record['winner_whr_lead'] = record['winner_whr'] - record['loser_whr']
+        return record
+
+
+def strip(record: dict) -> dict:
+    '''
+    Remove the WHR fields from a record, for when WHR is no longer joined.
+    '''
+    for name in WHR_FIELDS:
+        record.pop(name, None)
+    return record